@@ -0,0 +1,560 @@
+from road import Road
+from lane_index import LaneIndex
+from vehicle_arrays import VehicleArrays
+from vehicle import *
+from operator import attrgetter
+import numpy as np
+
+
+class ArrayRoad(Road):
+    """
+    Road that keeps the state of its vehicles in NumPy arrays (struct of arrays) instead of in the Vehicle objects.
+    The accelerations, positions, velocities and gaps of all vehicles are updated in a single batched step.
+
+    The arrays are indexed in the same order as the vehicle list, i.e. sorted by decreasing position:
+        the columns of VehicleArrays (positions, velocities, accelerations, gaps, lanes, vehicle parameters, ...)
+        leaders, followers: index of the next and previous vehicle in the same lane, -1 if there is none
+
+    The Vehicle objects stay available through the vehicles attribute, which acts as a view on the arrays: the
+    objects are brought up to date lazily, the first time the vehicle list is accessed after an update. The same
+    holds for lane_index, which is rebuilt from the arrays when it is needed.
+    Changes made directly to the Vehicle objects are not written back to the arrays, use load_vehicles to do so.
+
+    Leaders and followers are derived from the order of the vehicles within each lane, so a vehicle that passes its
+    leader (a collision) follows the vehicle that is now in front of it instead of keeping the old link.
+
+    Args:
+        see Road
+    """
+    def __init__(self, length, num_lanes=Road.DEFAULT_NUM_LANES, vehicles=None, vehicle_factory=None,
+                 insertion_gap=Road.DEFAULT_INSERTION_GAP, insertion_chance=Road.DEFAULT_INSERTION_CHANCE,
+                 time_step=Road.DEFAULT_TIME_STEP,
+                 lane_change_recheck_interval=Road.DEFAULT_LANE_CHANGE_RECHECK_INTERVAL, seed=None):
+        self._vehicles = []
+        self._stale_vehicles = False
+        self._lane_index = None
+        self.traffic_models = []
+        self.lane_change_models = []
+
+        super().__init__(length, num_lanes, vehicles, vehicle_factory, insertion_gap, insertion_chance, time_step,
+                         lane_change_recheck_interval, seed)
+
+    @property
+    def vehicles(self):
+        if self._stale_vehicles:
+            self.sync_vehicles()
+
+        return self._vehicles
+
+    @vehicles.setter
+    def vehicles(self, vehicles):
+        self._vehicles = vehicles
+        self.load_vehicles()
+
+    @property
+    def lane_index(self):
+        if self._lane_index is None:
+            self._lane_index = LaneIndex(self.num_lanes, self.vehicles)
+
+        return self._lane_index
+
+    @lane_index.setter
+    def lane_index(self, lane_index):
+        self._lane_index = lane_index
+
+    def invalidate_views(self):
+        self._stale_vehicles = True
+        self._lane_index = None
+
+    def load_vehicles(self):
+        """Rebuild the arrays from the Vehicle objects, sorting the vehicle list in the process"""
+        vehicles = self._vehicles
+        vehicles.sort(key=lambda x: x.position, reverse=True)
+        self._stale_vehicles = False
+        self._lane_index = None
+
+        arrays = VehicleArrays(vehicles, self.traffic_models, self.lane_change_models)
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, getattr(arrays, attribute))
+
+        self.update_links()
+
+    def sync_vehicles(self):
+        """Write the array state back to the Vehicle objects"""
+        vehicles = self._vehicles
+        leaders = self.leaders.tolist()
+        followers = self.followers.tolist()
+
+        for i, (vehicle, position, velocity, acceleration, gap, lane, last_lane_change_time) in enumerate(
+                zip(vehicles, self.positions.tolist(), self.velocities.tolist(), self.accelerations.tolist(),
+                    self.gaps.tolist(), self.lanes.tolist(), self.last_lane_change_times.tolist())):
+            vehicle.position = position
+            vehicle.velocity = velocity
+            vehicle.acceleration = acceleration
+            vehicle.gap = gap
+            vehicle.lane = lane
+            vehicle.last_lane_change_time = last_lane_change_time
+
+            vehicle.next_vehicle = None if leaders[i] < 0 else vehicles[leaders[i]]
+            vehicle.prev_vehicle = None if followers[i] < 0 else vehicles[followers[i]]
+
+        self._stale_vehicles = False
+
+    def sync_vehicle(self, index):
+        """Write the array state of the vehicle at index back to its Vehicle object (without its links) and return
+        it, None for index -1"""
+        if index < 0:
+            return None
+
+        vehicle = self._vehicles[index]
+        vehicle.position = float(self.positions[index])
+        vehicle.velocity = float(self.velocities[index])
+        vehicle.acceleration = float(self.accelerations[index])
+        vehicle.gap = float(self.gaps[index])
+        vehicle.lane = int(self.lanes[index])
+        vehicle.last_lane_change_time = float(self.last_lane_change_times[index])
+
+        return vehicle
+
+    def vehicle_ids(self):
+        # The ids are not part of the array state, so the Vehicle objects do not have to be brought up to date
+        return np.fromiter(map(attrgetter('vehicle_id'), self._vehicles), np.int64, len(self._vehicles))
+
+    def vehicle_links(self):
+        return self.leaders, self.followers
+
+    def vehicle_arrays(self):
+        arrays = VehicleArrays(traffic_models=self.traffic_models, lane_change_models=self.lane_change_models)
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(arrays, attribute, getattr(self, attribute))
+
+        return arrays
+
+    def update_links(self):
+        """Recompute the leaders, followers and gaps from the lanes and the order of the vehicles"""
+        num = self.positions.size
+        lane_order = np.lexsort((np.arange(num), self.lanes))
+        same_lane = self.lanes[lane_order[1:]] == self.lanes[lane_order[:-1]]
+
+        self.leaders = np.full(num, -1, dtype=int)
+        self.leaders[lane_order[1:][same_lane]] = lane_order[:-1][same_lane]
+        self.followers = np.full(num, -1, dtype=int)
+        self.followers[lane_order[:-1][same_lane]] = lane_order[1:][same_lane]
+
+        self.update_gaps()
+
+    def update_gaps(self):
+        has_leader = self.leaders >= 0
+        leaders = self.leaders[has_leader]
+
+        self.gaps = np.full(self.positions.size, math.inf)
+        self.gaps[has_leader] = self.positions[leaders] - self.positions[has_leader] - self.lengths[leaders]
+
+    def update_gaps_of(self, indices):
+        """Recompute the gaps of the vehicles at the given indices"""
+        for i in indices:
+            leader = self.leaders[i]
+            self.gaps[i] = math.inf if leader < 0 else self.positions[leader] - self.positions[i] - self.lengths[leader]
+
+    def update_accelerations(self):
+        self.acceleration_update_count += self.positions.size
+        has_leader = self.leaders >= 0
+        next_velocities = np.where(has_leader, self.velocities[self.leaders], 0)
+
+        for model_id, traffic_model in enumerate(self.traffic_models):
+            mask = self.model_ids == model_id
+            if not mask.any():
+                continue
+
+            self.accelerations[mask] = traffic_model.calculate_accelerations(
+                self.velocities[mask], self.gaps[mask], next_velocities[mask], self.desired_velocities[mask],
+                self.desired_time_headways[mask], self.max_accelerations[mask], self.comfortable_decelerations[mask])
+
+        self.invalidate_views()
+
+    def skip_lane_changes(self, time):
+        # The arrays tell directly whether a vehicle is off cooldown, so nothing has to be tracked
+        can_change = self.lane_change_model_ids >= 0
+        on_cooldown = time - self.last_lane_change_times < self.get_min_last_change_deltas(self)
+        if (can_change & ~on_cooldown).any():
+            return False
+
+        self.cooldown_skip_count += self.count_lane_change_options(self.lanes[can_change])
+        return True
+
+    def update_lane_change_schedule(self, state):
+        # skip_lane_changes looks at the arrays directly, so there is no schedule to keep
+        pass
+
+    def apply_lane_changes(self, candidates, decisions, time, stale=None):
+        # Same rules as Road.apply_lane_changes, on the arrays: only the lanes, times and links of the vehicles that
+        # change lanes (and of their neighbours) are updated, and only the Vehicle objects involved in a lane change
+        # that is evaluated again are brought up to date
+        stale = np.zeros(decisions.size, dtype=bool) if stale is None else stale.copy()
+        pending = decisions | stale
+        changed_vehicles = set()
+        changed_gaps = set()
+
+        start = 0
+        while True:
+            remaining = np.flatnonzero(pending[start:])
+            if remaining.size == 0:
+                break
+
+            i = start + int(remaining[0])
+            start = i + 1
+
+            index = int(candidates.vehicles[i])
+            if index in changed_vehicles:
+                continue
+
+            new_lane = int(candidates.new_lanes[i])
+            if stale[i]:
+                new_next_index, new_prev_index = self.find_neighbours(new_lane, self.positions[index])
+                self.lane_change_reevaluation_count += 1
+                if not self.will_change_lane(index, new_lane, new_next_index, new_prev_index, time):
+                    continue
+            else:
+                new_next_index = int(candidates.new_next_vehicles[i])
+                new_prev_index = int(candidates.new_prev_vehicles[i])
+
+            next_index = int(self.leaders[index])
+            changed_indices = [next_index, new_next_index]
+            if next_index >= 0 and self.obstacles[next_index]:
+                changed_indices.append(int(self.followers[index]))
+            if new_next_index >= 0 and self.obstacles[new_next_index]:
+                changed_indices.append(new_prev_index)
+
+            later = slice(start, None)
+            invalidated = self.find_invalidated_lane_changes(
+                candidates, later, [changed for changed in changed_indices if changed >= 0], index, new_lane,
+                new_next_index, new_prev_index)
+            stale[later] |= invalidated
+            pending[later] |= invalidated
+
+            changed_vehicles.add(index)
+            self.lane_change_count += 1
+            if self.event_log is not None:
+                self.event_log.record_lane_change(time, self._vehicles[index], new_lane)
+            changed_gaps.update(self.change_vehicle_lane(index, new_lane, time))
+
+        # The gaps are updated after all lane changes, like the gaps of the Vehicle objects of a Road
+        if changed_vehicles:
+            self.update_gaps_of(changed_gaps)
+            self.invalidate_views()
+
+        return stale
+
+    def replay_lane_changes(self, time):
+        lane_changes = self.event_log.replay_lane_changes(time)
+        if not lane_changes:
+            return
+
+        indices = {vehicle.vehicle_id: i for i, vehicle in enumerate(self._vehicles)}
+        changed_gaps = set()
+        for vehicle_id, new_lane in lane_changes:
+            self.lane_change_count += 1
+            changed_gaps.update(self.change_vehicle_lane(indices[vehicle_id], new_lane, time))
+
+        self.update_gaps_of(changed_gaps)
+        self.invalidate_views()
+
+    """
+        Args:
+            lane: lane in which to look for the neighbours
+            position: longitudinal position on the road [m]
+
+        Returns:
+            Tuple of the index of the closest vehicle in front of the position and of the closest vehicle at or behind
+            the position, -1 if there is no such vehicle (see LaneIndex.get_neighbours)
+    """
+    def find_neighbours(self, lane, position):
+        i = int(np.searchsorted(-self.positions, -position))
+        return self.find_in_lane(lane, i - 1, -1), self.find_in_lane(lane, i, 1)
+
+    """
+        Searches the vehicle list for the closest vehicle in a lane, in windows that grow with the distance, so a lane
+        change only looks at the vehicles around it instead of at the whole lane.
+
+        Args:
+            lane: lane of the vehicle to find
+            index: index in the vehicle list to start at (inclusive)
+            direction: 1 to search towards the end of the vehicle list, -1 towards the start
+
+        Returns:
+            Index of the closest vehicle in the lane, -1 if there is none
+    """
+    def find_in_lane(self, lane, index, direction):
+        size = 16
+        while 0 <= index < self.lanes.size:
+            start, end = (index, index + size) if direction > 0 else (max(index - size + 1, 0), index + 1)
+            matches = np.flatnonzero(self.lanes[start:end] == lane)
+            if matches.size > 0:
+                return start + int(matches[0] if direction > 0 else matches[-1])
+
+            index = end if direction > 0 else start - 1
+            size *= 4
+
+        return -1
+
+    def will_change_lane(self, index, new_lane, new_next_index, new_prev_index, time):
+        """Evaluate a single lane change of the vehicle at index with its lane change model, after bringing the Vehicle
+        objects it looks at up to date"""
+        vehicle = self.sync_vehicle(index)
+        vehicle.next_vehicle = self.sync_vehicle(int(self.leaders[index]))
+        vehicle.prev_vehicle = self.sync_vehicle(int(self.followers[index]))
+
+        return vehicle.will_change_lane(new_lane, self.sync_vehicle(new_next_index), self.sync_vehicle(new_prev_index),
+                                        time)
+
+    """
+        Moves the vehicle at index to another lane, between the vehicles before and after it in the order of the
+        vehicle list, and links its old neighbours to each other. The gaps are not updated.
+
+        Returns:
+            List of the indices of the vehicles that got a new next vehicle
+    """
+    def change_vehicle_lane(self, index, new_lane, time):
+        next_index = int(self.leaders[index])
+        prev_index = int(self.followers[index])
+        if next_index >= 0:
+            self.followers[next_index] = prev_index
+        if prev_index >= 0:
+            self.leaders[prev_index] = next_index
+
+        new_next_index = self.find_in_lane(new_lane, index - 1, -1)
+        new_prev_index = self.find_in_lane(new_lane, index + 1, 1)
+        self.leaders[index] = new_next_index
+        self.followers[index] = new_prev_index
+        if new_next_index >= 0:
+            self.followers[new_next_index] = index
+        if new_prev_index >= 0:
+            self.leaders[new_prev_index] = index
+
+        self.lanes[index] = new_lane
+        self.last_lane_change_times[index] = time
+
+        return [changed for changed in (index, prev_index, new_prev_index) if changed >= 0]
+
+    def update_positions_velocities(self):
+        if self.detectors:
+            self.update_detectors()
+        if self.space_time_grids:
+            self.update_space_time_grids()
+
+        moving = ~self.obstacles
+        self.positions[moving] += self.time_step * self.velocities[moving]
+
+        updating = moving & (self.positions <= self.length)
+        self.velocities[updating] = np.maximum(0, self.velocities[updating]
+                                               + self.time_step * self.accelerations[updating])
+
+        self.update_gaps()
+        self.invalidate_views()
+        self.sort_vehicles()
+
+        # Remove vehicles from road that reached the end of the road, these are at the front of the sorted arrays
+        exited_count = int(np.count_nonzero(self.positions > self.length))
+        if exited_count > 0:
+            self.remove_front_vehicles(exited_count)
+
+    def update_detectors(self):
+        # Only the vehicles less than a step at the highest velocity behind a detector can reach it in this step
+        max_distance = self.time_step * (self.velocities.max() if self.velocities.size else 0)
+        reversed_positions = -self.positions
+        for detector in self.detectors:
+            start, end = np.searchsorted(reversed_positions, [-detector.position, max_distance - detector.position],
+                                         side='right')
+            nearby = np.arange(start, end)
+            crossing = nearby[self.positions[nearby] + self.time_step * self.velocities[nearby] >= detector.position]
+            if detector.lane is not None:
+                crossing = crossing[self.lanes[crossing] == detector.lane]
+
+            detector.update(self.velocities[crossing].tolist(), self.lengths[crossing].tolist())
+
+    def update_space_time_grids(self):
+        moving = ~self.obstacles
+        for space_time_grid in self.space_time_grids:
+            space_time_grid.update(self.positions[moving], self.velocities[moving], self.lanes[moving])
+
+    def remove_front_vehicles(self, count):
+        if self.vehicle_factory is not None:
+            self.vehicle_factory.release_vehicles(self._vehicles[:count])
+
+        self.removed_vehicle_count += count
+        self._remove_front(count)
+
+    def _remove_front(self, count):
+        """Remove the first count vehicles, the vehicles behind them keep their order and links"""
+        del self._vehicles[:count]
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, getattr(self, attribute)[count:])
+
+        for attribute in ('leaders', 'followers'):
+            links = getattr(self, attribute)[count:] - count
+            links[links < 0] = -1
+            setattr(self, attribute, links)
+
+        self.gaps[self.leaders < 0] = math.inf
+        self.invalidate_views()
+
+    def sort_vehicles(self):
+        if self.positions.size < 2 or not (np.diff(self.positions) > 0).any():
+            return
+
+        self._keep(np.argsort(-self.positions, kind='stable'))
+        self.invalidate_views()
+
+    def _keep(self, indices):
+        """Select (and reorder) the vehicles at the given indices, dropping all others"""
+        self._vehicles = [self._vehicles[i] for i in indices.tolist()]
+
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, getattr(self, attribute)[indices])
+
+        self.update_links()
+
+    def _insert(self, index, vehicles):
+        """Insert the given vehicles in the arrays and the vehicle list, starting at index"""
+        arrays = VehicleArrays(vehicles, self.traffic_models, self.lane_change_models)
+        self._vehicles[index:index] = vehicles
+        self.inserted_vehicle_count += len(vehicles)
+
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, np.insert(getattr(self, attribute), index, getattr(arrays, attribute)))
+
+        self.update_links()
+        self.invalidate_views()
+
+    def insert_vehicle(self, vehicle):
+        """Insert a single vehicle behind the vehicles at the same position, only updating the links of its neighbours
+        in the lane"""
+        index = int(np.searchsorted(-self.positions, -vehicle.position, side='right'))
+        arrays = VehicleArrays([vehicle], self.traffic_models, self.lane_change_models)
+        self._vehicles.insert(index, vehicle)
+        self.inserted_vehicle_count += 1
+
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, np.insert(getattr(self, attribute), index, getattr(arrays, attribute)))
+
+        # Indices from the inserted vehicle onwards move down by one
+        for links in (self.leaders, self.followers):
+            links[links >= index] += 1
+        self.leaders = np.insert(self.leaders, index, -1)
+        self.followers = np.insert(self.followers, index, -1)
+
+        in_lane = np.flatnonzero(self.lanes == vehicle.lane)
+        i = int(np.searchsorted(in_lane, index))
+        if i > 0:
+            self.leaders[index] = in_lane[i - 1]
+            self.followers[in_lane[i - 1]] = index
+        if i + 1 < in_lane.size:
+            self.followers[index] = in_lane[i + 1]
+            self.leaders[in_lane[i + 1]] = index
+
+        self.update_local_gaps(index)
+        self.invalidate_views()
+
+    def _remove(self, index):
+        """Remove the vehicle at index, linking its leader and follower to each other"""
+        leader = int(self.leaders[index])
+        follower = int(self.followers[index])
+        if leader >= 0:
+            self.followers[leader] = follower
+        if follower >= 0:
+            self.leaders[follower] = leader
+
+        del self._vehicles[index]
+        for attribute in VehicleArrays.COLUMNS + ('leaders', 'followers'):
+            setattr(self, attribute, np.delete(getattr(self, attribute), index))
+
+        # Indices behind the removed vehicle move up by one
+        for links in (self.leaders, self.followers):
+            links[links > index] -= 1
+
+        if follower >= 0:
+            self.update_local_gaps(follower - 1)
+        self.invalidate_views()
+
+    def update_local_gaps(self, index):
+        """Recompute the gaps of the vehicle at index and of its follower"""
+        self.update_gaps_of(i for i in (index, int(self.followers[index])) if i >= 0)
+
+    def add_vehicle(self, vehicle):
+        self.insert_vehicle(vehicle)
+
+    def remove_vehicle(self, vehicle):
+        # The Vehicle objects may be out of date, so the vehicle is looked up by identity instead of by position
+        try:
+            index = self._vehicles.index(vehicle)
+        except ValueError:
+            return
+
+        self._remove(index)
+
+    def generate_new_vehicles(self, time):
+        if self.vehicle_factory is None:
+            return
+
+        new_vehicles = []
+        for new_vehicle in self.create_new_vehicles(time):
+            in_lane = np.flatnonzero(self.lanes == new_vehicle.lane)
+            if in_lane.size == 0:
+                distance = self.length
+            else:
+                next_index = in_lane[-1]
+                distance = self.positions[next_index] - new_vehicle.position - self.lengths[next_index]
+
+            if distance >= self.insertion_gap:
+                new_vehicles.append(new_vehicle)
+            else:
+                self.vehicle_factory.release_vehicles([new_vehicle])
+
+        if new_vehicles:
+            self._insert(len(self._vehicles), new_vehicles)
+            if self.event_log is not None:
+                for new_vehicle in new_vehicles:
+                    self.event_log.record_insertion(time, new_vehicle)
+
+    def get_entry_gaps(self):
+        # The vehicles are sorted, so the last vehicle of a lane has the highest index in it
+        last_vehicles = np.full(self.num_lanes, -1)
+        np.maximum.at(last_vehicles, self.lanes, np.arange(self.lanes.size))
+
+        in_use = last_vehicles >= 0
+        gaps = np.full(self.num_lanes, math.inf)
+        velocities = np.full(self.num_lanes, math.inf)
+        gaps[in_use] = self.positions[last_vehicles[in_use]] - self.lengths[last_vehicles[in_use]]
+        velocities[in_use] = self.velocities[last_vehicles[in_use]]
+
+        return gaps, velocities
+
+    def get_traffic_flow(self, at_position, current_time):
+        if not 0 <= at_position <= self.length:
+            return -1
+
+        vehicles_passed_point = (int(np.count_nonzero((self.positions > at_position) & ~self.obstacles))
+                                 + self.removed_vehicle_count)
+
+        return vehicles_passed_point / (current_time / 3600)
+
+    def remove_obstacle(self, lane, at_position):
+        if not 0 <= lane < self.num_lanes:
+            return
+
+        # Only the vehicles at the position, found with a binary search, are checked
+        start = int(np.searchsorted(-self.positions, -at_position, side='left'))
+        end = int(np.searchsorted(-self.positions, -at_position, side='right'))
+        matches = np.flatnonzero(self.obstacles[start:end] & (self.lanes[start:end] == lane))
+        if matches.size > 0:
+            self._remove(start + int(matches[0]))
+            if self.event_log is not None:
+                self.event_log.record_obstacle(lane, at_position)
+
+    def vehicle_density(self):
+        vehicles_count = int(np.count_nonzero(~self.obstacles))
+
+        if vehicles_count == 0:
+            return 0
+
+        return vehicles_count / self.length
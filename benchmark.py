@@ -0,0 +1,220 @@
+from scenario import TRAFFIC_MODELS, ROADS, spawn_seeds
+from lane_change_models import MOBIL
+from vehicle_factory import VehicleFactory
+from instrumentation import Instrumentation
+from segmented_road import SegmentedRoad
+from itertools import product
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time as timer
+import tracemalloc
+
+import numpy as np
+
+
+DEFAULT_VEHICLE_COUNTS = [100, 1000, 10000, 100000]
+DEFAULT_LANE_COUNTS = [1, 2, 3, 4, 5]
+DEFAULT_TRAFFIC_MODELS = ['IDM', 'Gipps']
+DEFAULT_ROADS = ['Road']
+DEFAULT_SEGMENT_COUNTS = [1, 2, 4, 8]
+
+DEFAULT_STEPS = 10
+DEFAULT_WARMUP_STEPS = 2
+
+# Distance between the vehicles in the initial rows [m]
+SPACING = 40
+
+
+def create_road(road_type, num_vehicles, num_lanes, traffic_model, lane_changes, seed=0):
+    """Road with num_vehicles vehicles spread over rows in all lanes, and factory inflow at the start of the road"""
+    road_seed, factory_seed = spawn_seeds(seed)
+
+    time_step = ROADS[road_type].DEFAULT_TIME_STEP
+    lane_change_model = MOBIL() if lane_changes else None
+    vehicle_factory = VehicleFactory([1, 1, 1, 1], TRAFFIC_MODELS[traffic_model](time_step), lane_change_model,
+                                     seed=factory_seed, pool_size=VehicleFactory.REUSE_POOL_SIZE)
+
+    vehicles = []
+    for lane in range(num_lanes):
+        num = num_vehicles // num_lanes + (lane < num_vehicles % num_lanes)
+        vehicles += vehicle_factory.create_random_vehicle_row(num, SPACING, lane=lane)
+
+    # Long enough that no vehicle reaches the end of the road during the benchmark
+    length = 2 * SPACING * (num_vehicles // num_lanes + 1) + 10000
+    return ROADS[road_type](length, num_lanes=num_lanes, vehicles=vehicles, vehicle_factory=vehicle_factory,
+                            time_step=time_step, seed=road_seed)
+
+
+"""
+    Benchmarks a single configuration.
+
+    Returns:
+        Dict with the configuration and the results:
+            steps_per_second, vehicle_updates_per_second: throughput of the measured steps
+            peak_memory: peak memory allocated while building the road and during the warmup and measured steps
+                         [bytes], traced in a separate run with the same seed, as tracing slows down the steps
+            phase_seconds: mean time spent per step in each phase of the update (see Instrumentation.PHASES),
+                           sort_vehicles is included in the phase that calls it as well
+            counters: mean change of the road's counters per step, e.g. the number of lane change evaluations
+"""
+def run_benchmark(road_type, num_vehicles, num_lanes, traffic_model, lane_changes, steps=DEFAULT_STEPS,
+                  warmup_steps=DEFAULT_WARMUP_STEPS):
+    tracemalloc.start()
+    road = create_road(road_type, num_vehicles, num_lanes, traffic_model, lane_changes)
+    for step in range(warmup_steps + steps):
+        road.update(step * road.time_step)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    road = create_road(road_type, num_vehicles, num_lanes, traffic_model, lane_changes)
+    for step in range(warmup_steps):
+        road.update(step * road.time_step)
+
+    with Instrumentation(road) as instrumentation:
+        acceleration_update_count = road.acceleration_update_count
+        start = timer.perf_counter()
+        for step in range(warmup_steps, warmup_steps + steps):
+            road.update(step * road.time_step)
+        elapsed = timer.perf_counter() - start
+        vehicle_updates = road.acceleration_update_count - acceleration_update_count
+
+        metrics = instrumentation.snapshot()
+
+    return {
+        'road': road_type,
+        'vehicles': num_vehicles,
+        'lanes': num_lanes,
+        'traffic_model': traffic_model,
+        'lane_changes': lane_changes,
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_second': steps / elapsed,
+        'vehicle_updates_per_second': vehicle_updates / elapsed,
+        'peak_memory': peak_memory,
+        'phase_seconds': {phase: phase_time / steps for phase, phase_time in metrics['phase_seconds'].items()},
+        'counters': {name: count / steps for name, count in metrics['counters'].items()},
+    }
+
+
+"""
+    Benchmarks a SegmentedRoad, split from an ArrayRoad, to see how the step throughput scales with the number of
+    segments (worker processes).
+
+    Returns:
+        Dict with the configuration and the steps_per_second and vehicle_updates_per_second of the measured steps
+"""
+def run_segment_benchmark(num_vehicles, num_lanes, traffic_model, lane_changes, num_segments, steps=DEFAULT_STEPS,
+                          warmup_steps=DEFAULT_WARMUP_STEPS):
+    road = create_road('ArrayRoad', num_vehicles, num_lanes, traffic_model, lane_changes)
+    with SegmentedRoad(road, num_segments) as segmented_road:
+        for step in range(warmup_steps):
+            segmented_road.update(step * segmented_road.time_step)
+
+        acceleration_update_count = segmented_road.acceleration_update_count
+        start = timer.perf_counter()
+        for step in range(warmup_steps, warmup_steps + steps):
+            segmented_road.update(step * segmented_road.time_step)
+        elapsed = timer.perf_counter() - start
+        vehicle_updates = segmented_road.acceleration_update_count - acceleration_update_count
+
+    return {
+        'segments': num_segments,
+        'vehicles': num_vehicles,
+        'lanes': num_lanes,
+        'traffic_model': traffic_model,
+        'lane_changes': lane_changes,
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_second': steps / elapsed,
+        'vehicle_updates_per_second': vehicle_updates / elapsed,
+    }
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+
+def run_suite(roads, vehicle_counts, lane_counts, traffic_models, lane_change_options, steps=DEFAULT_STEPS,
+              warmup_steps=DEFAULT_WARMUP_STEPS, verbose=True):
+    results = []
+    for road_type, num_vehicles, num_lanes, traffic_model, lane_changes in product(
+            roads, vehicle_counts, lane_counts, traffic_models, lane_change_options):
+        result = run_benchmark(road_type, num_vehicles, num_lanes, traffic_model, lane_changes, steps, warmup_steps)
+        results.append(result)
+
+        if verbose:
+            print(f'{road_type:>9} {num_vehicles:>7} vehicles {num_lanes} lanes {traffic_model:>5} '
+                  f'{"MOBIL" if lane_changes else "-":>5}: {result["steps_per_second"]:9.2f} steps/s '
+                  f'{result["vehicle_updates_per_second"]:12.0f} vehicle updates/s '
+                  f'{result["peak_memory"] / 2 ** 20:8.1f} MiB', flush=True)
+
+    return {'environment': get_environment(), 'results': results}
+
+
+def run_scaling_suite(segment_counts, vehicle_counts, lane_counts, traffic_models, lane_change_options,
+                      steps=DEFAULT_STEPS, warmup_steps=DEFAULT_WARMUP_STEPS, verbose=True):
+    results = []
+    for num_vehicles, num_lanes, traffic_model, lane_changes, num_segments in product(
+            vehicle_counts, lane_counts, traffic_models, lane_change_options, segment_counts):
+        result = run_segment_benchmark(num_vehicles, num_lanes, traffic_model, lane_changes, num_segments, steps,
+                                       warmup_steps)
+        results.append(result)
+
+        if verbose:
+            print(f'{num_segments:>3} segments {num_vehicles:>7} vehicles {num_lanes} lanes {traffic_model:>5} '
+                  f'{"MOBIL" if lane_changes else "-":>5}: {result["steps_per_second"]:9.2f} steps/s '
+                  f'{result["vehicle_updates_per_second"]:12.0f} vehicle updates/s', flush=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the step throughput of roads.')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=DEFAULT_VEHICLE_COUNTS)
+    parser.add_argument('--lanes', type=int, nargs='+', default=DEFAULT_LANE_COUNTS)
+    parser.add_argument('--models', nargs='+', default=DEFAULT_TRAFFIC_MODELS, choices=sorted(TRAFFIC_MODELS))
+    parser.add_argument('--roads', nargs='+', default=DEFAULT_ROADS, choices=sorted(ROADS))
+    parser.add_argument('--lane-changes', nargs='+', default=['on', 'off'], choices=['on', 'off'],
+                        help='benchmark with and/or without the MOBIL lane change model')
+    parser.add_argument('--steps', type=int, default=DEFAULT_STEPS, help='number of measured steps')
+    parser.add_argument('--warmup-steps', type=int, default=DEFAULT_WARMUP_STEPS)
+    parser.add_argument('--segments', type=int, nargs='*',
+                        help='also benchmark a SegmentedRoad with these numbers of segments, '
+                             f'{" ".join(map(str, DEFAULT_SEGMENT_COUNTS))} if no number is given')
+    args = parser.parse_args()
+
+    lane_change_options = [option == 'on' for option in args.lane_changes]
+    report = run_suite(args.roads, args.vehicles, args.lanes, args.models, lane_change_options, args.steps,
+                       args.warmup_steps)
+    if args.segments is not None:
+        report['segment_scaling'] = run_scaling_suite(args.segments or DEFAULT_SEGMENT_COUNTS, args.vehicles,
+                                                      args.lanes, args.models, lane_change_options, args.steps,
+                                                      args.warmup_steps)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print(f'Results are in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+from road import Road, IdleLaneChanges
+from array_road import ArrayRoad
+from vehicle_factory import VehicleFactory
+from incidents import Incident, IncidentSchedule
+from vehicle import *
+from operator import attrgetter
+import gc
+import importlib
+import json
+
+import numpy as np
+
+
+ROAD_CLASSES = {road_class.__name__: road_class for road_class in (Road, ArrayRoad)}
+
+# Attributes of the vehicles that are stored as a column in the checkpoint
+FLOAT_ATTRIBUTES = ('position', 'velocity', 'acceleration', 'gap', 'last_lane_change_time')
+INT_ATTRIBUTES = ('lane', 'vehicle_id')
+
+# Counters of the road that are restored, so statistics like the traffic flow continue where they left off
+COUNTERS = ('removed_vehicle_count', 'inserted_vehicle_count', 'acceleration_update_count', 'free_flow_update_count',
+            'lane_change_evaluation_count', 'cooldown_skip_count', 'idle_skip_count', 'lane_change_reevaluation_count',
+            'lane_change_count')
+
+
+def get_vehicle_classes(vehicle_class=Vehicle):
+    vehicle_classes = {vehicle_class.__name__: vehicle_class}
+    for subclass in vehicle_class.__subclasses__():
+        vehicle_classes.update(get_vehicle_classes(subclass))
+
+    return vehicle_classes
+
+
+def describe_model(model):
+    return {'module': model.__class__.__module__, 'class': model.__class__.__name__, 'attributes': vars(model)}
+
+
+def describe_random(generator):
+    return generator.bit_generator.state
+
+
+def restore_random(state):
+    bit_generator = getattr(np.random, state['bit_generator'])()
+    bit_generator.state = state
+
+    return np.random.Generator(bit_generator)
+
+
+def restore_model(description):
+    model_class = getattr(importlib.import_module(description['module']), description['class'])
+    model = model_class.__new__(model_class)
+    model.__dict__.update(description['attributes'])
+
+    return model
+
+
+"""
+    Saves the full state of a road to a compact binary checkpoint (an uncompressed .npz file with a column per vehicle
+    attribute), from which the simulation can be continued bit-identically with load_checkpoint.
+
+    The checkpoint contains the vehicles (including obstacles) with their state, parameters, lanes and models, the
+    leader/follower links, the order of the vehicles in each lane, the parameters and counters of the road, the vehicle
+    factory, the state of the random number generators of the road and the factory (including the numbers that were
+    drawn but not used yet), the incident schedule (the starts and ends that are still due and the moving bottlenecks
+    of the incidents in progress) and the simulation time.
+
+    Args:
+        road: road to save
+        path: path of the checkpoint file
+        time: current time elapsed in the simulation, the time of the next update
+"""
+def save_checkpoint(road, path, time):
+    vehicles = road.vehicles
+    num = len(vehicles)
+    indices = {vehicle: i for i, vehicle in enumerate(vehicles)}
+
+    traffic_models = list(map(attrgetter('traffic_model'), vehicles))
+    lane_change_models = list(map(attrgetter('lane_change_model'), vehicles))
+
+    models = []
+    model_indices = {id(None): -1}
+
+    def get_model_index(model):
+        if id(model) not in model_indices:
+            model_indices[id(model)] = len(models)
+            models.append(model)
+
+        return model_indices[id(model)]
+
+    for model in {id(model): model for model in traffic_models + lane_change_models}.values():
+        get_model_index(model)
+
+    vehicle_classes = list({vehicle.__class__: None for vehicle in vehicles})
+    class_indices = {vehicle_class: i for i, vehicle_class in enumerate(vehicle_classes)}
+
+    arrays = {attribute: np.fromiter(map(attrgetter(attribute), vehicles), float, num)
+              for attribute in FLOAT_ATTRIBUTES}
+    arrays.update({attribute: np.fromiter(map(attrgetter(attribute), vehicles), np.int64, num)
+                   for attribute in INT_ATTRIBUTES})
+
+    arrays['class_ids'] = np.fromiter(map(class_indices.__getitem__, map(type, vehicles)), np.int64, num)
+    arrays['traffic_models'] = np.fromiter(map(model_indices.__getitem__, map(id, traffic_models)), np.int64, num)
+    arrays['lane_change_models'] = np.fromiter(map(model_indices.__getitem__, map(id, lane_change_models)), np.int64,
+                                               num)
+
+    arrays['next_vehicles'], arrays['prev_vehicles'] = map(np.asarray, road.vehicle_links())
+
+    lane_vehicles = road.lane_index.lanes
+    arrays['lane_sizes'] = np.array([len(lane) for lane in lane_vehicles], dtype=np.int64)
+    arrays['lane_order'] = np.fromiter((indices[vehicle] for lane in lane_vehicles for vehicle in lane), np.int64,
+                                       int(arrays['lane_sizes'].sum()))
+
+    if road.idle_lane_changes is not None:
+        arrays.update({f'idle_{name}': value for name, value in road.idle_lane_changes._asdict().items()})
+
+    arrays['random_block'] = np.array(road.random_block[road.random_position:], dtype=float)
+
+    vehicle_factory = None
+    if road.vehicle_factory is not None:
+        vehicle_factory = {
+            'weights': road.vehicle_factory.weights,
+            'default_traffic_model': get_model_index(road.vehicle_factory.default_traffic_model),
+            'default_lane_change_model': get_model_index(road.vehicle_factory.default_lane_change_model),
+            'random_state': describe_random(road.vehicle_factory.random),
+            'pool_size': road.vehicle_factory.pool_size,
+        }
+        arrays['vehicle_type_block'] = np.array(
+            road.vehicle_factory.vehicle_type_block[road.vehicle_factory.vehicle_type_position:], dtype=np.int64)
+
+    incident_schedule = None
+    if road.incident_schedule is not None:
+        incident_schedule = describe_incident_schedule(road.incident_schedule, indices)
+
+    # Peek at the id the next new vehicle gets, so the restored road continues with the same ids
+    next_vehicle_id = next(Vehicle.ids)
+    Vehicle.ids = count(next_vehicle_id)
+
+    metadata = {
+        'road_class': road.__class__.__name__,
+        'length': road.length,
+        'num_lanes': road.num_lanes,
+        'insertion_gap': road.insertion_gap,
+        'insertion_chance': road.insertion_chance,
+        'time_step': road.time_step,
+        'lane_change_recheck_interval': road.lane_change_recheck_interval,
+        'counters': {counter: getattr(road, counter) for counter in COUNTERS},
+        'time': time,
+        'next_vehicle_id': next_vehicle_id,
+        'random_state': describe_random(road.random),
+        'models': [describe_model(model) for model in models],
+        'vehicle_classes': [vehicle_class.__name__ for vehicle_class in vehicle_classes],
+        'vehicle_factory': vehicle_factory,
+        'incident_schedule': incident_schedule,
+    }
+    arrays['metadata'] = np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8)
+
+    with open(path, 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, **arrays)
+
+
+"""
+    Args:
+        incident_schedule: IncidentSchedule of the road
+        indices: dict with the index of each vehicle of the road in the checkpoint
+
+    Returns:
+        Dict with the pending events of the schedule (in heap order), the next sequence number and the indices of the
+        moving bottlenecks of the incidents in progress
+"""
+def describe_incident_schedule(incident_schedule, indices):
+    next_sequence = next(incident_schedule.sequence)
+    incident_schedule.sequence = count(next_sequence)
+
+    return {
+        'events': [(time, sequence, starts, dict(incident._asdict(), lanes=list(map(int, incident.lanes))), start)
+                   for time, sequence, starts, incident, start in incident_schedule.events],
+        'next_sequence': next_sequence,
+        # Moving bottlenecks that already left the road are not removed at the end of their incident anyway
+        'bottlenecks': [(start, [indices[bottleneck] for bottleneck in bottlenecks if bottleneck in indices])
+                        for start, bottlenecks in incident_schedule.bottlenecks.items()],
+    }
+
+
+def restore_incident_schedule(road, description, vehicles):
+    incident_schedule = IncidentSchedule(road)
+    # Saved in heap order, so the list is still a heap
+    incident_schedule.events = [(time, sequence, starts, Incident(**dict(incident, lanes=tuple(incident['lanes']))),
+                                 start)
+                                for time, sequence, starts, incident, start in description['events']]
+    incident_schedule.sequence = count(description['next_sequence'])
+    incident_schedule.bottlenecks = {start: [vehicles[i] for i in bottleneck_indices]
+                                     for start, bottleneck_indices in description['bottlenecks']}
+
+    return incident_schedule
+
+
+def restore_vehicles(arrays, metadata, models):
+    all_vehicle_classes = get_vehicle_classes()
+    vehicle_classes = [all_vehicle_classes[name] for name in metadata['vehicle_classes']]
+    vehicles = [vehicle_class.__new__(vehicle_class)
+                for vehicle_class in map(vehicle_classes.__getitem__, arrays['class_ids'].tolist())]
+
+    # Index -1 (no model or vehicle) selects the None at the end
+    models = models + [None]
+    linked_vehicles = vehicles + [None]
+
+    attributes = FLOAT_ATTRIBUTES + INT_ATTRIBUTES + ('traffic_model', 'lane_change_model', 'next_vehicle',
+                                                      'prev_vehicle')
+    columns = [arrays[attribute].tolist() for attribute in FLOAT_ATTRIBUTES + INT_ATTRIBUTES]
+    columns += [list(map(models.__getitem__, arrays['traffic_models'].tolist())),
+                list(map(models.__getitem__, arrays['lane_change_models'].tolist())),
+                list(map(linked_vehicles.__getitem__, arrays['next_vehicles'].tolist())),
+                list(map(linked_vehicles.__getitem__, arrays['prev_vehicles'].tolist()))]
+
+    # Vehicles have no __dict__, their attributes are slots that are filled a column at a time
+    for attribute, column in zip(attributes, columns):
+        for vehicle, value in zip(vehicles, column):
+            setattr(vehicle, attribute, value)
+
+    return vehicles
+
+
+"""
+    Args:
+        path: path of a checkpoint written by save_checkpoint
+
+    Returns:
+        Tuple of the restored road and the simulation time at which it was saved
+"""
+def load_checkpoint(path):
+    with np.load(path) as checkpoint:
+        arrays = {name: checkpoint[name] for name in checkpoint.files}
+
+    metadata = json.loads(arrays.pop('metadata').tobytes().decode())
+    models = [restore_model(description) for description in metadata['models']]
+
+    # Creating many linked objects at once triggers the garbage collector over and over, without anything to collect
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        vehicles = restore_vehicles(arrays, metadata, models)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    # New vehicles must not reuse the ids of the restored ones (or of other vehicles created in this process)
+    Vehicle.ids = count(max(next(Vehicle.ids), metadata['next_vehicle_id']))
+
+    vehicle_factory = None
+    if metadata['vehicle_factory'] is not None:
+        default_traffic_model, default_lane_change_model = (
+            None if model_index < 0 else models[model_index]
+            for model_index in (metadata['vehicle_factory']['default_traffic_model'],
+                                metadata['vehicle_factory']['default_lane_change_model']))
+        # Checkpoints from before the pool size was saved come from factories without reuse
+        vehicle_factory = VehicleFactory(metadata['vehicle_factory']['weights'], default_traffic_model,
+                                         default_lane_change_model, seed=0,
+                                         pool_size=metadata['vehicle_factory'].get('pool_size',
+                                                                                   VehicleFactory.DEFAULT_POOL_SIZE))
+        vehicle_factory.random = restore_random(metadata['vehicle_factory']['random_state'])
+        vehicle_factory.vehicle_type_block = arrays['vehicle_type_block'].tolist()
+    road = ROAD_CLASSES[metadata['road_class']](
+        metadata['length'], num_lanes=metadata['num_lanes'], vehicles=vehicles, vehicle_factory=vehicle_factory,
+        insertion_gap=metadata['insertion_gap'], insertion_chance=metadata['insertion_chance'],
+        time_step=metadata['time_step'], lane_change_recheck_interval=metadata['lane_change_recheck_interval'], seed=0)
+    road.random = restore_random(metadata['random_state'])
+    road.random_block = arrays['random_block'].tolist()
+
+    # Vehicles at the same position may be ordered differently within a lane than in the vehicle list
+    lane_order = iter(arrays['lane_order'].tolist())
+    road.lane_index.lanes = [[vehicles[next(lane_order)] for _ in range(lane_size)]
+                             for lane_size in arrays['lane_sizes'].tolist()]
+
+    for counter, value in metadata['counters'].items():
+        setattr(road, counter, value)
+
+    if 'idle_keys' in arrays:
+        road.idle_lane_changes = IdleLaneChanges(*(arrays[f'idle_{name}'] for name in IdleLaneChanges._fields))
+
+    if metadata.get('incident_schedule') is not None:
+        restore_incident_schedule(road, metadata['incident_schedule'], vehicles)
+
+    return road, metadata['time']
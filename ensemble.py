@@ -0,0 +1,349 @@
+from array_road import ArrayRoad
+from lane_change_models import LaneChangeCandidates
+from scenario import load_scenario, create_road
+from vehicle import *
+import argparse
+import json
+
+import numpy as np
+
+
+class Ensemble(ArrayRoad):
+    """
+    Independent replicas of one road (e.g. a scenario with different seeds) that are advanced together, as a single
+    batch of vehicles. The accelerations, lane change decisions and position updates of all replicas are computed by
+    the same batched operations, so stepping many replicas costs far less than stepping each of them on its own.
+
+    The replicas share one ArrayRoad, in which replica r uses lanes r * replica_lanes up to (r + 1) * replica_lanes:
+    vehicles only follow vehicles in the same lane and only change to adjacent lanes of their own replica, so the
+    replicas never interact. Every replica keeps the vehicle factory and the random number generator of its road, and
+    evolves exactly like its road would on its own as an ArrayRoad (the vehicle ids are handed out across replicas).
+    The counters of the ensemble are summed over all replicas, the per-replica metrics are available as arrays.
+
+    The incident schedule of every replica is taken over as well, and applies its incidents to the lanes of its
+    replica. Detectors, space-time grids and instrumentation see the combined road and are not supported.
+
+    Args:
+        replicas: roads with the same length, number of lanes, time step and insertion parameters; their vehicles,
+                  vehicle factories and random number generators are taken over, the roads should not be used anymore
+    """
+    def __init__(self, replicas):
+        road = replicas[0]
+        parameters = ('length', 'num_lanes', 'insertion_gap', 'insertion_chance', 'time_step',
+                      'lane_change_recheck_interval')
+        for replica in replicas:
+            if any(getattr(replica, parameter) != getattr(road, parameter) for parameter in parameters):
+                raise ValueError('The replicas of an ensemble must have the same road parameters')
+
+        self.replicas = replicas
+        self.num_replicas = len(replicas)
+        self.replica_lanes = road.num_lanes
+
+        # Every replica usually has its own model objects, models with the same parameters are merged so each
+        # model is evaluated once for the vehicles of all replicas
+        shared_models = {}
+
+        def share_model(model):
+            if model is None:
+                return None
+
+            return shared_models.setdefault((model.__class__, tuple(sorted(vars(model).items()))), model)
+
+        vehicles = []
+        for r, replica in enumerate(replicas):
+            for vehicle in replica.vehicles:
+                vehicle.lane += r * self.replica_lanes
+                vehicle.traffic_model = share_model(vehicle.traffic_model)
+                vehicle.lane_change_model = share_model(vehicle.lane_change_model)
+            vehicles += replica.vehicles
+
+            vehicle_factory = replica.vehicle_factory
+            if vehicle_factory is not None:
+                vehicle_factory.default_traffic_model = share_model(vehicle_factory.default_traffic_model)
+                vehicle_factory.default_lane_change_model = share_model(vehicle_factory.default_lane_change_model)
+
+        self.removed_vehicle_counts = np.zeros(self.num_replicas, dtype=int)
+        self.inserted_vehicle_counts = np.array([replica.inserted_vehicle_count for replica in replicas])
+        self.lane_change_counts = np.zeros(self.num_replicas, dtype=int)
+
+        super().__init__(road.length, self.num_replicas * self.replica_lanes, vehicles, None, road.insertion_gap,
+                         road.insertion_chance, road.time_step, road.lane_change_recheck_interval, seed=0)
+        self.inserted_vehicle_count = int(self.inserted_vehicle_counts.sum())
+
+        # The incident schedules of the replicas, each applied to the lanes of its replica through a ReplicaLanes
+        self.replica_schedules = []
+        for r, replica in enumerate(replicas):
+            if replica.incident_schedule is not None:
+                replica.incident_schedule.road = ReplicaLanes(self, r)
+                replica.incident_schedule.road.incident_schedule = replica.incident_schedule
+                self.replica_schedules.append(replica.incident_schedule)
+
+    def update(self, time):
+        for schedule in self.replica_schedules:
+            schedule.update(time)
+
+        super().update(time)
+
+    def get_replicas(self, indices=slice(None)):
+        """Replica of each of the vehicles at the given indices"""
+        return self.lanes[indices] // self.replica_lanes
+
+    def change_lanes(self, time):
+        if self.replica_lanes <= 1:
+            return
+
+        super().change_lanes(time)
+
+    def are_adjacent_lanes(self, lanes, new_lanes):
+        return (new_lanes >= 0) & (new_lanes // self.replica_lanes == lanes // self.replica_lanes)
+
+    def find_lane_neighbours(self, state, vehicles, new_lanes):
+        # With many lanes, a search per lane is too slow. The candidates are merged into the vehicles ordered by lane
+        # and by decreasing position (the order of the vehicle list), in front of the vehicles at the same position:
+        # the vehicles before a candidate in its new lane are the ones in front of it
+        num = state.positions.size
+        lane_order = np.lexsort((np.arange(num), state.lanes))
+        lane_starts = np.searchsorted(state.lanes[lane_order], np.arange(self.num_lanes + 1))
+
+        is_vehicle = np.concatenate((np.ones(num, dtype=bool), np.zeros(vehicles.size, dtype=bool)))
+        merged = np.lexsort((is_vehicle, -np.concatenate((state.positions[lane_order], state.positions[vehicles])),
+                             np.concatenate((state.lanes[lane_order], new_lanes))))
+
+        merged_vehicles = is_vehicle[merged]
+        ranks = np.empty(vehicles.size, dtype=int)
+        ranks[merged[~merged_vehicles] - num] = (np.cumsum(merged_vehicles) - merged_vehicles)[~merged_vehicles]
+
+        lane_order = np.append(lane_order, -1)
+        has_next = ranks > lane_starts[new_lanes]
+        has_prev = ranks < lane_starts[new_lanes + 1]
+
+        return np.where(has_next, lane_order[ranks - 1], -1), np.where(has_prev, lane_order[ranks], -1)
+
+    def apply_lane_changes(self, candidates, decisions, time, stale=None):
+        # The replicas do not interact, so the lane changes are applied per replica: a lane change then only checks
+        # the later candidates of its own replica
+        stale = np.zeros(decisions.size, dtype=bool) if stale is None else stale.copy()
+        replicas = self.get_replicas(candidates.vehicles)
+        order = np.argsort(replicas, kind='stable')
+        bounds = np.searchsorted(replicas[order], np.arange(self.num_replicas + 1))
+
+        for r in np.unique(replicas[decisions | stale]).tolist():
+            selected = order[bounds[r]:bounds[r + 1]]
+            stale[selected] = super().apply_lane_changes(
+                LaneChangeCandidates(*(field[selected] for field in candidates)), decisions[selected], time,
+                stale[selected])
+
+        return stale
+
+    def change_vehicle_lane(self, index, new_lane, time):
+        self.lane_change_counts[self.lanes[index] // self.replica_lanes] += 1
+        return super().change_vehicle_lane(index, new_lane, time)
+
+    def remove_front_vehicles(self, count):
+        replicas = self.get_replicas(slice(count))
+        self.removed_vehicle_counts += np.bincount(replicas, minlength=self.num_replicas)
+
+        for r, vehicle in zip(replicas.tolist(), self._vehicles[:count]):
+            if self.replicas[r].vehicle_factory is not None:
+                self.replicas[r].vehicle_factory.release_vehicles([vehicle])
+
+        super().remove_front_vehicles(count)
+
+    def generate_new_vehicles(self, time):
+        # Index of the last vehicle in each lane, -1 for empty lanes
+        last_vehicles = np.full(self.num_lanes, -1)
+        np.maximum.at(last_vehicles, self.lanes, np.arange(self.positions.size))
+        last_vehicles = last_vehicles.tolist()
+
+        new_vehicles = []
+        for r, replica in enumerate(self.replicas):
+            vehicle_factory = replica.vehicle_factory
+            if vehicle_factory is None:
+                continue
+
+            for lane, draw in enumerate(replica.draw_random(self.replica_lanes), r * self.replica_lanes):
+                if draw > self.insertion_chance:
+                    continue
+
+                new_vehicle = vehicle_factory.create_random_vehicle()
+                new_vehicle.lane = lane
+                new_vehicle.last_lane_change_time = time
+
+                next_index = last_vehicles[lane]
+                if next_index < 0:
+                    distance = self.length
+                else:
+                    distance = self.positions[next_index] - new_vehicle.position - self.lengths[next_index]
+
+                if distance >= self.insertion_gap:
+                    new_vehicles.append(new_vehicle)
+                    self.inserted_vehicle_counts[r] += 1
+                else:
+                    vehicle_factory.release_vehicles([new_vehicle])
+
+        if new_vehicles:
+            self._insert(len(self._vehicles), new_vehicles)
+
+    def add_obstacle(self, lane, at_position):
+        """Add an obstacle to every replica"""
+        if not 0 <= lane < self.replica_lanes:
+            return
+
+        for r in range(self.num_replicas):
+            super().add_obstacle(r * self.replica_lanes + lane, at_position)
+        self.inserted_vehicle_counts += 1
+
+    def remove_obstacle(self, lane, at_position):
+        """Remove an obstacle from every replica"""
+        if not 0 <= lane < self.replica_lanes:
+            return
+
+        for r in range(self.num_replicas):
+            super().remove_obstacle(r * self.replica_lanes + lane, at_position)
+
+    def vehicle_counts(self):
+        """Number of vehicles (without obstacles) on each replica"""
+        return np.bincount(self.get_replicas(~self.obstacles), minlength=self.num_replicas)
+
+    def vehicle_densities(self):
+        """Number of vehicles per meter of road on each replica"""
+        return self.vehicle_counts() / self.length
+
+    def mean_speeds(self):
+        """Mean velocity of the vehicles on each replica [m/s], nan for replicas without vehicles"""
+        moving = ~self.obstacles
+        speed_sums = np.bincount(self.get_replicas(moving), weights=self.velocities[moving],
+                                 minlength=self.num_replicas)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return speed_sums / self.vehicle_counts()
+
+    def get_traffic_flows(self, at_position, current_time):
+        """Traffic flow at a position on each replica [vehicles/hour], see Road.get_traffic_flow"""
+        if not 0 <= at_position <= self.length:
+            return np.full(self.num_replicas, -1)
+
+        passed = ~self.obstacles & (self.positions > at_position)
+        vehicles_passed_point = (np.bincount(self.get_replicas(passed), minlength=self.num_replicas)
+                                 + self.removed_vehicle_counts)
+
+        return vehicles_passed_point / (current_time / 3600)
+
+
+class ReplicaLanes:
+    """
+    The lanes of one replica of an ensemble, on which the IncidentSchedule of the replica adds and removes its
+    obstacles and moving bottlenecks, in the lanes of the replica (starting at 0) like on the road of the replica.
+
+    Args:
+        ensemble: the Ensemble
+        replica: index of the replica
+    """
+    def __init__(self, ensemble, replica):
+        self.ensemble = ensemble
+        self.replica = replica
+        self.num_lanes = ensemble.replica_lanes
+        self.lane_offset = replica * ensemble.replica_lanes
+        self.incident_schedule = None
+
+    def add_obstacle(self, lane, at_position):
+        if not 0 <= lane < self.num_lanes:
+            return
+
+        ArrayRoad.add_obstacle(self.ensemble, self.lane_offset + lane, at_position)
+        self.ensemble.inserted_vehicle_counts[self.replica] += 1
+
+    def remove_obstacle(self, lane, at_position):
+        if 0 <= lane < self.num_lanes:
+            ArrayRoad.remove_obstacle(self.ensemble, self.lane_offset + lane, at_position)
+
+    def add_vehicle(self, vehicle):
+        vehicle.lane += self.lane_offset
+        self.ensemble.add_vehicle(vehicle)
+        self.ensemble.inserted_vehicle_counts[self.replica] += 1
+
+    def remove_vehicle(self, vehicle):
+        self.ensemble.remove_vehicle(vehicle)
+
+
+"""
+    Simulates replicas of a scenario with different seeds as an Ensemble, sampling the density and speed of every
+    replica like sweep.run_scenario does.
+
+    Args:
+        scenario: scenario as returned by load_scenario, its seed is replaced by the seeds of the replicas
+        seeds: seed of each replica
+        warmup: time [s] before the density and speed are sampled
+        sample_interval: time [s] between two samples of the density and speed
+        measure_position: position at which the traffic flow is measured [m], the middle of the road if None
+
+    Returns:
+        List with a dict of metrics for each replica:
+            seed: seed of the replica
+            flow: traffic flow at the measure position at the end of the run [vehicles/hour]
+            density: mean number of vehicles per meter of road
+            mean_speed: mean velocity of the vehicles on the road [m/s]
+            vehicle_count, removed_vehicle_count: vehicles on the road at the end and vehicles that left the road
+            lane_change_count: number of lane changes
+"""
+def run_ensemble(scenario, seeds, warmup=0, sample_interval=10, measure_position=None):
+    ensemble = Ensemble([create_road(dict(scenario, seed=seed)) for seed in seeds])
+    time_step = ensemble.time_step
+
+    if measure_position is None:
+        measure_position = ensemble.length / 2
+
+    densities = []
+    speeds = []
+    next_sample_time = warmup
+
+    time = 0
+    for time in np.arange(0, scenario['duration'], time_step):
+        ensemble.update(time)
+
+        if time >= next_sample_time:
+            next_sample_time += sample_interval
+            densities.append(ensemble.vehicle_densities())
+            speeds.append(ensemble.mean_speeds())
+
+    densities = np.array(densities).reshape(-1, ensemble.num_replicas)
+    speeds = np.array(speeds).reshape(-1, ensemble.num_replicas)
+    sampled_speeds = ~np.isnan(speeds)
+    speed_sums = np.where(sampled_speeds, speeds, 0).sum(axis=0)
+    speed_counts = sampled_speeds.sum(axis=0)
+
+    flows = ensemble.get_traffic_flows(measure_position, time + time_step)
+    return [{
+        'seed': seed,
+        'flow': float(flows[r]),
+        'density': float(densities[:, r].mean()) if densities.size else 0,
+        'mean_speed': float(speed_sums[r] / speed_counts[r]) if speed_counts[r] else 0,
+        'vehicle_count': int(ensemble.vehicle_counts()[r]),
+        'removed_vehicle_count': int(ensemble.removed_vehicle_counts[r]),
+        'lane_change_count': int(ensemble.lane_change_counts[r]),
+    } for r, seed in enumerate(seeds)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate many replicas of a scenario as a single batched ensemble.')
+    parser.add_argument('scenario', nargs='?', default=None,
+                        help='JSON scenario file, see scenario.DEFAULT_SCENARIO (the braking scenario if omitted)')
+    parser.add_argument('--replicas', type=int, default=100, help='number of replicas, with seeds 0 to REPLICAS - 1')
+    parser.add_argument('--warmup', type=float, default=0, help='time [s] before the density and speed are sampled')
+    parser.add_argument('--output', default='ensemble.json',
+                        help='JSON file the metrics of the replicas are written to')
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+    metrics = run_ensemble(scenario, list(range(args.replicas)), warmup=args.warmup)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(metrics, output_file, indent=2)
+
+    flows = np.array([replica_metrics['flow'] for replica_metrics in metrics])
+    print(f'Simulated {args.replicas} replicas of {scenario["duration"]} s, flow {flows.mean():.1f} '
+          f'+/- {flows.std(ddof=1) if flows.size > 1 else 0:.1f} vehicles/hour, metrics are in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+from road import Road
+from array_road import ArrayRoad
+from vehicle_factory import VEHICLE_CLASSES, VEHICLE_TYPES
+from vehicle import *
+
+import numpy as np
+
+
+# Columns of each kind of event in the saved log, every kind also has a times column
+EVENT_COLUMNS = {
+    'insertions': (('ids', np.int64), ('types', np.int64), ('lanes', np.int64)),
+    'lane_changes': (('ids', np.int64), ('lanes', np.int64)),
+    'obstacles': (('ids', np.int64), ('lanes', np.int64), ('positions', np.float64), ('added', bool)),
+}
+
+VEHICLE_TYPE_INDICES = {VEHICLE_CLASSES[vehicle_type]: i for i, vehicle_type in enumerate(VEHICLE_TYPES)}
+
+
+class EventLog:
+    """
+    Log of the decisions that make a run of a road unique: the vehicles that were inserted (their vehicle type, lane
+    and id), the lane changes that were accepted and the obstacles that were added and removed, each with the time of
+    the update they belong to. Everything else follows deterministically from the state of the road, so the log is
+    enough to reproduce a run exactly.
+
+    Creating an EventLog attaches it to the road. A recording log collects the events while the road is updated, and
+    save writes them to a compact binary file (an uncompressed .npz file with a column per field).
+
+    A replaying log (created with replay set to a saved log) makes the road take the decisions from the log instead:
+    the vehicles are inserted without drawing random numbers, the lane changes are applied without evaluating the
+    lane change models and the obstacles are edited at the logged times. The road then follows the recorded run in
+    a fraction of the time, and the replay can start from a checkpoint of that run (see checkpoint.py), as the events
+    before the time of the first update are skipped. The road still needs its vehicle factory to create the vehicles.
+
+    Obstacle edits made between two updates belong to the next update, and the edits of an IncidentSchedule are
+    logged like any other. A replaying road does not run its incident schedule, as its obstacles are in the log, but
+    the moving bottlenecks of incidents are vehicles that are not logged, so runs with moving bottlenecks cannot be
+    replayed. Past the end of the log no more vehicles are inserted and no lanes are changed.
+
+    Only Road and ArrayRoad are supported. A replay has to start from the state of the recorded run, e.g. the same
+    initial road (with the same vehicle ids) or a checkpoint, on a road of the same class.
+
+    Args:
+        road: road to record or to replay
+        replay: path of a saved log or a recording EventLog to replay, None to record
+    """
+    def __init__(self, road, replay=None):
+        if type(road) not in (Road, ArrayRoad):
+            raise ValueError(f'Event logs are only supported for Road and ArrayRoad, not {road.__class__.__name__}')
+
+        self.road = road
+        self.replaying = replay is not None
+
+        # Recorded events as lists of rows (time first), and obstacle edits that wait for the next update
+        self.events = {kind: [] for kind in EVENT_COLUMNS}
+        self.pending_obstacles = []
+
+        # Columns of the events to replay, and the index of the next event of each kind
+        self.columns = None
+        self.positions = None
+        if self.replaying:
+            self.columns = replay.arrays() if isinstance(replay, EventLog) else self.load(replay)
+
+        road.event_log = self
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as event_log:
+            return {name: event_log[name] for name in event_log.files}
+
+    def arrays(self):
+        """Columns of the recorded events, named <kind>_<column>"""
+        arrays = {}
+        for kind, columns in EVENT_COLUMNS.items():
+            rows = self.events[kind]
+            arrays[f'{kind}_times'] = np.array([row[0] for row in rows], dtype=np.float64)
+            for i, (column, dtype) in enumerate(columns, 1):
+                arrays[f'{kind}_{column}'] = np.array([row[i] for row in rows], dtype=dtype)
+
+        return arrays
+
+    def save(self, path):
+        with open(path, 'wb') as event_log_file:
+            np.savez(event_log_file, **self.arrays())
+
+    def record_insertion(self, time, vehicle):
+        if not self.replaying:
+            self.events['insertions'].append((time, vehicle.vehicle_id, VEHICLE_TYPE_INDICES[type(vehicle)],
+                                              vehicle.lane))
+
+    def record_lane_change(self, time, vehicle, new_lane):
+        if not self.replaying:
+            self.events['lane_changes'].append((time, vehicle.vehicle_id, new_lane))
+
+    """
+        Args:
+            lane, position: lane and position of the obstacle [m]
+            obstacle: the added Obstacle, None for a removal
+    """
+    def record_obstacle(self, lane, position, obstacle=None):
+        if not self.replaying:
+            self.pending_obstacles.append((-1 if obstacle is None else obstacle.vehicle_id, lane, position,
+                                           obstacle is not None))
+
+    """
+        Called by the road at the start of an update: assigns the obstacle edits since the last update to this one, or
+        applies the logged obstacle edits of this update when replaying.
+
+        Args:
+            time: current time elapsed in the simulation
+    """
+    def begin_step(self, time):
+        if not self.replaying:
+            self.events['obstacles'] += [(time,) + edit for edit in self.pending_obstacles]
+            self.pending_obstacles = []
+            return
+
+        if self.positions is None:
+            # Events before the first replayed update (e.g. before a checkpoint) already happened
+            self.positions = {kind: self.find_step_end(kind, time - self.road.time_step) for kind in EVENT_COLUMNS}
+
+        for obstacle_id, lane, position, added in self.replay_events('obstacles', time):
+            if not added:
+                self.road.remove_obstacle(lane, position)
+                continue
+
+            obstacle = Obstacle()
+            obstacle.vehicle_id = obstacle_id
+            obstacle.lane = lane
+            obstacle.position = position
+            self.road.add_vehicle(obstacle)
+
+    def find_step_end(self, kind, time):
+        """Index of the first event of the given kind after the update at the given time"""
+        # The times of the replayed updates may differ slightly from the recorded ones, e.g. when they are computed
+        # differently after restoring a checkpoint, so the events are matched to the nearest update
+        return int(np.searchsorted(self.columns[f'{kind}_times'], time + self.road.time_step / 2, side='left'))
+
+    def replay_events(self, kind, time):
+        """Rows with the columns (without the time) of the logged events of the given kind at the given update"""
+        start = self.positions[kind]
+        end = max(self.find_step_end(kind, time), start)
+        self.positions[kind] = end
+
+        return list(zip(*(self.columns[f'{kind}_{column}'][start:end].tolist() for column, _ in EVENT_COLUMNS[kind])))
+
+    """
+        Args:
+            time: current time elapsed in the simulation
+            vehicle_factory: factory that creates the vehicles
+
+        Returns:
+            List of the vehicles that were inserted at the update at the given time, with their logged ids and lanes
+    """
+    def replay_insertions(self, time, vehicle_factory):
+        new_vehicles = []
+        for vehicle_id, type_index, lane in self.replay_events('insertions', time):
+            new_vehicle = vehicle_factory.create_vehicle(VEHICLE_TYPES[type_index])
+            new_vehicle.vehicle_id = vehicle_id
+            new_vehicle.lane = lane
+            new_vehicle.last_lane_change_time = time
+            new_vehicles.append(new_vehicle)
+
+        return new_vehicles
+
+    def replay_lane_changes(self, time):
+        """List of the (vehicle id, new lane) of the lane changes that were accepted at the update at the given time,
+        in the order in which they were applied"""
+        return self.replay_events('lane_changes', time)
+
+    def close(self):
+        """Detach the log from the road, a recording log can still be saved"""
+        if self.road.event_log is self:
+            self.road.event_log = None
@@ -0,0 +1,424 @@
+from road import Road
+from macroscopic import CellTransmissionModel, measure_fundamental_diagram
+from lane_change_models import MOBIL
+from vehicle_factory import VehicleFactory
+from scenario import TRAFFIC_MODELS, ROADS, spawn_seeds
+from vehicle import *
+import argparse
+import sys
+
+import numpy as np
+
+
+# Demand of the window throughput check, as a fraction of the capacity of the road
+DEFAULT_THROUGHPUT_DEMAND = 0.7
+# Fraction of the demand a window has to carry to pass the window throughput check
+THROUGHPUT_TOLERANCE = 0.95
+
+
+class HybridRoad:
+    """
+    Road of which only some windows are simulated microscopically, with Vehicles and their traffic and lane change
+    models, while the stretches around them are simulated macroscopically with a CellTransmissionModel. The cost of a
+    time step grows with the number of vehicles in the windows and the number of cells, not with the length of the
+    road, which makes it suitable for corridor studies that only need vehicles near the area of interest.
+
+    At the upstream edge of a window, the flow out of the last cell in front of it is accumulated, and every whole
+    vehicle is created by the vehicle factory and inserted in the lane where the gap at the start of the window exceeds
+    the gap it needs the most. It needs the gap that vehicles keep at the velocity of the last vehicle in the lane in
+    congested traffic (see get_required_gaps), and follows that vehicle at its velocity, so behind a standing vehicle
+    it enters at jam spacing and a queue in front of the window discharges into it as fast as the vehicles accelerate.
+    It enters at the position it reached since it crossed the edge during the time step, so the vehicles keep the
+    spacing of the macroscopic flow instead of the spacing of the time steps. When no lane has room for a vehicle, the
+    cell cannot send vehicles and the macroscopic traffic backs up in front of the window.
+    At the downstream edge, the vehicles that leave a window are added to the first cell behind it. While that cell is
+    congested, its supply is accumulated over the time steps, and while it is used up the end of the window is closed
+    with an obstacle in every lane, so congestion in the macroscopic stretch spills back into the window.
+
+    The windows are Roads (or ArrayRoads) of their own, the positions of their vehicles are relative to the start of
+    the window.
+
+    Args:
+        length: length of the road [m]
+        num_lanes: number of lanes the road has
+        windows: list of (start, end) positions of the microscopic windows [m], overlapping or touching windows are
+                 merged, and the stretches between them have to be at least one cell long
+        vehicles: list of vehicles on the road at the start, the vehicles in a window are placed on it (and linked to
+                  their neighbours), the others are added to the counts of the cells they are in
+        vehicle_factory: object used to create the vehicles at the upstream edges of the windows
+        inflow: whether vehicles enter the road at its start, through the vehicle factory of the first window or, if
+                the road starts with a macroscopic stretch, with a demand of insertion_chance vehicles per lane per step
+        fundamental_diagram: FundamentalDiagram of the macroscopic stretches, measured with the vehicles of the vehicle
+                             factory if None (see measure_fundamental_diagram)
+        cell_length: approximate length of the cells of the macroscopic stretches [m]
+        window_type: class of the roads of the windows, Road or ArrayRoad
+        insertion_gap, insertion_chance, time_step, seed: see Road
+        road_parameters: other arguments for the roads of the windows
+    """
+    def __init__(self, length, num_lanes=Road.DEFAULT_NUM_LANES, windows=(), vehicles=None, vehicle_factory=None,
+                 inflow=True, fundamental_diagram=None, cell_length=CellTransmissionModel.DEFAULT_CELL_LENGTH,
+                 window_type=Road, insertion_gap=Road.DEFAULT_INSERTION_GAP,
+                 insertion_chance=Road.DEFAULT_INSERTION_CHANCE, time_step=Road.DEFAULT_TIME_STEP, seed=None,
+                 **road_parameters):
+        if vehicle_factory is None:
+            raise ValueError('A hybrid road needs a vehicle factory to create the vehicles that enter its windows')
+
+        self.length = length
+        self.num_lanes = num_lanes
+        self.vehicle_factory = vehicle_factory
+        self.inflow = inflow
+        self.insertion_gap = insertion_gap
+        self.insertion_chance = insertion_chance
+        self.time_step = time_step
+        # Gap [m] between standing vehicles, the smallest gap at which a vehicle enters a window
+        self.jam_gap = getattr(vehicle_factory.default_traffic_model, 'MINIMUM_GAP', insertion_gap)
+
+        if fundamental_diagram is None:
+            fundamental_diagram = measure_fundamental_diagram(vehicle_factory, time_step)
+        self.fundamental_diagram = fundamental_diagram
+        # Time gap [s] between the vehicles in congested traffic, from the congested branch of the fundamental diagram
+        self.congested_headway = max(1 / fundamental_diagram.capacity
+                                     - 1 / (fundamental_diagram.free_flow_speed * fundamental_diagram.jam_density), 0)
+
+        windows = self.merge_windows(windows)
+        window_seeds = np.random.SeedSequence(seed).spawn(len(windows)) if seed is not None else [None] * len(windows)
+
+        # Sections of the road in order, each a CellTransmissionModel or a window road, with their start positions
+        self.sections = []
+        self.section_starts = []
+        position = 0
+        for (start, end), window_seed in zip(windows, window_seeds):
+            if start > position:
+                self.add_stretch(position, start, cell_length)
+
+            window_factory = vehicle_factory if inflow and start == 0 else None
+            self.section_starts.append(start)
+            self.sections.append(window_type(end - start, num_lanes=num_lanes, vehicle_factory=window_factory,
+                                             insertion_gap=insertion_gap, insertion_chance=insertion_chance,
+                                             time_step=time_step, seed=window_seed, **road_parameters))
+            position = end
+
+        if position < length:
+            self.add_stretch(position, length, cell_length)
+
+        num_sections = len(self.sections)
+        # Whole and fractional vehicles that wait to enter each window, and the number that joined them this time step
+        self.pending_counts = np.zeros(num_sections)
+        self.entry_counts = np.zeros(num_sections)
+        # Number of vehicles the stretch behind each window can still receive (negative when more vehicles left the
+        # window in a time step than it could receive), and whether the window is closed for it
+        self.exit_credits = np.full(num_sections, float(num_lanes))
+        self.closed = np.zeros(num_sections, dtype=bool)
+        # Number of vehicles that had left each window at the previous time step
+        self.exit_counts = np.zeros(num_sections, dtype=int)
+
+        # Vehicles that left the road at its end, fractional if the road ends with a macroscopic stretch
+        self.removed_vehicle_count = 0
+
+        # Optional IncidentSchedule that starts and ends incidents while the road is updated, see incidents.py
+        self.incident_schedule = None
+
+        for vehicle in [] if vehicles is None else vehicles:
+            self.add_vehicle(vehicle)
+
+    @staticmethod
+    def merge_windows(windows):
+        """Sorted windows, with overlapping or touching windows merged into one"""
+        merged = []
+        for start, end in sorted(windows):
+            if start >= end:
+                raise ValueError(f'Empty window: ({start}, {end})')
+
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+
+        return merged
+
+    def add_stretch(self, start, end, cell_length):
+        self.section_starts.append(start)
+        self.sections.append(CellTransmissionModel(end - start, self.num_lanes, self.fundamental_diagram,
+                                                   self.time_step, cell_length))
+
+    @property
+    def windows(self):
+        """List of the roads of the microscopic windows"""
+        return [section for section in self.sections if not isinstance(section, CellTransmissionModel)]
+
+    def update(self, time):
+        if self.incident_schedule is not None:
+            self.incident_schedule.update(time)
+
+        sections = self.sections
+        last = len(sections) - 1
+
+        # The flows across the edges of the stretches are determined from the state before the update, the vehicles
+        # that flow into a window are inserted before it is updated
+        for i, stretch in enumerate(sections):
+            if not isinstance(stretch, CellTransmissionModel):
+                continue
+
+            inflow = 0
+            if i == 0 and self.inflow:
+                inflow = min(self.insertion_chance * self.num_lanes, stretch.supply())
+
+            outflow = stretch.demand()
+            if i < last:
+                # A vehicle only needs room in a lane once it has crossed the edge completely, so one more vehicle
+                # than there are lanes with room can be on its way
+                gaps, _ = sections[i + 1].get_entry_gaps()
+                outflow = min(outflow, max(np.count_nonzero(gaps >= self.jam_gap) + 1 - self.pending_counts[i + 1],
+                                           0))
+                self.pending_counts[i + 1] += outflow
+                self.entry_counts[i + 1] = outflow
+            else:
+                self.removed_vehicle_count += outflow
+
+            stretch.update(inflow, outflow)
+
+        for i, window in enumerate(sections):
+            if isinstance(window, CellTransmissionModel):
+                continue
+
+            if self.pending_counts[i] >= 1:
+                self.insert_vehicles(i, time)
+
+            if i < last:
+                self.update_exit(i)
+
+            window.update(time)
+
+            exit_count = window.removed_vehicle_count - self.exit_counts[i]
+            self.exit_counts[i] = window.removed_vehicle_count
+            if i < last:
+                sections[i + 1].counts[0] += exit_count
+                self.exit_credits[i] -= exit_count
+            else:
+                self.removed_vehicle_count += exit_count
+
+    """
+        Turns the whole vehicles that wait to enter a window into vehicles of the vehicle factory.
+
+        Args:
+            i: index of the window in the sections
+            time: current time elapsed in the simulation
+    """
+    def insert_vehicles(self, i, time):
+        window = self.sections[i]
+        gaps, velocities = window.get_entry_gaps()
+        while self.pending_counts[i] >= 1:
+            # The lane where the gap exceeds the gap a vehicle needs the most
+            required_gaps = self.get_required_gaps(velocities)
+            lane = int(np.argmax(gaps - required_gaps))
+            if gaps[lane] < required_gaps[lane]:
+                break
+
+            vehicle = self.vehicle_factory.create_random_vehicle()
+            vehicle.lane = lane
+            vehicle.last_lane_change_time = time
+
+            # The pending vehicles beyond this one joined later, so this one crossed the edge that part of the time
+            # step ago (the part is 0 for vehicles that waited for a gap)
+            crossed = 0
+            if self.entry_counts[i] > 0:
+                crossed = min((self.pending_counts[i] - 1) / self.entry_counts[i], 1)
+            vehicle.velocity = min(vehicle.desired_velocity, velocities[lane])
+            vehicle.position = min(vehicle.velocity * crossed * self.time_step, gaps[lane] - required_gaps[lane])
+
+            window.add_vehicle(vehicle)
+            gaps[lane] = vehicle.position - vehicle.length
+            velocities[lane] = vehicle.velocity
+            self.pending_counts[i] -= 1
+
+    def get_required_gaps(self, leader_velocities):
+        """Gaps [m] a vehicle needs to enter a window behind leaders with the given velocities (inf if there is none):
+        the jam gap plus the congested time headway at the velocity of the leader"""
+        return self.jam_gap + self.congested_headway * np.minimum(leader_velocities,
+                                                                  self.fundamental_diagram.free_flow_speed)
+
+    def update_exit(self, i):
+        """Close the end of a window with obstacles while the stretch behind it cannot receive vehicles, and open it
+        again when it can"""
+        window = self.sections[i]
+        stretch = self.sections[i + 1]
+        if stretch.counts[0] <= stretch.critical_count:
+            # A cell in free flow takes the vehicles that leave the window together in a time step, even if there are
+            # more of them than its supply
+            self.exit_credits[i] = self.num_lanes
+        else:
+            self.exit_credits[i] = min(self.exit_credits[i] + stretch.supply(), self.num_lanes)
+
+        closed = self.exit_credits[i] < 0
+        if closed == self.closed[i]:
+            return
+
+        self.closed[i] = closed
+        for lane in range(self.num_lanes):
+            if closed:
+                window.add_obstacle(lane, window.length)
+            else:
+                window.remove_obstacle(lane, window.length)
+
+    def find_section(self, position):
+        """Index of the section a position on the road is in"""
+        return max(int(np.searchsorted(self.section_starts, position, side='right')) - 1, 0)
+
+    def add_vehicle(self, vehicle):
+        """Add a vehicle at its position on the road, to the window it is in (relative to the start of the window) or
+        to the count of its cell"""
+        i = self.find_section(vehicle.position)
+        section = self.sections[i]
+        position = vehicle.position - self.section_starts[i]
+        if isinstance(section, CellTransmissionModel):
+            section.add_vehicles(position)
+            return
+
+        vehicle.position = position
+        vehicle.next_vehicle = None
+        vehicle.prev_vehicle = None
+        section.add_vehicle(vehicle)
+
+    def remove_vehicle(self, vehicle):
+        """Remove a vehicle from the window it is in, if it is still on the road"""
+        for window in self.windows:
+            window.remove_vehicle(vehicle)
+
+    def add_obstacle(self, lane, at_position):
+        i = self.find_section(at_position)
+        if isinstance(self.sections[i], CellTransmissionModel):
+            raise ValueError(f'Obstacles can only be placed in a window, not at {at_position} m')
+
+        self.sections[i].add_obstacle(lane, at_position - self.section_starts[i])
+
+    def remove_obstacle(self, lane, at_position):
+        i = self.find_section(at_position)
+        if not isinstance(self.sections[i], CellTransmissionModel):
+            self.sections[i].remove_obstacle(lane, at_position - self.section_starts[i])
+
+    def section_vehicle_count(self, i, at_position=-math.inf):
+        """Number of vehicles in a section, ahead of a position relative to its start"""
+        section = self.sections[i]
+        if isinstance(section, CellTransmissionModel):
+            return section.count_ahead(max(at_position, 0))
+
+        return sum(vehicle.position > at_position for vehicle in section.vehicles if not isinstance(vehicle, Obstacle))
+
+    def vehicle_count(self):
+        return sum(self.section_vehicle_count(i) for i in range(len(self.sections)))
+
+    def vehicle_density(self):
+        return self.vehicle_count() / self.length
+
+    """
+        Args:
+            at_position: position at which to measure the traffic flow [m]
+            current_time: current time elapsed in the simulation
+
+        Returns:
+            The traffic flow [vehicles/hour], see Road.get_traffic_flow
+    """
+    def get_traffic_flow(self, at_position, current_time):
+        if not 0 <= at_position <= self.length:
+            return -1
+
+        i = self.find_section(at_position)
+        vehicles_passed_point = (self.section_vehicle_count(i, at_position - self.section_starts[i])
+                                 + sum(self.section_vehicle_count(j) for j in range(i + 1, len(self.sections)))
+                                 + self.removed_vehicle_count)
+
+        return vehicles_passed_point / (current_time / 3600)
+
+    def macroscopic_densities(self):
+        """Positions of the centres of the cells of the macroscopic stretches on the road [m], and their densities
+        [vehicles/m/lane]"""
+        stretches = [(start, section) for start, section in zip(self.section_starts, self.sections)
+                     if isinstance(section, CellTransmissionModel)]
+        if not stretches:
+            return np.zeros(0), np.zeros(0)
+
+        return (np.concatenate([start + stretch.cell_positions() for start, stretch in stretches]),
+                np.concatenate([stretch.densities() for _, stretch in stretches]))
+
+
+"""
+    Measures the throughput of a window of a hybrid road under a constant demand, to check that the vehicles enter a
+    window as fast as the macroscopic stretch in front of it sends them. The road starts with a macroscopic stretch, so
+    all vehicles enter the window at its upstream edge. The window is blocked in all lanes during the blockage, after
+    which the queue in front of it has to discharge into it.
+
+    Args:
+        vehicle_factory: object used to create the vehicles that enter the window
+        demand: demand at the start of the road, as a fraction of its capacity
+        length: length of the road [m]
+        num_lanes: number of lanes the road has
+        window: (start, end) position of the window [m]
+        blockage: (start, end) time [s] during which the window is blocked in the middle, None to not block it
+        duration: simulated time [s]
+        warmup: time [s] before the vehicles that leave the window are counted
+        window_type: class of the road of the window, Road or ArrayRoad
+        time_step: time step of the simulation [s]
+        seed: seed of the random number generator of the road
+
+    Returns:
+        The demand and the throughput of the window [vehicles/s]
+"""
+def measure_window_throughput(vehicle_factory, demand=DEFAULT_THROUGHPUT_DEMAND, length=5000,
+                              num_lanes=3, window=(2000, 3000), blockage=None, duration=1500,
+                              warmup=500, window_type=Road, time_step=Road.DEFAULT_TIME_STEP, seed=0):
+    fundamental_diagram = measure_fundamental_diagram(vehicle_factory, time_step)
+    insertion_chance = demand * fundamental_diagram.capacity * time_step
+    road = HybridRoad(length, num_lanes, windows=[window], vehicle_factory=vehicle_factory,
+                      fundamental_diagram=fundamental_diagram, window_type=window_type,
+                      insertion_chance=insertion_chance, time_step=time_step, seed=seed)
+    blockage_position = (window[0] + window[1]) / 2
+
+    removed_count = 0
+    for time in np.arange(0, duration, time_step):
+        if blockage is not None and time == blockage[0]:
+            for lane in range(num_lanes):
+                road.add_obstacle(lane, blockage_position)
+        if blockage is not None and time == blockage[1]:
+            for lane in range(num_lanes):
+                road.remove_obstacle(lane, blockage_position)
+
+        road.update(time)
+
+        if time < warmup:
+            removed_count = road.windows[0].removed_vehicle_count
+
+    throughput = (road.windows[0].removed_vehicle_count - removed_count) / (duration - warmup)
+    return insertion_chance * num_lanes / time_step, throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a window of a hybrid road carries a demand below its '
+                                                 'capacity.')
+    parser.add_argument('--demand', type=float, default=DEFAULT_THROUGHPUT_DEMAND,
+                        help='demand as a fraction of the capacity of the road')
+    parser.add_argument('--traffic-model', default='Gipps', choices=sorted(TRAFFIC_MODELS))
+    parser.add_argument('--lane-changes', action='store_true', help='let the vehicles change lanes with MOBIL')
+    parser.add_argument('--weights', type=float, nargs=4, default=[1, 0, 0, 0],
+                        help='weights of Cars, Trucks, AggressiveCars and PassiveCars')
+    parser.add_argument('--window-type', default='Road', choices=sorted(ROADS))
+    parser.add_argument('--blockage', type=float, nargs=2, default=[200, 320], metavar=('START', 'END'),
+                        help='time [s] during which the window is blocked')
+    parser.add_argument('--duration', type=float, default=1500, help='simulated time [s]')
+    parser.add_argument('--warmup', type=float, default=500, help='time [s] before the throughput is measured')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    _, factory_seed = spawn_seeds(args.seed)
+    vehicle_factory = VehicleFactory(args.weights, TRAFFIC_MODELS[args.traffic_model](Road.DEFAULT_TIME_STEP),
+                                     MOBIL() if args.lane_changes else None, seed=factory_seed)
+    demand, throughput = measure_window_throughput(vehicle_factory, args.demand, blockage=args.blockage,
+                                                   duration=args.duration, warmup=args.warmup,
+                                                   window_type=ROADS[args.window_type], seed=args.seed)
+
+    print(f'The window carries {throughput:.3f} of a demand of {demand:.3f} vehicles/s')
+    if throughput < THROUGHPUT_TOLERANCE * demand:
+        sys.exit(f'The throughput of the window is below {THROUGHPUT_TOLERANCE:.0%} of the demand')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+from vehicle import *
+from collections import namedtuple
+import heapq
+
+
+"""
+Incident is a disruption of the traffic on a road between a start and an end time:
+    kind: 'obstacle' (an obstacle in each of the lanes), 'lane_closure' (the same, for closing lanes from a position
+          onwards) or 'moving_bottleneck' (a MovingBottleneck that drives in the lane at a constant velocity)
+    lanes: tuple with the lanes of the incident
+    position: position of the obstacles, or the position at which the moving bottleneck enters the road [m]
+    velocity: velocity of the moving bottleneck [m/s], 0 for the other kinds
+    start_time, end_time: time at which the incident starts and ends [s], inf if it never ends
+"""
+Incident = namedtuple('Incident', ['kind', 'lanes', 'position', 'velocity', 'start_time', 'end_time'])
+
+
+class IncidentSchedule:
+    """
+    Timed incidents that a road applies while it is updated. Creating an IncidentSchedule attaches it to the road,
+    after which every call to road.update first starts and ends the incidents that are due at the current time.
+
+    The starts and ends of the incidents are kept in a heap ordered by time, so a step without due incidents only
+    looks at the first entry. Obstacles and moving bottlenecks are added and removed with a binary search on the road,
+    which only updates the links of their neighbours, so many scheduled incidents do not slow down the updates.
+
+    Args:
+        road: road to apply the incidents to
+        incidents: optional list of incident descriptions, see add_incident
+    """
+    KINDS = ('obstacle', 'lane_closure', 'moving_bottleneck')
+
+    def __init__(self, road, incidents=()):
+        self.road = road
+
+        # Heap of (time, sequence number, whether the incident starts, incident, sequence number of its start), the
+        # sequence number keeps the order of events at the same time
+        self.events = []
+        self.sequence = count()
+        # Moving bottlenecks of the incidents in progress, by the sequence number of their start
+        self.bottlenecks = {}
+
+        for incident in incidents:
+            self.add_incident(incident)
+
+        road.incident_schedule = self
+
+    """
+        Args:
+            description: dict with the kind (see KINDS) of the incident, its lane or lanes, its position, its start
+                         and end time (optional) and, for moving bottlenecks, its velocity, e.g.
+                         {'kind': 'obstacle', 'lane': 0, 'position': 5000, 'start_time': 60, 'end_time': 300}
+
+        Returns:
+            The scheduled Incident
+    """
+    def add_incident(self, description):
+        description = dict(description)
+        kind = description.pop('kind')
+        if kind not in self.KINDS:
+            raise ValueError(f'Unknown incident kind: {kind}')
+
+        lanes = description.pop('lanes', None)
+        if lanes is None:
+            lanes = [description.pop('lane')]
+
+        return self.schedule(Incident(kind, tuple(lanes), description['position'], description.get('velocity', 0),
+                                      description.get('start_time', 0), description.get('end_time', math.inf)))
+
+    def add_obstacle(self, lane, position, start_time=0, end_time=math.inf):
+        return self.schedule(Incident('obstacle', (lane,), position, 0, start_time, end_time))
+
+    def add_lane_closure(self, lanes, position, start_time=0, end_time=math.inf):
+        return self.schedule(Incident('lane_closure', tuple(lanes), position, 0, start_time, end_time))
+
+    def add_moving_bottleneck(self, lane, position, velocity, start_time=0, end_time=math.inf):
+        return self.schedule(Incident('moving_bottleneck', (lane,), position, velocity, start_time, end_time))
+
+    def schedule(self, incident):
+        start = next(self.sequence)
+        heapq.heappush(self.events, (incident.start_time, start, True, incident, start))
+        if incident.end_time < math.inf:
+            heapq.heappush(self.events, (incident.end_time, next(self.sequence), False, incident, start))
+
+        return incident
+
+    """
+        Starts and ends the incidents that are due.
+
+        Args:
+            time: current time elapsed in the simulation
+    """
+    def update(self, time):
+        while self.events and self.events[0][0] <= time:
+            _, _, starts, incident, start = heapq.heappop(self.events)
+            if starts:
+                self.start_incident(incident, start)
+            else:
+                self.end_incident(incident, start)
+
+    def start_incident(self, incident, start):
+        if incident.kind != 'moving_bottleneck':
+            for lane in incident.lanes:
+                self.road.add_obstacle(lane, incident.position)
+            return
+
+        bottlenecks = []
+        for lane in incident.lanes:
+            if 0 <= lane < self.road.num_lanes:
+                bottleneck = MovingBottleneck(incident.position, incident.velocity, lane=lane)
+                self.road.add_vehicle(bottleneck)
+                bottlenecks.append(bottleneck)
+
+        self.bottlenecks[start] = bottlenecks
+
+    def end_incident(self, incident, start):
+        if incident.kind != 'moving_bottleneck':
+            for lane in incident.lanes:
+                self.road.remove_obstacle(lane, incident.position)
+            return
+
+        # A moving bottleneck that already left the road is not removed again
+        for bottleneck in self.bottlenecks.pop(start, []):
+            self.road.remove_vehicle(bottleneck)
+
+    def close(self):
+        """Detach the schedule from the road, the incidents in progress stay on the road"""
+        if self.road.incident_schedule is self:
+            self.road.incident_schedule = None
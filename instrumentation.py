@@ -0,0 +1,184 @@
+import cProfile
+import json
+import logging
+import time as timer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Instrumentation:
+    """
+    Opt-in instrumentation of the update of a road. Creating an Instrumentation attaches it to the road, after which
+    every call to road.update records the wall time of each phase (and of sort_vehicles, which is called from within the
+    other phases), the number of times each phase was called and the change of the road's counters. A road without
+    instrumentation only pays for a single attribute check per update.
+
+    The recorded metrics are available through snapshot, and can optionally be written as periodic log lines, as a
+    trace file in the Chrome trace event format (which can be opened in chrome://tracing or Perfetto) and as a cProfile
+    profile (which can be read with pstats or viewers like snakeviz).
+
+    Args:
+        road: road to instrument
+        log_interval: number of steps between two log lines with the metrics of the last interval, None for no logging
+        trace_path: path of the trace file to write, None for no trace
+        profile_path: path of the cProfile profile to write when the instrumentation is closed, None for no profile
+    """
+    PHASES = ('update_accelerations', 'change_lanes', 'update_positions_velocities', 'sort_vehicles',
+              'generate_new_vehicles')
+
+    # The counters of the road, with the names under which they are reported
+    COUNTERS = (
+        ('acceleration_updates', 'acceleration_update_count'),
+        ('free_flow_updates', 'free_flow_update_count'),
+        ('lane_change_evaluations', 'lane_change_evaluation_count'),
+        ('lane_change_reevaluations', 'lane_change_reevaluation_count'),
+        ('lane_changes', 'lane_change_count'),
+        ('cooldown_skips', 'cooldown_skip_count'),
+        ('idle_skips', 'idle_skip_count'),
+        ('insertions', 'inserted_vehicle_count'),
+        ('removals', 'removed_vehicle_count'),
+    )
+
+    def __init__(self, road, log_interval=None, trace_path=None, profile_path=None):
+        self.road = road
+        self.log_interval = log_interval
+        self.profile_path = profile_path
+
+        self.steps = 0
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.phase_calls = dict.fromkeys(self.PHASES, 0)
+        self.counters = dict.fromkeys((name for name, _ in self.COUNTERS), 0)
+        self.last_step = None
+
+        self.interval_start = None
+        self.interval_phase_seconds = dict(self.phase_seconds)
+        self.interval_counters = dict(self.counters)
+
+        self.trace_file = None
+        if trace_path is not None:
+            self.trace_file = open(trace_path, 'w')
+            self.trace_file.write('[\n' + json.dumps({'name': 'process_name', 'ph': 'M', 'pid': 0, 'tid': 0,
+                                                      'args': {'name': road.__class__.__name__}}))
+        self.trace_start = timer.perf_counter()
+
+        self.profile = cProfile.Profile() if profile_path is not None else None
+
+        # sort_vehicles is called from within the other phases, so it is timed by shadowing it on the road instance
+        sort_vehicles = road.sort_vehicles
+
+        def timed_sort_vehicles():
+            start = timer.perf_counter()
+            sort_vehicles()
+            self.record_phase('sort_vehicles', start, timer.perf_counter())
+
+        self.timed_sort_vehicles = timed_sort_vehicles
+        road.sort_vehicles = timed_sort_vehicles
+        road.instrumentation = self
+
+    def get_road_counters(self):
+        return {name: getattr(self.road, attribute) for name, attribute in self.COUNTERS}
+
+    def record_phase(self, phase, start, end):
+        self.phase_seconds[phase] += end - start
+        self.phase_calls[phase] += 1
+        if self.last_step is not None:
+            self.last_step['phase_seconds'][phase] += end - start
+
+        if self.trace_file is not None:
+            self.write_trace_event({'name': phase, 'ph': 'X', 'ts': (start - self.trace_start) * 1e6,
+                                    'dur': (end - start) * 1e6, 'pid': 0, 'tid': 0})
+
+    def write_trace_event(self, event):
+        self.trace_file.write(',\n' + json.dumps(event))
+
+    """
+        Updates the road with the phases of Road.get_update_phases, while recording the metrics of the step.
+
+        Args:
+            time: current time elapsed in the simulation
+    """
+    def update(self, time):
+        road = self.road
+        counters_before = self.get_road_counters()
+        self.last_step = {'time': time, 'phase_seconds': dict.fromkeys(self.PHASES, 0.0)}
+
+        if self.interval_start is None:
+            self.interval_start = timer.perf_counter()
+
+        if self.profile is not None:
+            self.profile.enable()
+
+        for phase, update in road.get_update_phases(time):
+            start = timer.perf_counter()
+            update()
+            self.record_phase(phase, start, timer.perf_counter())
+
+        if self.profile is not None:
+            self.profile.disable()
+
+        counters_after = self.get_road_counters()
+        step_counters = {name: counters_after[name] - counters_before[name] for name in counters_after}
+        for name, value in step_counters.items():
+            self.counters[name] += value
+
+        # Every vehicle gets an acceleration update, so the Vehicle objects of an ArrayRoad do not have to be synced to
+        # count them
+        self.last_step['vehicles'] = step_counters['acceleration_updates']
+        self.last_step['counters'] = step_counters
+        self.steps += 1
+
+        if self.trace_file is not None:
+            self.write_trace_event({'name': 'counters', 'ph': 'C', 'pid': 0, 'tid': 0,
+                                    'ts': (timer.perf_counter() - self.trace_start) * 1e6, 'args': step_counters})
+
+        if self.log_interval is not None and self.steps % self.log_interval == 0:
+            self.log_interval_metrics()
+
+    def log_interval_metrics(self):
+        elapsed = timer.perf_counter() - self.interval_start
+        phase_milliseconds = ' '.join(
+            f'{phase}={(self.phase_seconds[phase] - self.interval_phase_seconds[phase]) / self.log_interval * 1000:.3f}'
+            for phase in self.PHASES)
+        counters = ' '.join(f'{name}={self.counters[name] - self.interval_counters[name]}' for name in self.counters)
+
+        logger.info(f'steps={self.steps} time={self.last_step["time"]} vehicles={self.last_step["vehicles"]} '
+                    f'steps_per_second={self.log_interval / elapsed:.2f} ms_per_step: {phase_milliseconds} '
+                    f'counts: {counters}')
+
+        self.interval_start = timer.perf_counter()
+        self.interval_phase_seconds = dict(self.phase_seconds)
+        self.interval_counters = dict(self.counters)
+
+    def snapshot(self):
+        """Metrics recorded since the instrumentation was attached, and those of the last step"""
+        return {
+            'steps': self.steps,
+            'phase_seconds': dict(self.phase_seconds),
+            'phase_calls': dict(self.phase_calls),
+            'counters': dict(self.counters),
+            'last_step': self.last_step,
+        }
+
+    def close(self):
+        """Detach the instrumentation from the road, and write the trace and profile"""
+        if self.road.instrumentation is self:
+            self.road.instrumentation = None
+        # Only the timed sort_vehicles of this instrumentation is removed, so closing twice does no harm
+        if self.road.__dict__.get('sort_vehicles') is self.timed_sort_vehicles:
+            del self.road.sort_vehicles
+
+        if self.trace_file is not None:
+            self.trace_file.write('\n]\n')
+            self.trace_file.close()
+            self.trace_file = None
+
+        if self.profile is not None:
+            self.profile.dump_stats(self.profile_path)
+            self.profile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,4 +1,18 @@
+from collections import namedtuple
 from vehicle import *
+import numpy as np
+
+
+"""
+LaneChangeCandidates represent a batch of possible lane changes, each field is an array with one entry per candidate:
+    vehicles: index of the vehicle that considers changing lanes
+    new_lanes: the lane the vehicle considers changing to
+    old_next_vehicles, new_next_vehicles: index of the current and potential new next vehicle, -1 if there is none
+    old_prev_vehicles, new_prev_vehicles: index of the current and potential new previous vehicle, -1 if there is none
+"""
+LaneChangeCandidates = namedtuple('LaneChangeCandidates', ['vehicles', 'new_lanes', 'old_next_vehicles',
+                                                           'new_next_vehicles', 'old_prev_vehicles',
+                                                           'new_prev_vehicles'])
 
 
 class MOBIL:
@@ -58,3 +72,65 @@ class MOBIL:
         return (acceleration_change + self.politeness_factor
                 * (acceleration_change_old_prev + acceleration_change_new_prev)) > (vehicle.max_acceleration
                                                                                     - (is_right * self.right_bias))
+
+    """
+        Batched version of will_change_lane, evaluating many candidate lane changes at once.
+
+        Args:
+            state: VehicleArrays (or an ArrayRoad) with the state of all vehicles
+            vehicles: index array of the vehicles that consider changing lanes
+            new_lanes: array with the lane each vehicle considers changing to
+            old_next_vehicles, new_next_vehicles, old_prev_vehicles, new_prev_vehicles:
+                index arrays of the current and potential new next and previous vehicles, -1 if there is none
+            time: current time elapsed in the simulation
+
+        Returns:
+            Boolean array with for each candidate whether the vehicle will change lanes
+    """
+    def will_change_lanes(self, state, vehicles, new_lanes, old_next_vehicles, new_next_vehicles, old_prev_vehicles,
+                          new_prev_vehicles, time):
+        model_ids = state.model_ids[vehicles]
+        minimum_gaps = np.array([traffic_model.MINIMUM_GAP for traffic_model in state.traffic_models] + [0])[model_ids]
+
+        # Do not changes lanes if the vehicle 'just' changed lanes
+        allowed = time - state.last_lane_change_times[vehicles] >= self.MIN_LAST_CHANGE_DELTA
+
+        # Check if gap to new previous vehicle is sufficient
+        has_new_prev = new_prev_vehicles >= 0
+        gap_new_prev = state.positions[vehicles] - state.positions[new_prev_vehicles] - state.lengths[vehicles]
+        allowed &= ~has_new_prev | (gap_new_prev >= minimum_gaps)
+
+        # Safety criterion: lane changing should not lead to dangerous deceleration
+        new_acc_new_prev = state.calculate_accelerations(new_prev_vehicles, np.where(has_new_prev, vehicles, -1),
+                                                         model_ids)
+        new_acc_new_prev[~has_new_prev] = 0
+        allowed &= ~has_new_prev | (new_acc_new_prev >= -state.comfortable_decelerations[new_prev_vehicles])
+
+        # Check if gap to new next vehicle is sufficient
+        has_new_next = new_next_vehicles >= 0
+        gap_new_next = (state.positions[new_next_vehicles] - state.positions[vehicles]
+                        - state.lengths[new_next_vehicles])
+        allowed &= ~has_new_next | (gap_new_next >= minimum_gaps)
+
+        # Avoid obstacles
+        has_old_next = old_next_vehicles >= 0
+        gap_old_next = (state.positions[old_next_vehicles] - state.positions[vehicles]
+                        - state.lengths[old_next_vehicles])
+        avoid_obstacle = (has_old_next & state.obstacles[old_next_vehicles]
+                          & has_new_next & state.obstacles[new_next_vehicles])
+
+        # Safety criterion: lane changing should not lead to dangerous deceleration
+        new_acc = state.calculate_accelerations(vehicles, new_next_vehicles, model_ids)
+        safe = new_acc >= -state.comfortable_decelerations[vehicles]
+
+        # Incentive criterion: lane changes should be net beneficial
+        acceleration_change = new_acc - state.accelerations[vehicles]
+        acceleration_change_old_prev = np.where(old_prev_vehicles >= 0, state.accelerations[old_prev_vehicles], 0)
+        acceleration_change_new_prev = np.where(has_new_prev, state.accelerations[new_prev_vehicles], 0)
+
+        is_right = new_lanes > state.lanes[vehicles]
+        incentive = (acceleration_change + self.politeness_factor
+                     * (acceleration_change_old_prev + acceleration_change_new_prev)) > (
+                state.max_accelerations[vehicles] - (is_right * self.right_bias))
+
+        return allowed & np.where(avoid_obstacle, gap_new_next >= gap_old_next, safe & incentive)
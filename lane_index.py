@@ -0,0 +1,94 @@
+def bisect_position(vehicles, position, after_equal=False):
+    """Index of the first vehicle with a position smaller than or equal to the given position in a list of vehicles
+    sorted by decreasing position, or strictly smaller than the given position if after_equal is set"""
+    low, high = 0, len(vehicles)
+    while low < high:
+        middle = (low + high) // 2
+        if vehicles[middle].position > position or (after_equal and vehicles[middle].position == position):
+            low = middle + 1
+        else:
+            high = middle
+
+    return low
+
+
+class LaneIndex:
+    """
+    Per-lane index of the vehicles on a road, used to find the leader and follower of a position in any lane.
+    Each lane keeps a list of its vehicles sorted by their longitudinal position, in decreasing order, so lookups use
+    a binary search.
+
+    Args:
+        num_lanes: number of lanes of the road
+        vehicles: vehicles to index
+    """
+    def __init__(self, num_lanes, vehicles=()):
+        self.lanes = [[] for _ in range(num_lanes)]
+
+        for vehicle in vehicles:
+            if 0 <= vehicle.lane < num_lanes:
+                self.lanes[vehicle.lane].append(vehicle)
+
+        self.sort()
+
+    def sort(self):
+        for lane in range(len(self.lanes)):
+            self.sort_lane(lane)
+
+    def sort_lane(self, lane):
+        self.lanes[lane].sort(key=lambda x: x.position, reverse=True)
+
+    def _index_of(self, vehicle):
+        vehicles = self.lanes[vehicle.lane]
+
+        # Vehicles at the same position are not ordered by the binary search, so look for the exact object
+        for i in range(bisect_position(vehicles, vehicle.position), len(vehicles)):
+            if vehicles[i] is vehicle:
+                return i
+
+        return vehicles.index(vehicle)
+
+    """
+        Args:
+            lane: lane in which to look for the neighbours
+            position: longitudinal position on the road [m]
+
+        Returns:
+            Tuple of the closest vehicle in front of the position and the closest vehicle at or behind the position,
+            either one is None if there is no such vehicle
+    """
+    def get_neighbours(self, lane, position):
+        vehicles = self.lanes[lane]
+        i = bisect_position(vehicles, position)
+
+        next_vehicle = vehicles[i - 1] if i > 0 else None
+        prev_vehicle = vehicles[i] if i < len(vehicles) else None
+
+        return next_vehicle, prev_vehicle
+
+    def get_next_vehicle(self, lane, position):
+        return self.get_neighbours(lane, position)[0]
+
+    def get_prev_vehicle(self, lane, position):
+        return self.get_neighbours(lane, position)[1]
+
+    def first(self, lane):
+        vehicles = self.lanes[lane]
+        return vehicles[0] if vehicles else None
+
+    def last(self, lane):
+        vehicles = self.lanes[lane]
+        return vehicles[-1] if vehicles else None
+
+    def insert(self, vehicle):
+        vehicles = self.lanes[vehicle.lane]
+        vehicles.insert(bisect_position(vehicles, vehicle.position), vehicle)
+
+    def remove(self, vehicle):
+        del self.lanes[vehicle.lane][self._index_of(vehicle)]
+
+    def remove_first(self, lane, count):
+        del self.lanes[lane][:count]
+
+    def __len__(self):
+        return sum(len(vehicles) for vehicles in self.lanes)
@@ -0,0 +1,470 @@
+from scenario import load_scenario, create_road
+from checkpoint import save_checkpoint
+from incidents import IncidentSchedule
+from vehicle import *
+from operator import attrgetter
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Binary snapshot of the vehicles on a road, in little-endian byte order: a header with the magic bytes b'TSIM', the
+format version (uint16), the simulation time (float64) and the number of vehicles n (uint32), followed by the columns
+    vehicle_ids: n uint32
+    type_ids: n uint8, the type_id of the vehicle classes (see register_vehicle_type)
+    lanes: n uint8
+    positions, velocities: n float32 each [m] and [m/s]
+"""
+SNAPSHOT_HEADER = struct.Struct('<4sHdI')
+SNAPSHOT_MAGIC = b'TSIM'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = (('vehicle_ids', '<u4'), ('type_ids', 'u1'), ('lanes', 'u1'), ('positions', '<f4'),
+                    ('velocities', '<f4'))
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def encode_snapshot(road, time):
+    vehicles = road.vehicles
+    num = len(vehicles)
+    columns = [np.fromiter(map(attrgetter(attribute), vehicles), dtype, num) for attribute, dtype in
+               (('vehicle_id', '<u4'), ('type_id', 'u1'), ('lane', 'u1'), ('position', '<f4'), ('velocity', '<f4'))]
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time, num)
+    return header + b''.join(column.tobytes() for column in columns)
+
+
+def decode_snapshot(data):
+    """Dict with the time and the columns (as NumPy arrays) of a snapshot created by encode_snapshot"""
+    magic, version, time, num = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError('Not a snapshot of a supported version')
+
+    snapshot = {'time': time}
+    offset = SNAPSHOT_HEADER.size
+    for name, dtype in SNAPSHOT_COLUMNS:
+        snapshot[name] = np.frombuffer(data, dtype, num, offset)
+        offset += snapshot[name].nbytes
+
+    return snapshot
+
+
+class SnapshotClient:
+    """
+    Connection that receives snapshots. It only holds the latest snapshot that was not sent yet: when a new snapshot is
+    published before the previous one was written, the previous one is dropped. A slow client therefore receives
+    fewer snapshots, but never delays the simulation or the other clients.
+
+    Args:
+        writer: asyncio StreamWriter of the connection
+        decimation: only every decimation-th published snapshot is offered to the client
+        frame: function that wraps a snapshot in the framing of the connection
+    """
+    def __init__(self, writer, decimation, frame):
+        self.writer = writer
+        self.decimation = max(1, decimation)
+        self.frame = frame
+
+        self.pending = None
+        self.available = asyncio.Event()
+        # Task that sends the snapshots, see LiveServer.stream
+        self.sender = None
+        self.published_count = 0
+        self.sent_count = 0
+        self.dropped_count = 0
+
+    def offer(self, snapshot):
+        self.published_count += 1
+        if (self.published_count - 1) % self.decimation != 0:
+            return
+
+        if self.pending is not None:
+            self.dropped_count += 1
+        self.pending = snapshot
+        self.available.set()
+
+    async def send_snapshots(self):
+        while True:
+            await self.available.wait()
+            self.available.clear()
+            snapshot, self.pending = self.pending, None
+
+            self.writer.write(self.frame(snapshot))
+            # Only this client waits for its connection to drain
+            await self.writer.drain()
+            self.sent_count += 1
+
+
+class LiveServer:
+    """
+    Advances a road in the background of an asyncio event loop, at a given real-time factor, and serves the state of
+    the road to local clients while it runs:
+        GET /snapshot: the latest snapshot (see encode_snapshot)
+        GET /stream?every=n: a stream of every n-th snapshot, each prefixed with its length (uint32, little-endian)
+        GET /ws?every=n: a WebSocket that receives every n-th snapshot as a binary message, and accepts commands as
+                         JSON text messages, to which it replies with a text message
+        GET /status: JSON with the time, the number of steps, the number of vehicles in the latest snapshot, and
+                     whether the simulation is paused
+        POST /command: a command as a JSON object, the reply is a JSON object
+
+    A command is a JSON object with the name of the command and its arguments, e.g.
+    {"command": "add_obstacle", "lane": 0, "position": 5000}. The commands are add_obstacle, remove_obstacle,
+    add_incident (see IncidentSchedule.add_incident), pause, resume, set_real_time_factor (value) and checkpoint (path
+    relative to checkpoint_directory, see save_checkpoint). The time steps run in a worker thread, so the event loop
+    keeps serving the clients during a step; commands are applied between two time steps, so they never see a road in
+    the middle of an update.
+
+    Every snapshot_interval steps, a snapshot is encoded once and offered to all clients, which send it at their own
+    pace (see SnapshotClient).
+
+    Args:
+        road: road to simulate
+        time: simulation time at the start [s]
+        duration: simulation time at which the simulation stops (the server keeps serving the last state), None to
+                  run until the server is stopped
+        real_time_factor: simulated seconds per wall clock second, 0 to simulate as fast as possible
+        snapshot_interval: number of time steps between the published snapshots
+        checkpoint_directory: directory that the checkpoint command writes to (it cannot write outside of it), None to
+                              disable the checkpoint command
+    """
+    DEFAULT_REAL_TIME_FACTOR = 1.0
+    DEFAULT_SNAPSHOT_INTERVAL = 1
+    DEFAULT_CHECKPOINT_DIRECTORY = 'checkpoints'
+    # Number of seconds the simulation may fall behind the real-time factor before it stops catching up
+    MAX_LAG = 1.0
+
+    def __init__(self, road, time=0, duration=None, real_time_factor=DEFAULT_REAL_TIME_FACTOR,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL, checkpoint_directory=DEFAULT_CHECKPOINT_DIRECTORY):
+        self.road = road
+        self.time = time
+        self.duration = duration
+        self.real_time_factor = real_time_factor
+        self.snapshot_interval = snapshot_interval
+        self.checkpoint_directory = checkpoint_directory
+
+        self.step_count = 0
+        self.paused = False
+        self.snapshot = encode_snapshot(road, time)
+        self.clients = set()
+
+        self.commands = None
+        self.reference = None
+        self.server = None
+        self.simulation = None
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """Start the server and the simulation, the simulation keeps running in the background"""
+        self.commands = asyncio.Queue()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.simulation = asyncio.ensure_future(self.run())
+
+        return self.server
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """Run the server (and the simulation) until it is cancelled"""
+        await self.start(host, port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.reference = (loop.time(), self.time)
+        while True:
+            while not self.commands.empty():
+                self.apply_command(*self.commands.get_nowait())
+
+            if self.paused or (self.duration is not None and self.time >= self.duration):
+                # Wait for a command that resumes (or otherwise changes) the simulation
+                self.apply_command(*await self.commands.get())
+                self.reference = (loop.time(), self.time)
+                continue
+
+            # Only one step runs at a time, and no command is applied while it runs
+            self.time, snapshot = await loop.run_in_executor(None, self.step)
+            self.step_count += 1
+
+            if snapshot is not None:
+                self.publish(snapshot)
+
+            await self.pace(loop)
+
+    """
+        Updates the road for one time step in a worker thread, and encodes the snapshot if one is due.
+
+        Returns:
+            Tuple of the time after the step and the snapshot, None if no snapshot is due
+    """
+    def step(self):
+        self.road.update(self.time)
+        time = self.time + self.road.time_step
+
+        snapshot = None
+        if (self.step_count + 1) % self.snapshot_interval == 0:
+            snapshot = encode_snapshot(self.road, time)
+
+        return time, snapshot
+
+    async def pace(self, loop):
+        """Wait until the wall clock catches up with the simulation, always giving the clients a turn"""
+        delay = 0
+        if self.real_time_factor > 0:
+            wall_time, time = self.reference
+            delay = wall_time + (self.time - time) / self.real_time_factor - loop.time()
+            if delay < -self.MAX_LAG:
+                self.reference = (loop.time(), self.time)
+
+        await asyncio.sleep(max(delay, 0))
+
+    def publish(self, snapshot):
+        self.snapshot = snapshot
+        for client in self.clients:
+            client.offer(self.snapshot)
+
+    """
+        Args:
+            command: dict with the name of the command and its arguments
+            future: future that gets the reply of the command
+
+        Returns:
+            The reply, a dict with the time, and an error if the command failed
+    """
+    def apply_command(self, command, future=None):
+        reply = {'time': self.time}
+        try:
+            name = command['command']
+            if name == 'add_obstacle':
+                self.road.add_obstacle(int(command['lane']), float(command['position']))
+            elif name == 'remove_obstacle':
+                self.road.remove_obstacle(int(command['lane']), float(command['position']))
+            elif name == 'add_incident':
+                if self.road.incident_schedule is None:
+                    IncidentSchedule(self.road)
+                self.road.incident_schedule.add_incident({key: value for key, value in command.items()
+                                                          if key != 'command'})
+            elif name == 'pause':
+                self.paused = True
+            elif name == 'resume':
+                self.paused = False
+            elif name == 'set_real_time_factor':
+                self.real_time_factor = float(command['value'])
+                self.reference = (asyncio.get_event_loop().time(), self.time)
+            elif name == 'checkpoint':
+                path = self.get_checkpoint_path(command['path'])
+                save_checkpoint(self.road, path, self.time)
+                reply['path'] = path
+            else:
+                raise ValueError(f'Unknown command: {name}')
+        except Exception as error:
+            reply['error'] = f'{error.__class__.__name__}: {error}'
+
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+        return reply
+
+    def get_checkpoint_path(self, path):
+        """Path of a checkpoint in the checkpoint directory, which is created when it does not exist"""
+        if self.checkpoint_directory is None:
+            raise ValueError('Checkpoints are disabled')
+
+        directory = os.path.realpath(self.checkpoint_directory)
+        checkpoint_path = os.path.realpath(os.path.join(directory, path))
+        if checkpoint_path == directory or os.path.commonpath([directory, checkpoint_path]) != directory:
+            raise ValueError(f'Checkpoints can only be written to {self.checkpoint_directory}')
+
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        return checkpoint_path
+
+    async def submit(self, command):
+        """Queue a command for the simulation and wait for its reply"""
+        future = asyncio.get_event_loop().create_future()
+        await self.commands.put((command, future))
+
+        return await future
+
+    def status(self):
+        # The road can be in the middle of a step, so the number of vehicles is that of the latest snapshot
+        return {'time': self.time, 'steps': self.step_count, 'vehicles': SNAPSHOT_HEADER.unpack_from(self.snapshot)[3],
+                'paused': self.paused, 'real_time_factor': self.real_time_factor, 'clients': len(self.clients)}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) < 2:
+                return
+
+            method, target = request_line[:2]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            decimation = int(query.get('every', ['1'])[0])
+
+            if method == 'GET' and url.path == '/snapshot':
+                self.write_response(writer, 200, self.snapshot, 'application/octet-stream')
+            elif method == 'GET' and url.path == '/status':
+                self.write_response(writer, 200, json.dumps(self.status()).encode(), 'application/json')
+            elif method == 'POST' and url.path == '/command':
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    reply = await self.submit(json.loads(body))
+                except ValueError as error:
+                    reply = {'error': f'Invalid command: {error}'}
+                self.write_response(writer, 400 if 'error' in reply else 200, json.dumps(reply).encode(),
+                                    'application/json')
+            elif method == 'GET' and url.path == '/stream':
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nConnection: close\r\n\r\n')
+                await self.stream(SnapshotClient(writer, decimation,
+                                                 lambda snapshot: struct.pack('<I', len(snapshot)) + snapshot))
+            elif method == 'GET' and url.path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                await self.handle_websocket(reader, writer, headers, decimation)
+            else:
+                self.write_response(writer, 404, b'Not found', 'text/plain')
+
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception('Error while handling a request')
+        finally:
+            writer.close()
+
+    @staticmethod
+    def write_response(writer, status, body, content_type):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + body)
+
+    async def stream(self, client, reader=None):
+        """Send snapshots to a client until it disconnects, or until the reader task (if any) ends"""
+        self.clients.add(client)
+        client.offer(self.snapshot)
+        client.sender = asyncio.ensure_future(client.send_snapshots())
+        tasks = [client.sender] if reader is None else [client.sender, asyncio.ensure_future(reader)]
+        try:
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                # The connection is cancelled when the event loop shuts down, which ends the stream like a disconnect
+                return
+
+            for task in done:
+                if not task.cancelled() and task.exception() is not None and \
+                        not isinstance(task.exception(), (ConnectionError, asyncio.IncompleteReadError)):
+                    raise task.exception()
+        finally:
+            self.clients.discard(client)
+            for task in tasks:
+                task.cancel()
+
+    async def handle_websocket(self, reader, writer, headers, decimation):
+        accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'].encode() + WEBSOCKET_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+        client = SnapshotClient(writer, decimation, lambda snapshot: websocket_frame(snapshot, opcode=2))
+        await self.stream(client, self.receive_websocket_commands(reader, writer))
+
+    async def receive_websocket_commands(self, reader, writer):
+        while True:
+            opcode, payload = await read_websocket_frame(reader)
+            if opcode == 8:
+                writer.write(websocket_frame(b'', opcode=8))
+                return
+            if opcode == 9:
+                writer.write(websocket_frame(payload, opcode=10))
+            elif opcode == 1:
+                try:
+                    reply = await self.submit(json.loads(payload))
+                except ValueError as error:
+                    reply = {'error': f'Invalid command: {error}'}
+                writer.write(websocket_frame(json.dumps(reply).encode(), opcode=1))
+
+    def close(self):
+        """Stop the server and the simulation, and disconnect the clients"""
+        if self.server is not None:
+            self.server.close()
+        if self.simulation is not None:
+            self.simulation.cancel()
+
+        for client in self.clients:
+            client.writer.close()
+            # Ends the stream of the client, the sender would otherwise wait for the next snapshot
+            if client.sender is not None:
+                client.sender.cancel()
+
+
+def websocket_frame(payload, opcode):
+    """Unfragmented, unmasked WebSocket frame, as sent by a server"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+    return header + payload
+
+
+async def read_websocket_frame(reader):
+    """Opcode and payload of the next WebSocket frame sent by a client (fragmented messages are not supported)"""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+
+    mask = await reader.readexactly(4) if second & 0x80 else b'\0\0\0\0'
+    payload = np.frombuffer(await reader.readexactly(length), np.uint8)
+    payload = payload ^ np.resize(np.frombuffer(mask, np.uint8), length)
+
+    return first & 0x0f, payload.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a scenario in the background and serve its state to clients.')
+    parser.add_argument('scenario', nargs='?', default=None,
+                        help='JSON scenario file, see scenario.DEFAULT_SCENARIO (the braking scenario if omitted)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--real-time-factor', type=float, default=LiveServer.DEFAULT_REAL_TIME_FACTOR,
+                        help='simulated seconds per second, 0 to simulate as fast as possible')
+    parser.add_argument('--snapshot-interval', type=int, default=LiveServer.DEFAULT_SNAPSHOT_INTERVAL,
+                        help='number of time steps between snapshots')
+    parser.add_argument('--checkpoint-directory', default=LiveServer.DEFAULT_CHECKPOINT_DIRECTORY,
+                        help='directory that the checkpoint command writes to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    scenario = load_scenario(args.scenario)
+    server = LiveServer(create_road(scenario), duration=scenario['duration'], real_time_factor=args.real_time_factor,
+                        snapshot_interval=args.snapshot_interval, checkpoint_directory=args.checkpoint_directory)
+
+    logger.info(f'Serving {scenario["name"]} on http://{args.host}:{args.port}')
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import math
+
+
+class LoopDetector:
+    """
+    Virtual inductive loop at a fixed position on the road. The road tells the detector which vehicles cross it in
+    every time step (see Road.add_detector), and the detector keeps the counts, speeds and occupation times of the last
+    window seconds in a ring buffer with one slot per time step. Running totals are kept next to the ring buffer, so
+    every reading takes constant time, regardless of the number of vehicles on the road.
+
+    The occupancy is derived like a loop does from its pulses: a crossing vehicle occupies the detector for its length
+    divided by its speed. For a detector across several lanes, it is the mean occupancy of the lanes.
+
+    Args:
+        position: position of the detector on the road [m]
+        lane: lane of the detector, None for a detector across all lanes
+        time_step: time step of the road [s]
+        window: time [s] over which the windowed readings are aggregated
+        covered_lanes: number of lanes the detector covers
+    """
+    DEFAULT_WINDOW = 60
+
+    def __init__(self, position, lane, time_step, window=DEFAULT_WINDOW, covered_lanes=1):
+        self.position = position
+        self.lane = lane
+        self.time_step = time_step
+        self.window = window
+        self.covered_lanes = covered_lanes
+
+        self.window_steps = max(1, round(window / time_step))
+        self.step_counts = [0] * self.window_steps
+        self.step_speed_sums = [0.0] * self.window_steps
+        self.step_occupied_times = [0.0] * self.window_steps
+
+        self.steps = 0
+        self.total_count = 0
+        self.window_count = 0
+        self.window_speed_sum = 0.0
+        self.window_occupied_time = 0.0
+
+    """
+        Adds a time step to the detector, dropping the oldest step from the window.
+
+        Args:
+            speeds: speeds of the vehicles that crossed the detector during the step [m/s]
+            lengths: lengths of these vehicles [m]
+    """
+    def update(self, speeds, lengths):
+        slot = self.steps % self.window_steps
+        self.steps += 1
+
+        count = len(speeds)
+        speed_sum = sum(speeds)
+        occupied_time = min(sum(length / speed for speed, length in zip(speeds, lengths)),
+                            self.time_step * self.covered_lanes)
+
+        self.window_count += count - self.step_counts[slot]
+        self.window_speed_sum += speed_sum - self.step_speed_sums[slot]
+        self.window_occupied_time += occupied_time - self.step_occupied_times[slot]
+
+        self.step_counts[slot] = count
+        self.step_speed_sums[slot] = speed_sum
+        self.step_occupied_times[slot] = occupied_time
+        self.total_count += count
+
+    def window_time(self):
+        """Time covered by the window [s], shorter than window until the detector has seen enough steps"""
+        return min(self.steps, self.window_steps) * self.time_step
+
+    def count(self):
+        """Number of vehicles that crossed the detector within the window"""
+        return self.window_count
+
+    def flow(self):
+        """Flow over the window [vehicles/hour]"""
+        if self.steps == 0:
+            return 0
+
+        return self.window_count / (self.window_time() / 3600)
+
+    def time_mean_speed(self):
+        """Arithmetic mean of the speeds of the vehicles that crossed within the window [m/s], nan if there are none"""
+        if self.window_count == 0:
+            return math.nan
+
+        return self.window_speed_sum / self.window_count
+
+    def occupancy(self):
+        """Fraction of the window during which the detector was occupied by a vehicle"""
+        if self.steps == 0:
+            return 0
+
+        return min(1.0, max(0.0, self.window_occupied_time / (self.window_time() * self.covered_lanes)))
+
+    def readings(self):
+        return {
+            'time': self.steps * self.time_step,
+            'count': self.count(),
+            'total_count': self.total_count,
+            'flow': self.flow(),
+            'time_mean_speed': self.time_mean_speed(),
+            'occupancy': self.occupancy(),
+        }
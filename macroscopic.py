@@ -0,0 +1,219 @@
+from road import Road
+from ring_road import run_density_sweep
+from vehicle_factory import VehicleFactory, VEHICLE_CLASSES, VEHICLE_TYPES
+from collections import namedtuple
+from operator import itemgetter
+
+import numpy as np
+
+
+"""
+FundamentalDiagram represents a triangular fundamental diagram, per lane:
+    free_flow_speed: speed of the traffic below the critical density [m/s]
+    capacity: maximum flow [vehicles/s]
+    jam_density: density of standing traffic [vehicles/m]
+"""
+FundamentalDiagram = namedtuple('FundamentalDiagram', ['free_flow_speed', 'capacity', 'jam_density'])
+
+# Densities [vehicles/km/lane] at which measure_fundamental_diagram measures the equilibrium flow
+DEFAULT_DENSITIES = np.arange(5, 81)
+
+# A point of the density sweep is uncongested if its speed deviation [m/s] is below FREE_FLOW_SPEED_DEVIATION and its
+# mean speed is at least FREE_FLOW_SPEED_FRACTION of the lowest desired velocity of the vehicles
+FREE_FLOW_SPEED_DEVIATION = 1
+FREE_FLOW_SPEED_FRACTION = 0.95
+# Largest relative difference between the measured free flow speed and the mean desired velocity of the vehicles
+FREE_FLOW_SPEED_TOLERANCE = 0.25
+
+
+"""
+    Estimates the fundamental diagram of the vehicles a factory creates, from their mean parameters: vehicles at the
+    capacity drive at the free flow speed at their desired time headway, standing vehicles keep the minimum gap of the
+    traffic model. This is an upper bound of the flow the traffic model can carry, see measure_fundamental_diagram.
+
+    Args:
+        vehicle_factory: VehicleFactory with the weights of the vehicle types and the default traffic model
+        minimum_gap: gap between standing vehicles [m] if the traffic model does not define a MINIMUM_GAP
+
+    Returns:
+        The FundamentalDiagram per lane
+"""
+def estimate_fundamental_diagram(vehicle_factory, minimum_gap=2):
+    minimum_gap = getattr(vehicle_factory.default_traffic_model, 'MINIMUM_GAP', minimum_gap)
+
+    weights = np.asarray(vehicle_factory.weights, dtype=float)
+    weights /= weights.sum()
+    vehicle_classes = [VEHICLE_CLASSES[vehicle_type] for vehicle_type in VEHICLE_TYPES]
+
+    def mean(attribute):
+        return float(np.dot(weights, [getattr(vehicle_class, attribute) for vehicle_class in vehicle_classes]))
+
+    free_flow_speed = mean('desired_velocity')
+    jam_spacing = mean('length') + minimum_gap
+
+    return FundamentalDiagram(free_flow_speed, free_flow_speed / (jam_spacing + free_flow_speed
+                                                                  * mean('desired_time_headway')), 1 / jam_spacing)
+
+
+"""
+    Measures the fundamental diagram of the vehicles a factory creates with a density sweep on a ring road (see
+    ring_road.run_density_sweep), with the traffic model of the factory. The free flow branch of the triangle is fitted
+    to the uncongested points of the sweep (see FREE_FLOW_SPEED_*): the free flow speed is the least squares slope of
+    their flows over their densities, and the capacity is the largest flow among them. The jam density follows from
+    the minimum gap, as in estimate_fundamental_diagram.
+
+    The vehicles of a ring cannot overtake, so uncongested traffic moves at the desired velocity of the slowest vehicle
+    in its lane, and with mixed vehicle types the congested points depend on the order of the types. The free flow
+    speed can therefore be somewhat below the mean desired velocity of the vehicles, but not by more than
+    FREE_FLOW_SPEED_TOLERANCE.
+
+    Traffic that arrives at a microscopic window at this capacity is carried by its vehicles, while the capacity of
+    estimate_fundamental_diagram can be just out of their reach, so that a queue builds up in front of the window.
+
+    Args:
+        vehicle_factory: VehicleFactory with the weights of the vehicle types and the default traffic model, its
+                         random number generator is left untouched
+        time_step: time step for the simulation
+        densities: densities at which the flow is measured [vehicles/km/lane]
+        minimum_gap: gap between standing vehicles [m] if the traffic model does not define a MINIMUM_GAP
+
+    Returns:
+        The FundamentalDiagram per lane
+
+    Raises:
+        ValueError: if no point of the sweep is uncongested, or if the measured free flow speed differs by more than
+                    FREE_FLOW_SPEED_TOLERANCE from the mean desired velocity of the vehicles
+"""
+def measure_fundamental_diagram(vehicle_factory, time_step=Road.DEFAULT_TIME_STEP, densities=DEFAULT_DENSITIES,
+                                minimum_gap=2):
+    ring_factory = VehicleFactory(list(vehicle_factory.weights), vehicle_factory.default_traffic_model, None, seed=0)
+    points = run_density_sweep(densities, time_step=time_step, vehicle_factory=ring_factory)
+
+    min_speed = min(VEHICLE_CLASSES[vehicle_type].desired_velocity
+                    for vehicle_type, weight in zip(VEHICLE_TYPES, vehicle_factory.weights) if weight > 0)
+    uncongested = [point for point in points if point['speed_deviation'] < FREE_FLOW_SPEED_DEVIATION
+                   and point['mean_speed'] >= FREE_FLOW_SPEED_FRACTION * min_speed]
+    if not uncongested:
+        raise ValueError('No density of the sweep is uncongested, measure the fundamental diagram at lower densities')
+
+    uncongested_densities = np.array([point['density'] for point in uncongested]) / 1000
+    uncongested_flows = np.array([point['flow'] for point in uncongested]) / 3600
+    free_flow_speed = float(np.dot(uncongested_flows, uncongested_densities)
+                            / np.dot(uncongested_densities, uncongested_densities))
+
+    estimate = estimate_fundamental_diagram(vehicle_factory, minimum_gap)
+    if abs(free_flow_speed - estimate.free_flow_speed) > FREE_FLOW_SPEED_TOLERANCE * estimate.free_flow_speed:
+        raise ValueError(f'The measured free flow speed {free_flow_speed:.2f} m/s is not close to the mean desired '
+                         f'velocity {estimate.free_flow_speed:.2f} m/s of the vehicles')
+
+    return FundamentalDiagram(free_flow_speed, float(uncongested_flows.max()), estimate.jam_density)
+
+
+class CellTransmissionModel:
+    """
+    Cell transmission model (the Godunov discretisation of the LWR model) of a stretch of road: the stretch is divided
+    into cells of equal length, and in every time step each cell sends as many vehicles to the next cell as it can
+    send (its demand) and the next cell can receive (its supply). The traffic of all lanes is aggregated.
+
+    The number of vehicles in each cell is kept as a (fractional) count, so the cost of a time step depends on the
+    number of cells, not on the number of vehicles.
+
+    Args:
+        length: length of the stretch [m]
+        num_lanes: number of lanes of the stretch
+        fundamental_diagram: FundamentalDiagram per lane
+        time_step: time step for the simulation
+        cell_length: approximate length of the cells [m], the vehicles may not cross more than one cell per time step
+    """
+    DEFAULT_CELL_LENGTH = 100
+
+    def __init__(self, length, num_lanes, fundamental_diagram: FundamentalDiagram, time_step,
+                 cell_length=DEFAULT_CELL_LENGTH):
+        self.length = length
+        self.num_lanes = num_lanes
+        self.fundamental_diagram = fundamental_diagram
+        self.time_step = time_step
+
+        num_cells = max(1, int(length // cell_length))
+        self.cell_length = length / num_cells
+
+        free_flow_speed, capacity, jam_density = fundamental_diagram
+        critical_density = capacity / free_flow_speed
+        if critical_density >= jam_density:
+            raise ValueError(f'The critical density {critical_density} is not below the jam density {jam_density}')
+        self.wave_speed = capacity / (jam_density - critical_density)
+        if max(free_flow_speed, self.wave_speed) * time_step > self.cell_length:
+            raise ValueError(f'Cells of {self.cell_length:.1f} m are too short for a time step of {time_step} s')
+
+        self.counts = np.zeros(num_cells)
+
+        # Capacity, and critical and jam count per cell, in vehicles per time step and vehicles
+        self.capacity = capacity * num_lanes * time_step
+        self.critical_count = critical_density * num_lanes * self.cell_length
+        self.jam_count = jam_density * num_lanes * self.cell_length
+        self.free_flow_ratio = free_flow_speed * time_step / self.cell_length
+        self.wave_ratio = self.wave_speed * time_step / self.cell_length
+
+    def demands(self):
+        """Number of vehicles each cell can send in a time step"""
+        return np.minimum(self.free_flow_ratio * self.counts, self.capacity)
+
+    def supplies(self):
+        """Number of vehicles each cell can receive in a time step"""
+        return np.minimum(self.capacity, self.wave_ratio * np.maximum(self.jam_count - self.counts, 0))
+
+    def demand(self):
+        """Number of vehicles the last cell can send out of the stretch in a time step"""
+        return min(self.free_flow_ratio * self.counts[-1], self.capacity)
+
+    def supply(self):
+        """Number of vehicles the first cell can receive in a time step"""
+        return min(self.capacity, self.wave_ratio * max(self.jam_count - self.counts[0], 0))
+
+    """
+        Moves the vehicles through the cells for one time step.
+
+        Args:
+            inflow: number of vehicles that enter the first cell, at most its supply
+            outflow: number of vehicles that leave the last cell, at most its demand
+
+        Both are determined from the state before the update, like the flows between the cells.
+    """
+    def update(self, inflow, outflow):
+        flows = np.minimum(self.demands()[:-1], self.supplies()[1:])
+        self.counts[1:] += flows
+        self.counts[:-1] -= flows
+        self.counts[0] += inflow
+        self.counts[-1] -= outflow
+
+    def add_vehicles(self, position, count=1):
+        """Add vehicles at a position on the stretch to the count of its cell"""
+        self.counts[min(int(position // self.cell_length), self.counts.size - 1)] += count
+
+    def speeds(self):
+        """Equilibrium speed in each cell [m/s], on the congested side of the fundamental diagram when the density is
+        above the critical density"""
+        with np.errstate(divide='ignore'):
+            congested_speeds = self.wave_speed * (self.fundamental_diagram.jam_density / self.densities() - 1)
+
+        return np.clip(congested_speeds, 0, self.fundamental_diagram.free_flow_speed)
+
+    def densities(self):
+        """Density in each cell [vehicles/m/lane]"""
+        return self.counts / (self.num_lanes * self.cell_length)
+
+    def count_ahead(self, position):
+        """Number of vehicles ahead of a position on the stretch, assuming they are spread evenly over each cell"""
+        cell = position / self.cell_length
+        i = min(int(cell), self.counts.size)
+        if i == self.counts.size:
+            return 0.0
+
+        return float(self.counts[i + 1:].sum() + self.counts[i] * (i + 1 - cell))
+
+    def vehicle_count(self):
+        return float(self.counts.sum())
+
+    def cell_positions(self):
+        """Positions of the centres of the cells on the stretch [m]"""
+        return (np.arange(self.counts.size) + 0.5) * self.cell_length
@@ -0,0 +1,535 @@
+from road import Road
+from array_road import ArrayRoad
+from segmented_road import RoadSegment, VehicleRecord, COUNTERS
+from vehicle import *
+from collections import namedtuple
+import copy
+import multiprocessing
+
+import numpy as np
+
+
+"""
+Link represents a junction between the end of an upstream and the start of a downstream segment:
+    upstream, downstream: names of the segments
+    lanes: dict that maps the lanes of the upstream segment to the lane of the downstream segment they lead to
+    fraction: share of the vehicles in these lanes that takes the link, relative to the other links from the same lane
+"""
+Link = namedtuple('Link', ['upstream', 'downstream', 'lanes', 'fraction'])
+
+
+class NetworkSegment(RoadSegment):
+    """
+    Segment of a RoadNetwork, an ArrayRoad with positions from 0 to its length. In every step, its arrays also
+    contain copies (ghosts) of the vehicles across its junctions: ahead of each lane the last vehicle of the lane it
+    leads to and the first vehicle of the other lanes that lead there as well, and behind each lane the first vehicle
+    of the lanes that lead into it, with their positions relative to the start of this segment. Ghosts never change
+    lanes and are removed before the positions are updated.
+
+    Vehicles that drive past the end of the segment are not removed from the road, but returned to the network, which
+    hands them over to the next segment.
+
+    Args:
+        models: list of the traffic and lane change models that VehicleRecords refer to
+        records: VehicleRecords of the vehicles on the segment
+        random: state of the random number generator of the road, as (generator, block, position)
+        see Road for the other arguments
+    """
+    def __init__(self, models, records, length, num_lanes, vehicle_factory, insertion_gap, insertion_chance,
+                 time_step, random):
+        # The road itself has no end, the vehicles that drive past the end of the segment are handed over after the
+        # update, so their velocities are updated like those of the other vehicles
+        super().__init__(0, length, models, records, math.inf, num_lanes, vehicle_factory, insertion_gap,
+                         insertion_chance, time_step, random)
+
+    def get_ghost(self, record):
+        # A vehicle can be the ghost of several lanes, and of a lane of its own segment (at a lane drop), so every
+        # ghost is a new object
+        return self.create_vehicle(record)
+
+    def change_vehicle_lane(self, index, new_lane, time):
+        # The ghosts are sent anew in every step, so the lane changes are not reported to the other segments
+        return ArrayRoad.change_vehicle_lane(self, index, new_lane, time)
+
+    """
+        Updates the segment for one time step, like Road.update.
+
+        Args:
+            time: current time elapsed in the simulation
+            incoming: VehicleRecords of the vehicles that were handed over to the segment in the last step
+            ghosts: VehicleRecords of the ghosts ahead of and behind the segment
+
+        Returns:
+            Tuple of the VehicleRecords of the vehicles that reached the end of the segment, the first and last vehicle
+            of the segment in each lane (see get_lane_ends), its number of vehicles and its counters
+    """
+    def step(self, time, incoming, ghosts):
+        self.ghost_rows = np.zeros(self.positions.size, dtype=bool)
+        self.insert_sorted(list(map(self.create_vehicle, incoming)))
+        self.insert_sorted(list(map(self.get_ghost, ghosts)), ghosts=True)
+
+        self.update_accelerations()
+        self.acceleration_update_count -= len(ghosts)
+        self.change_lanes(time)
+
+        self.remove_ghosts()
+        self.update_positions_velocities()
+        self.generate_new_vehicles(time)
+
+        # The vehicles that drove past the end are at the front of the sorted arrays
+        outgoing_count = int(np.count_nonzero(self.positions > self.end))
+        outgoing = self.get_records(np.arange(outgoing_count))
+        if outgoing:
+            self._remove_front(outgoing_count)
+
+        vehicle_count = self.positions.size - int(np.count_nonzero(self.obstacles))
+
+        return outgoing, self.get_lane_ends(), vehicle_count, {counter: getattr(self, counter) for counter in COUNTERS}
+
+
+def run_network_command(segments, command, args):
+    """Execute a command of a RoadNetwork on the segments of a worker"""
+    if command == 'add':
+        name, segment_args = args
+        segments[name] = NetworkSegment(*segment_args)
+        return None
+
+    if command == 'step':
+        time, requests = args
+        return {name: segments[name].step(time, *request) for name, request in requests.items()}
+
+    if command == 'allocate_vehicle_id':
+        return next(Vehicle.ids)
+
+    name, method, method_args = args
+    return getattr(segments[name], method)(*method_args)
+
+
+def run_network_worker(connection, first_vehicle_id, num_workers):
+    """Serves the requests of a RoadNetwork for the segments assigned to a worker process, until it is closed"""
+    # The workers hand out interleaved vehicle ids, so the ids stay unique across the network
+    Vehicle.ids = count(first_vehicle_id, num_workers)
+
+    segments = {}
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            break
+
+        try:
+            result = run_network_command(segments, command, args)
+        except Exception as error:
+            result = error
+
+        connection.send(result)
+
+    connection.close()
+
+
+class RoadNetwork:
+    """
+    Network of road segments connected by junctions, for corridors with merges, diverges, on- and off-ramps and lane
+    drops. Each segment is an ArrayRoad with its own length, number of lanes and (for the segments where traffic
+    enters the network, like the start of the main road and the on-ramps) its own vehicle factory and inflow.
+
+    A Link connects the end of a segment to the start of another one and maps the lanes of the upstream segment to the
+    lanes of the downstream one. Several segments can lead into the same segment (merges and on-ramps), and a lane can
+    lead to several segments (diverges and off-ramps), in which case the vehicles choose a link at random, weighted by
+    the fractions of the links.
+
+    In every step, a segment gets copies (ghosts) of the vehicles across its junctions, so its first vehicles follow
+    the last vehicles of the segment ahead and lane changes near its start consider the vehicles behind the junction.
+    A lane that leads to several segments follows the link with the largest fraction. At merges and lane drops, the
+    first vehicles of the other lanes that lead to the same lane are ghosts ahead of the lane as well, so the vehicles
+    of the lanes zip together: each follows the vehicle closest ahead of it at the junction, whichever lane it is in.
+    All segments are then updated independently, and the vehicles that reached the end of a segment are handed over
+    to the start of the next one, keeping the distance they drove past the end, but no further than the rear of the
+    last vehicle in the lane they arrive in. A vehicle for which that lane has no room yet, because that vehicle has
+    not cleared the junction, is held back at the end of its segment. The lanes they arrive in are looked up in a
+    table, so the handover costs a constant time per vehicle. Vehicles in a lane without a link leave the network.
+
+    Because the segments only exchange their state between the steps, they are updated in parallel when the network
+    has worker processes, each of which updates a share of the segments (balanced by their length and lanes). Lane
+    changes right at a junction are decided with the state of the other segment at the start of the step.
+
+    Args:
+        time_step: time step for the simulation
+        seed: seed of the random number generators of the network, from which the seeds of the segments are derived
+        workers: number of worker processes, 0 to update the segments in this process
+    """
+    DEFAULT_WORKERS = 0
+
+    def __init__(self, time_step=Road.DEFAULT_TIME_STEP, seed=None, workers=DEFAULT_WORKERS):
+        self.time_step = time_step
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.random = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+        self.num_workers = workers
+
+        # Parameters of the segments by name, in the order they were added, and the links between them
+        self.segments = {}
+        self.links = []
+
+        # For each (segment, lane), the (link, downstream lane) pairs it leads to and the (segment, lane) pairs that
+        # lead into it
+        self.routes = {}
+        self.feeders = {}
+
+        self.started = False
+        self.workers = []
+        self.local_segments = {}
+        # Worker of each segment
+        self.assignment = {}
+
+        self.incoming = {}
+        self.first_vehicles = {}
+        self.last_vehicles = {}
+        self.vehicle_counts = {}
+        self.counters = {}
+
+        # Vehicles that left the network
+        self.removed_vehicle_count = 0
+        for counter in COUNTERS:
+            if counter != 'removed_vehicle_count':
+                setattr(self, counter, 0)
+
+    """
+        Adds a segment to the network, segments can only be added before the first update.
+
+        Args:
+            name: name of the segment
+            length: length of the segment [m]
+            num_lanes: number of lanes of the segment
+            vehicles: list of vehicles on the segment at the start, with positions relative to its start
+            vehicle_factory: factory that generates the vehicles entering the segment at its start, None if no
+                             traffic enters the network there; each segment gets its own copy
+            seed: seed of the random number generator of the segment, derived from the seed of the network if None
+            see Road for the other arguments
+    """
+    def add_segment(self, name, length, num_lanes=Road.DEFAULT_NUM_LANES, vehicles=None, vehicle_factory=None,
+                    insertion_gap=Road.DEFAULT_INSERTION_GAP, insertion_chance=Road.DEFAULT_INSERTION_CHANCE,
+                    seed=None):
+        if self.started:
+            raise RuntimeError('Segments can only be added before the network is started')
+        if name in self.segments:
+            raise ValueError(f'Duplicate segment: {name}')
+
+        if seed is None:
+            seed = self.seed_sequence.spawn(1)[0]
+
+        self.segments[name] = dict(length=length, num_lanes=num_lanes, vehicles=[] if vehicles is None else vehicles,
+                                   vehicle_factory=vehicle_factory, insertion_gap=insertion_gap,
+                                   insertion_chance=insertion_chance, seed=seed)
+
+    """
+        Connects the end of a segment to the start of another one.
+
+        Args:
+            upstream, downstream: names of the segments
+            lanes: dict that maps lanes of the upstream segment to lanes of the downstream segment, by default the
+                   lanes are aligned on the right (e.g. the single lane of an on-ramp leads to the rightmost lane),
+                   and the leftmost lanes of a wider upstream segment end in the leftmost downstream lane
+            fraction: share of the vehicles in the mapped lanes that takes this link (see Link)
+
+        Returns:
+            The Link
+    """
+    def connect(self, upstream, downstream, lanes=None, fraction=1.0):
+        if self.started:
+            raise RuntimeError('Segments can only be connected before the network is started')
+
+        upstream_lanes = self.segments[upstream]['num_lanes']
+        downstream_lanes = self.segments[downstream]['num_lanes']
+        if lanes is None:
+            offset = downstream_lanes - upstream_lanes
+            lanes = {lane: min(max(lane + offset, 0), downstream_lanes - 1) for lane in range(upstream_lanes)}
+
+        lanes = {int(lane): int(new_lane) for lane, new_lane in lanes.items()}
+        if not all(0 <= lane < upstream_lanes and 0 <= new_lane < downstream_lanes
+                   for lane, new_lane in lanes.items()):
+            raise ValueError(f'Invalid lanes for the link from {upstream} to {downstream}: {lanes}')
+
+        link = Link(upstream, downstream, lanes, fraction)
+        self.links.append(link)
+        for lane, new_lane in lanes.items():
+            self.routes.setdefault((upstream, lane), []).append((link, new_lane))
+            self.feeders.setdefault((downstream, new_lane), []).append((upstream, lane))
+
+        return link
+
+    def start(self):
+        """Create the segments, in the worker processes if there are any, the first update starts the network"""
+        if self.started:
+            return
+        self.started = True
+
+        # The models of all vehicles and factories, which the VehicleRecords refer to
+        models = []
+        for parameters in self.segments.values():
+            vehicle_factory = parameters['vehicle_factory']
+            candidates = [model for vehicle in parameters['vehicles']
+                          for model in (vehicle.traffic_model, vehicle.lane_change_model)]
+            if vehicle_factory is not None:
+                candidates += [vehicle_factory.default_traffic_model, vehicle_factory.default_lane_change_model]
+
+            for model in candidates:
+                if model is not None and all(model is not known for known in models):
+                    models.append(model)
+
+        self.models = models + [None]
+        model_indices = {id(model): i for i, model in enumerate(models)}
+        model_indices[id(None)] = -1
+
+        # Larger segments first, each to the worker with the least work so far
+        sizes = {name: parameters['length'] * parameters['num_lanes'] for name, parameters in self.segments.items()}
+        loads = [0] * max(self.num_workers, 1)
+        for name in sorted(sizes, key=sizes.get, reverse=True):
+            worker = loads.index(min(loads))
+            self.assignment[name] = worker
+            loads[worker] += sizes[name]
+
+        if self.num_workers > 0:
+            # Peek at the id the next new vehicle gets, the workers continue from it
+            first_vehicle_id = next(Vehicle.ids)
+            Vehicle.ids = count(first_vehicle_id)
+
+            for i in range(self.num_workers):
+                connection, worker_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=run_network_worker, daemon=True,
+                                                  args=(worker_connection, first_vehicle_id + i, self.num_workers))
+                process.start()
+                worker_connection.close()
+                self.workers.append((connection, process))
+
+        for name, parameters in self.segments.items():
+            vehicles = sorted(parameters['vehicles'], key=lambda x: x.position, reverse=True)
+            records = [VehicleRecord(vehicle.__class__, vehicle.vehicle_id, vehicle.position, vehicle.velocity,
+                                     vehicle.acceleration, vehicle.gap, vehicle.lane, vehicle.last_lane_change_time,
+                                     model_indices[id(vehicle.traffic_model)],
+                                     model_indices[id(vehicle.lane_change_model)]) for vehicle in vehicles]
+
+            vehicle_factory = parameters['vehicle_factory']
+            if vehicle_factory is not None:
+                # The factory is copied with its random number generator, but not with its pool or models
+                vehicle_factory = copy.deepcopy(vehicle_factory, {id(model): model for model in models})
+                vehicle_factory.pool = {}
+
+            random = (np.random.default_rng(parameters['seed']), [], 0)
+            self.request(name, 'add', name, (models, records, parameters['length'], parameters['num_lanes'],
+                                             vehicle_factory, parameters['insertion_gap'],
+                                             parameters['insertion_chance'], self.time_step, random))
+
+            num_lanes = parameters['num_lanes']
+            self.incoming[name] = []
+            self.first_vehicles[name] = [None] * num_lanes
+            self.last_vehicles[name] = [None] * num_lanes
+            for record in records:
+                if self.first_vehicles[name][record.lane] is None:
+                    self.first_vehicles[name][record.lane] = record
+                self.last_vehicles[name][record.lane] = record
+
+            self.vehicle_counts[name] = sum(not issubclass(record.vehicle_class, Obstacle) for record in records)
+            self.counters[name] = dict.fromkeys(COUNTERS, 0)
+
+    def send(self, worker, command, *args):
+        if self.num_workers == 0:
+            self.local_result = run_network_command(self.local_segments, command, args)
+        else:
+            self.workers[worker][0].send((command, args))
+
+    def receive(self, worker):
+        if self.num_workers == 0:
+            return self.local_result
+
+        result = self.workers[worker][0].recv()
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def request(self, name, command, *args):
+        worker = self.assignment[name]
+        self.send(worker, command, *args)
+        return self.receive(worker)
+
+    def get_ghosts(self, name):
+        """VehicleRecords of the ghosts of a segment, with their positions and lanes relative to the segment"""
+        length = self.segments[name]['length']
+        ghosts = []
+        for lane in range(self.segments[name]['num_lanes']):
+            # Ahead: the last vehicle of the lane this lane leads to, along the link with the largest fraction
+            routes = self.routes.get((name, lane))
+            if routes:
+                link, new_lane = max(routes, key=lambda route: route[0].fraction)
+                record = self.last_vehicles[link.downstream][new_lane]
+                if record is not None:
+                    ghosts.append(record._replace(position=record.position + length, lane=lane, lane_change_model=-1))
+
+                # The first vehicles of the other lanes that merge into the same lane
+                for upstream, upstream_lane in self.feeders[(link.downstream, new_lane)]:
+                    record = self.first_vehicles[upstream][upstream_lane]
+                    if record is None or (upstream, upstream_lane) == (name, lane):
+                        continue
+
+                    position = record.position
+                    if upstream != name:
+                        position += length - self.segments[upstream]['length']
+                    ghosts.append(record._replace(position=position, lane=lane, lane_change_model=-1))
+
+            # Behind: the first vehicle closest to the junction of the lanes that lead into this lane
+            behind = None
+            for upstream, upstream_lane in self.feeders.get((name, lane), ()):
+                record = self.first_vehicles[upstream][upstream_lane]
+                if record is not None:
+                    position = record.position - self.segments[upstream]['length']
+                    if behind is None or position > behind.position:
+                        behind = record._replace(position=position, lane=lane, lane_change_model=-1)
+
+            if behind is not None:
+                ghosts.append(behind)
+
+        return ghosts
+
+    def update(self, time):
+        self.start()
+
+        requests = [{} for _ in range(max(self.num_workers, 1))]
+        for name in self.segments:
+            requests[self.assignment[name]][name] = (self.incoming[name], self.get_ghosts(name))
+
+        # All workers update their segments at the same time
+        results = {}
+        if self.num_workers == 0:
+            results = run_network_command(self.local_segments, 'step', (time, requests[0]))
+        else:
+            for worker, worker_requests in enumerate(requests):
+                self.send(worker, 'step', time, worker_requests)
+            for worker in range(self.num_workers):
+                results.update(self.receive(worker))
+
+        self.incoming = {name: [] for name in self.segments}
+        handovers = []
+        for name in self.segments:
+            outgoing, (first_vehicles, last_vehicles), vehicle_count, counters = results[name]
+            self.first_vehicles[name] = first_vehicles
+            self.last_vehicles[name] = last_vehicles
+            self.vehicle_counts[name] = vehicle_count
+            self.add_counters(name, counters)
+
+            length = self.segments[name]['length']
+            for record in outgoing:
+                route = self.choose_route(name, record.lane)
+                if route is None:
+                    if not issubclass(record.vehicle_class, Obstacle):
+                        self.removed_vehicle_count += 1
+                    continue
+
+                link, new_lane = route
+                handovers.append((record.position - length, name, record, link.downstream, new_lane))
+
+        # The vehicles furthest ahead are handed over first, each behind the rear of the last vehicle in its lane
+        handovers.sort(key=lambda handover: handover[0], reverse=True)
+        for position, name, record, downstream, new_lane in handovers:
+            last_vehicle = self.last_vehicles[downstream][new_lane]
+            velocity = record.velocity
+            if last_vehicle is not None and position > last_vehicle.position - last_vehicle.vehicle_class.length:
+                position = last_vehicle.position - last_vehicle.vehicle_class.length
+                velocity = min(velocity, last_vehicle.velocity)
+
+            if position < 0:
+                # The lane has no room yet, the vehicle waits at the end of its segment
+                self.incoming[name].append(record._replace(position=position + self.segments[name]['length'],
+                                                           velocity=velocity))
+                continue
+
+            record = record._replace(position=position, velocity=velocity, lane=new_lane)
+            self.incoming[downstream].append(record)
+            self.last_vehicles[downstream][new_lane] = record
+
+        # The handed over vehicles are the last vehicles of their lanes, the vehicles that are held back can be the
+        # first ones
+        for name, records in self.incoming.items():
+            self.vehicle_counts[name] += sum(not issubclass(record.vehicle_class, Obstacle) for record in records)
+            first_vehicles = self.first_vehicles[name]
+            last_vehicles = self.last_vehicles[name]
+            for record in records:
+                if first_vehicles[record.lane] is None or record.position > first_vehicles[record.lane].position:
+                    first_vehicles[record.lane] = record
+                if last_vehicles[record.lane] is None or record.position <= last_vehicles[record.lane].position:
+                    last_vehicles[record.lane] = record
+
+    def choose_route(self, name, lane):
+        """The (link, downstream lane) a vehicle that reaches the end of a lane takes, None if it leaves the network"""
+        routes = self.routes.get((name, lane))
+        if not routes:
+            return None
+        if len(routes) == 1:
+            return routes[0]
+
+        fractions = np.cumsum([link.fraction for link, _ in routes])
+        return routes[min(int(np.searchsorted(fractions, self.random.random() * fractions[-1], side='right')),
+                          len(routes) - 1)]
+
+    def add_counters(self, name, counters):
+        for counter, value in counters.items():
+            if counter != 'removed_vehicle_count':
+                setattr(self, counter, getattr(self, counter) + value - self.counters[name][counter])
+        self.counters[name] = counters
+
+    def get_vehicles(self, name):
+        """List with a copy of the vehicles on a segment, sorted by decreasing position (without their links)"""
+        self.start()
+
+        vehicles = []
+        for record in self.request(name, 'call', name, 'get_vehicle_records', ()) + self.incoming[name]:
+            vehicle = record.vehicle_class.__new__(record.vehicle_class)
+            vehicle.vehicle_id, vehicle.position, vehicle.velocity, vehicle.acceleration, vehicle.gap, \
+                vehicle.lane, vehicle.last_lane_change_time = record[1:8]
+            vehicle.traffic_model = self.models[record.traffic_model]
+            vehicle.lane_change_model = self.models[record.lane_change_model]
+            vehicle.next_vehicle = None
+            vehicle.prev_vehicle = None
+            vehicles.append(vehicle)
+
+        vehicles.sort(key=lambda x: x.position, reverse=True)
+        return vehicles
+
+    def vehicle_count(self, name=None):
+        """Number of vehicles on a segment, or on the whole network if name is None"""
+        if name is None:
+            return sum(self.vehicle_counts.values())
+
+        return self.vehicle_counts[name]
+
+    def add_obstacle(self, name, lane, at_position):
+        self.start()
+        if not 0 <= lane < self.segments[name]['num_lanes']:
+            return
+
+        worker = self.assignment[name]
+        self.send(worker, 'allocate_vehicle_id')
+        record = VehicleRecord(Obstacle, self.receive(worker), at_position, 0, 0, math.inf, lane, 0, -1, -1)
+        self.first_vehicles[name], self.last_vehicles[name] = self.request(name, 'call', name, 'add_segment_obstacle',
+                                                                           (record,))
+
+    def remove_obstacle(self, name, lane, at_position):
+        self.start()
+        if not 0 <= lane < self.segments[name]['num_lanes']:
+            return
+
+        self.first_vehicles[name], self.last_vehicles[name] = self.request(
+            name, 'call', name, 'remove_segment_obstacle', (lane, at_position))
+
+    def close(self):
+        """Stop the worker processes"""
+        for connection, process in self.workers:
+            connection.send(('close', None))
+            process.join()
+            connection.close()
+
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
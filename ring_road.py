@@ -0,0 +1,333 @@
+from road import Road
+from vehicle_arrays import VehicleArrays
+from vehicle_factory import VehicleFactory
+from scenario import TRAFFIC_MODELS, spawn_seeds
+from vehicle import *
+import argparse
+import csv
+
+import numpy as np
+
+
+class RingRoad:
+    """
+    Closed ring road with a fixed number of vehicles, for experiments at a fixed density such as measuring the
+    fundamental diagram or the growth of stop-and-go waves. Positions wrap around at the length of the road, and the
+    leader of the front vehicle of a lane is the last vehicle of that lane, so no vehicles are inserted or removed.
+
+    Every lane is a ring of its own: vehicles do not change lanes on a ring road, so the order of the vehicles in a lane
+    never changes and their leaders are fixed. The state is kept in NumPy arrays (see VehicleArrays) that are allocated
+    once, grouped by traffic model, and every update works in place on these arrays and views of them: no vehicles,
+    lists or state arrays are created or freed while the road is updated, only the temporaries of the batched
+    traffic models.
+
+    The Vehicle objects stay available through the vehicles attribute, in the order of the arrays (not sorted by
+    position), and are brought up to date the first time it is accessed after an update. Their next_vehicle and
+    prev_vehicle links form a cycle in each lane.
+
+    Args:
+        length: length of the ring [m]
+        vehicles: vehicles on the ring, with positions in [0, length), obstacles are not supported
+        num_lanes: number of lanes (independent rings) the road has
+        time_step: time step for the simulation
+    """
+    def __init__(self, length, vehicles, num_lanes=1, time_step=Road.DEFAULT_TIME_STEP):
+        if not vehicles:
+            raise ValueError('A ring road needs at least one vehicle')
+        if any(isinstance(vehicle, Obstacle) for vehicle in vehicles):
+            raise ValueError('Obstacles are not supported on a ring road')
+        if any(not 0 <= vehicle.lane < num_lanes for vehicle in vehicles):
+            raise ValueError(f'The vehicles of a ring road with {num_lanes} lanes must be in lanes 0 to '
+                             f'{num_lanes - 1}')
+
+        self.length = length
+        self.num_lanes = num_lanes
+        self.time_step = time_step
+        # Vehicles never leave a ring
+        self.removed_vehicle_count = 0
+
+        self.traffic_models = []
+        arrays = VehicleArrays(vehicles, self.traffic_models)
+        arrays.positions %= length
+
+        # Vehicles with the same traffic model are stored next to each other, so each model updates a slice (a view)
+        order = np.lexsort((-arrays.positions, arrays.lanes, arrays.model_ids))
+        self._vehicles = [vehicles[i] for i in order.tolist()]
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, getattr(arrays, attribute)[order])
+
+        model_ids = self.model_ids
+        self.model_slices = [(traffic_model, slice(*np.searchsorted(model_ids, [model_id, model_id + 1])))
+                             for model_id, traffic_model in enumerate(self.traffic_models)]
+
+        self.leaders, self.lap_offsets = self.find_leaders()
+        self.leader_lengths = self.lengths[self.leaders]
+        # Number of times each vehicle passed the end of the ring
+        self.laps = np.zeros(self.positions.size, dtype=int)
+
+        # Buffers of the update
+        self.next_velocities = np.empty(self.positions.size)
+        self.changes = np.empty(self.positions.size)
+        self.wrapped = np.empty(self.positions.size, dtype=bool)
+        self.lap_differences = np.empty(self.positions.size, dtype=int)
+
+        self.update_gaps()
+
+        vehicles = self._vehicles
+        for vehicle, leader in zip(vehicles, self.leaders.tolist()):
+            vehicle.next_vehicle = vehicles[leader]
+            vehicles[leader].prev_vehicle = vehicle
+        self._stale_vehicles = True
+
+    def find_leaders(self):
+        """Index of the leader of every vehicle, the vehicle in front of it in its lane or, for the front vehicle, the
+        last vehicle of the lane, and the number of laps the leader is ahead at the start (1 for the front vehicles, 0
+        for the others)"""
+        lane_order = np.lexsort((-self.positions, self.lanes))
+        lanes = self.lanes[lane_order]
+        # The leader of each vehicle is the previous vehicle in its lane, shifted by one place within every lane
+        starts = np.flatnonzero(np.r_[True, lanes[1:] != lanes[:-1]])
+        ends = np.r_[starts[1:], lanes.size]
+
+        previous = np.arange(lanes.size) - 1
+        previous[starts] = ends - 1
+
+        leaders = np.empty(lanes.size, dtype=int)
+        leaders[lane_order] = lane_order[previous]
+        lap_offsets = np.zeros(lanes.size, dtype=int)
+        lap_offsets[lane_order[starts]] = 1
+
+        return leaders, lap_offsets
+
+    @property
+    def vehicles(self):
+        if self._stale_vehicles:
+            self.sync_vehicles()
+
+        return self._vehicles
+
+    def sync_vehicles(self):
+        """Write the array state back to the Vehicle objects"""
+        for vehicle, position, velocity, acceleration, gap in zip(
+                self._vehicles, self.positions.tolist(), self.velocities.tolist(), self.accelerations.tolist(),
+                self.gaps.tolist()):
+            vehicle.position = position
+            vehicle.velocity = velocity
+            vehicle.acceleration = acceleration
+            vehicle.gap = gap
+
+        self._stale_vehicles = False
+
+    def update(self, time):
+        self.update_accelerations()
+        self.update_positions_velocities()
+        self._stale_vehicles = True
+
+    def update_accelerations(self):
+        np.take(self.velocities, self.leaders, out=self.next_velocities)
+        for traffic_model, vehicles in self.model_slices:
+            self.accelerations[vehicles] = traffic_model.calculate_accelerations(
+                self.velocities[vehicles], self.gaps[vehicles], self.next_velocities[vehicles],
+                self.desired_velocities[vehicles], self.desired_time_headways[vehicles],
+                self.max_accelerations[vehicles], self.comfortable_decelerations[vehicles])
+
+    def update_positions_velocities(self):
+        changes = self.changes
+        np.multiply(self.time_step, self.velocities, out=changes)
+        self.positions += changes
+
+        np.multiply(self.time_step, self.accelerations, out=changes)
+        self.velocities += changes
+        np.maximum(self.velocities, 0, out=self.velocities)
+
+        # Vehicles that passed the end of the ring continue at its start
+        np.greater_equal(self.positions, self.length, out=self.wrapped)
+        np.subtract(self.positions, self.length, out=self.positions, where=self.wrapped)
+        self.laps += self.wrapped
+
+        self.update_gaps()
+
+    def update_gaps(self):
+        gaps = self.gaps
+        np.take(self.positions, self.leaders, out=gaps)
+        gaps -= self.positions
+
+        # The distance to a leader that is a lap ahead (e.g. the leader of the front vehicle, until one of them passes
+        # the end of the ring) includes the length of the ring, a follower that passed its leader gets a negative gap
+        lap_differences = self.lap_differences
+        np.take(self.laps, self.leaders, out=lap_differences)
+        lap_differences -= self.laps
+        lap_differences += self.lap_offsets
+        np.multiply(lap_differences, self.length, out=self.changes)
+        gaps += self.changes
+        gaps -= self.leader_lengths
+
+    def lane_vehicle_counts(self):
+        return np.bincount(self.lanes, minlength=self.num_lanes)
+
+    def lane_mean_speeds(self):
+        """Mean velocity of the vehicles in each lane [m/s], nan for lanes without vehicles"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (np.bincount(self.lanes, weights=self.velocities, minlength=self.num_lanes)
+                    / self.lane_vehicle_counts())
+
+    def lane_speed_deviations(self):
+        """Standard deviation of the velocities in each lane [m/s], which grows when stop-and-go waves form"""
+        counts = self.lane_vehicle_counts()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_squares = np.bincount(self.lanes, weights=self.velocities ** 2, minlength=self.num_lanes) / counts
+            return np.sqrt(np.maximum(mean_squares - self.lane_mean_speeds() ** 2, 0))
+
+    def lane_flows(self):
+        """Traffic flow in each lane [vehicles/hour], the density times the mean speed, which on a ring equals the
+        number of vehicles that pass any position per hour averaged over the ring"""
+        return np.bincount(self.lanes, weights=self.velocities, minlength=self.num_lanes) / self.length * 3600
+
+    def vehicle_density(self):
+        return self.positions.size / self.length
+
+    """
+        Args:
+            at_position: position at which to measure the traffic flow [m]
+            current_time: current time elapsed in the simulation
+
+        Returns:
+            The current traffic flow of all lanes together [vehicles/hour], see lane_flows, or -1 if the position is
+            not on the ring
+    """
+    def get_traffic_flow(self, at_position, current_time):
+        if not 0 <= at_position <= self.length:
+            return -1
+
+        return float(self.lane_flows().sum())
+
+
+"""
+    Creates vehicles evenly spaced around a lane of a ring road.
+
+    Args:
+        vehicle_factory: factory that creates the random vehicles
+        num: number of vehicles
+        length: length of the ring [m]
+        lane: lane of the vehicles
+        velocity: initial velocity of the vehicles [m/s]
+        perturbation: distance [m] the first vehicle is moved back, on a ring of identical vehicles that start evenly
+                      spaced nothing else breaks the symmetry that keeps stop-and-go waves from forming
+
+    Returns:
+        List of the vehicles
+"""
+def create_ring_vehicles(vehicle_factory, num, length, lane=0, velocity=0, perturbation=0):
+    vehicles = vehicle_factory.create_random_vehicles(num)
+    spacing = length / num
+    for i, vehicle in enumerate(vehicles):
+        vehicle.position = i * spacing
+        vehicle.velocity = velocity
+        vehicle.lane = lane
+
+    if vehicles:
+        vehicles[0].position = (vehicles[0].position - perturbation) % length
+
+    return vehicles
+
+
+"""
+    Measures the fundamental diagram on a ring road: every density gets a lane of its own on a single RingRoad, so all
+    densities are simulated together as one batch. The density, speed and flow of every lane are sampled like
+    sweep.run_scenario does.
+
+    Args:
+        densities: densities to simulate [vehicles/km/lane], each one is rounded to a whole number of vehicles
+        length: length of the ring [m]
+        traffic_model: name of the longitudinal traffic model, see scenario.TRAFFIC_MODELS
+        weights: VehicleFactory weights for Cars, Trucks, AggressiveCars and PassiveCars
+        duration: simulated time [s]
+        warmup: time [s] before the speed and flow are sampled
+        sample_interval: time [s] between two samples
+        time_step: time step for the simulation
+        perturbation: distance [m] the first vehicle of every lane is moved back, see create_ring_vehicles
+        seed: seed of the random number generator of the vehicle factory
+        vehicle_factory: VehicleFactory that creates the vehicles instead, with its own weights and traffic model
+
+    Returns:
+        List with a dict of metrics for each density:
+            density: density of the lane [vehicles/km], after rounding to whole vehicles
+            vehicle_count: number of vehicles in the lane
+            flow: mean traffic flow [vehicles/hour]
+            mean_speed: mean velocity of the vehicles [m/s]
+            speed_deviation: mean standard deviation of the velocities of the vehicles [m/s]
+"""
+def run_density_sweep(densities, length=1000, traffic_model='IDM', weights=(1, 0, 0, 0), duration=600, warmup=300,
+                      sample_interval=10, time_step=Road.DEFAULT_TIME_STEP, perturbation=1, seed=0,
+                      vehicle_factory=None):
+    if len(densities) == 0:
+        raise ValueError('A density sweep needs at least one density')
+    if min(densities) <= 0:
+        raise ValueError('The densities of a density sweep must be positive')
+
+    if vehicle_factory is None:
+        _, factory_seed = spawn_seeds(seed)
+        vehicle_factory = VehicleFactory(list(weights), TRAFFIC_MODELS[traffic_model](time_step), None,
+                                         seed=factory_seed)
+
+    counts = [max(int(round(density * length / 1000)), 1) for density in densities]
+    vehicles = []
+    for lane, count in enumerate(counts):
+        vehicles += create_ring_vehicles(vehicle_factory, count, length, lane=lane, perturbation=perturbation)
+
+    road = RingRoad(length, vehicles, num_lanes=len(counts), time_step=time_step)
+
+    samples = []
+    next_sample_time = warmup
+    for time in np.arange(0, duration, time_step):
+        road.update(time)
+
+        if time >= next_sample_time:
+            next_sample_time += sample_interval
+            samples.append((road.lane_flows(), road.lane_mean_speeds(), road.lane_speed_deviations()))
+
+    if samples:
+        flows, speeds, deviations = (np.mean(column, axis=0) for column in zip(*samples))
+    else:
+        flows = speeds = deviations = np.full(len(counts), math.nan)
+
+    return [{
+        'density': count / length * 1000,
+        'vehicle_count': count,
+        'flow': float(flows[lane]),
+        'mean_speed': float(speeds[lane]),
+        'speed_deviation': float(deviations[lane]),
+    } for lane, count in enumerate(counts)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the fundamental diagram on a ring road.')
+    parser.add_argument('--densities', type=float, nargs=3, default=[5, 150, 5], metavar=('START', 'STOP', 'STEP'),
+                        help='range of densities [vehicles/km/lane], STOP is included')
+    parser.add_argument('--length', type=float, default=1000, help='length of the ring [m]')
+    parser.add_argument('--traffic-model', default='IDM', choices=sorted(TRAFFIC_MODELS))
+    parser.add_argument('--weights', type=float, nargs=4, default=[1, 0, 0, 0],
+                        help='weights of Cars, Trucks, AggressiveCars and PassiveCars')
+    parser.add_argument('--duration', type=float, default=600, help='simulated time [s]')
+    parser.add_argument('--warmup', type=float, default=300, help='time [s] before the flow is sampled')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='fundamental_diagram.csv', help='CSV file the results are written to')
+    args = parser.parse_args()
+
+    start, stop, step = args.densities
+    results = run_density_sweep(np.arange(start, stop + step / 2, step), length=args.length,
+                                traffic_model=args.traffic_model, weights=args.weights, duration=args.duration,
+                                warmup=args.warmup, seed=args.seed)
+
+    with open(args.output, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+    capacity = max(results, key=lambda result: result['flow'])
+    print(f'Simulated {len(results)} densities, the highest flow is {capacity["flow"]:.0f} vehicles/hour at '
+          f'{capacity["density"]:.1f} vehicles/km, results are in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
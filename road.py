@@ -1,13 +1,46 @@
 from vehicle_factory import VehicleFactory
+from lane_index import LaneIndex, bisect_position
+from vehicle_arrays import VehicleArrays
+from lane_change_models import LaneChangeCandidates
+from loop_detector import LoopDetector
 from vehicle import *
+from collections import namedtuple
+from functools import partial
+from itertools import repeat
+from operator import attrgetter
+import numpy as np
 import random
 
 
+"""
+IdleLaneChanges represent the lane changes that are not evaluated until something changes, each field is an array with
+one entry per lane change:
+    keys: identifies the vehicle (by its vehicle_id) and the lane it considers changing to
+    neighbours: the current next, potential new next, current previous and potential new previous vehicle, the lane
+                change is evaluated again if one of them changes
+    accelerations: acceleration of the vehicle when the lane change was rejected
+    wake_times: time at which the lane change is evaluated again regardless
+"""
+IdleLaneChanges = namedtuple('IdleLaneChanges', ['keys', 'neighbours', 'accelerations', 'wake_times'])
+
+
 class Road:
     DEFAULT_NUM_LANES = 1
     DEFAULT_TIME_STEP = 0.5
     DEFAULT_INSERTION_GAP = 10
     DEFAULT_INSERTION_CHANCE = 0.5
+    DEFAULT_LANE_CHANGE_RECHECK_INTERVAL = 0
+
+    # Number of insertion decisions drawn from the random number generator at once
+    RANDOM_BLOCK_SIZE = 4096
+
+    # Change in acceleration [m/s^2] after which an idle vehicle is considered for lane changes again
+    IDLE_ACCELERATION_TOLERANCE = 0.1
+
+    # Columns of VehicleArrays that only change when a vehicle enters or leaves the road or changes lanes, which are
+    # kept in vehicle_table instead of being gathered from the vehicles in every step
+    TABLE_COLUMNS = ('lanes', 'last_lane_change_times', 'lengths', 'desired_velocities', 'desired_time_headways',
+                     'max_accelerations', 'comfortable_decelerations', 'obstacles', 'model_ids', 'lane_change_model_ids')
 
     """
     Args:
@@ -15,16 +48,27 @@ class Road:
         num_lanes: number of lanes the road has
         vehicles: list of vehicles sorted by their longitudinal position on the road, in decreasing order
                   i.e. the first vehicle on the road has index 0, the vehicle behind it has index 1 and so on
+                  the vehicles are also indexed per lane in lane_index and have a row in vehicle_table, which have to
+                  be kept up to date when vehicles are added, removed or change lanes
         vehicle_factory: object used to generate new vehicles, if None no new vehicles are generated
+                         the vehicles that leave the road are released to it, and reused if it has a pool size (see
+                         VehicleFactory), in which case no references to them may be kept
         time_step: time step for the simulation
+        lane_change_recheck_interval: maximum time [s] a vehicle whose lane changes were rejected is left out of the
+                                      lane change evaluation while its neighbourhood does not change, 0 to evaluate
+                                      every vehicle that is not on cooldown in each time step
+        seed: seed of the random number generator that decides when vehicles are inserted (anything
+              numpy.random.default_rng accepts), if None the seed is drawn from the global random module
     """
     def __init__(self, length, num_lanes=DEFAULT_NUM_LANES, vehicles=None, vehicle_factory: VehicleFactory = None,
                  insertion_gap=DEFAULT_INSERTION_GAP, insertion_chance=DEFAULT_INSERTION_CHANCE,
-                 time_step=DEFAULT_TIME_STEP):
+                 time_step=DEFAULT_TIME_STEP, lane_change_recheck_interval=DEFAULT_LANE_CHANGE_RECHECK_INTERVAL,
+                 seed=None):
         self.length = length
         self.num_lanes = num_lanes
 
         self.vehicles = [] if vehicles is None else vehicles
+        self.lane_index = LaneIndex(num_lanes, self.vehicles)
         self.sort_vehicles()
 
         self.vehicle_factory = vehicle_factory
@@ -33,120 +77,720 @@ class Road:
         self.insertion_chance = insertion_chance
         self.time_step = time_step
 
+        self.random = np.random.default_rng(random.getrandbits(64) if seed is None else seed)
+        # Uniform random numbers that were drawn for the insertion decisions, the ones before the position are used
+        self.random_block = []
+        self.random_position = 0
+
         self.removed_vehicle_count = 0
+        self.inserted_vehicle_count = 0
+        self.acceleration_update_count = 0
+        # Number of acceleration updates that took the free road path, see update_accelerations
+        self.free_flow_update_count = 0
+        # Interaction horizon of each combination of traffic model and vehicle class, see get_interaction_horizon
+        self.interaction_horizons = {}
+
+        self.lane_change_recheck_interval = lane_change_recheck_interval
+        self.idle_lane_changes = None
+
+        # Time before which no vehicle can change lanes (never later than the actual time) and number of possible lane
+        # changes of the vehicles that can change lanes, see skip_lane_changes
+        self.next_lane_change_time = -math.inf
+        self.lane_change_option_count = 0
+        # VehicleArrays with the TABLE_COLUMNS of the vehicles on the road in the rows given by vehicle_rows (a dict
+        # with the row of each vehicle), built by the first lane change evaluation, see vehicle_arrays
+        self.vehicle_table = None
+        self.vehicle_rows = None
+        self.free_rows = []
+
+        # Number of lane change evaluations performed, and skipped because of the cooldown or an unchanged neighbourhood
+        self.lane_change_evaluation_count = 0
+        self.cooldown_skip_count = 0
+        self.idle_skip_count = 0
+        # Number of lane changes evaluated again (one by one) because an earlier lane change changed their inputs
+        self.lane_change_reevaluation_count = 0
+        self.lane_change_count = 0
+
+        # Optional Instrumentation that times the phases of update, see instrumentation.py
+        self.instrumentation = None
+        # Optional IncidentSchedule that starts and ends incidents while the road is updated, see incidents.py
+        self.incident_schedule = None
+        # Optional EventLog that records the decisions made in the updates, or from which they are replayed, see
+        # event_log.py
+        self.event_log = None
+
+        # LoopDetectors that count the vehicles crossing them, see add_detector
+        self.detectors = []
+        # SpaceTimeGrids that aggregate the traffic on the road, see space_time_grid.py
+        self.space_time_grids = []
 
     def update(self, time):
-        self.update_accelerations()
-        self.change_lanes(time)
-        self.update_positions_velocities()
+        # A replaying road takes the obstacle edits of the incidents from its event log
+        if self.incident_schedule is not None and (self.event_log is None or not self.event_log.replaying):
+            self.incident_schedule.update(time)
 
-        self.sort_vehicles()
+        if self.event_log is not None:
+            self.event_log.begin_step(time)
+
+        if self.instrumentation is not None:
+            self.instrumentation.update(time)
+            return
+
+        for _, update_phase in self.get_update_phases(time):
+            update_phase()
 
-        self.generate_new_vehicles(time)
+    def get_update_phases(self, time):
+        """The phases of update in the order they run, as (name, function) tuples, through which Instrumentation times
+        them as well"""
+        return (('update_accelerations', self.update_accelerations),
+                ('change_lanes', partial(self.change_lanes, time)),
+                ('update_positions_velocities', self.update_positions_velocities),
+                ('generate_new_vehicles', partial(self.generate_new_vehicles, time)))
 
     def update_accelerations(self):
+        self.acceleration_update_count += len(self.vehicles)
+        interaction_horizons = self.interaction_horizons
         for vehicle in self.vehicles:
+            # A vehicle far enough behind its leader drives as on a free road, which is cheaper to compute (and gives
+            # exactly the same acceleration)
+            if vehicle.next_vehicle is not None and vehicle.velocity <= vehicle.desired_velocity:
+                traffic_model = vehicle.traffic_model
+                horizon = interaction_horizons.get((traffic_model, vehicle.__class__))
+                if horizon is None:
+                    horizon = self.get_interaction_horizon(traffic_model, vehicle.__class__)
+
+                if vehicle.gap >= horizon:
+                    self.free_flow_update_count += 1
+                    vehicle.acceleration = traffic_model.calculate_free_road_acceleration(vehicle)
+                    continue
+
             vehicle.update_acceleration()
 
+    def get_interaction_horizon(self, traffic_model, vehicle_class):
+        """Gap beyond which the leader does not influence the acceleration, NaN (which no gap reaches) for obstacles and
+        models without a free road path"""
+        if (traffic_model is None or issubclass(vehicle_class, Obstacle)
+                or not hasattr(traffic_model, 'calculate_free_road_acceleration')):
+            horizon = math.nan
+        else:
+            horizon = traffic_model.interaction_horizon(vehicle_class)
+
+        self.interaction_horizons[(traffic_model, vehicle_class)] = horizon
+        return horizon
+
     def change_lanes(self, time):
-        for i, vehicle in enumerate(self.vehicles):
-            if vehicle.lane_change_model is None or isinstance(vehicle, Obstacle):
+        if self.num_lanes < 2:
+            return
+
+        if self.event_log is not None and self.event_log.replaying:
+            self.replay_lane_changes(time)
+            return
+
+        if self.skip_lane_changes(time):
+            return
+
+        state = self.vehicle_arrays()
+        self.update_lane_change_schedule(state)
+
+        candidates = self.find_lane_change_candidates(state, time)
+
+        if self.lane_change_recheck_interval > 0:
+            idle_lane_changes = self.find_idle_lane_changes(state, candidates)
+            active = np.flatnonzero(idle_lane_changes.wake_times <= time)
+            self.idle_skip_count += candidates.vehicles.size - active.size
+            candidates = LaneChangeCandidates(*(field[active] for field in candidates))
+
+        self.lane_change_evaluation_count += candidates.vehicles.size
+        decisions = self.decide_lane_changes(state, candidates, time)
+        stale = self.apply_lane_changes(candidates, decisions, time)
+
+        if self.lane_change_recheck_interval > 0:
+            # Vehicles whose lane changes were rejected become idle, unless their neighbourhood already changed
+            rejected = active[~decisions & ~stale]
+            idle_lane_changes.accelerations[active] = state.accelerations[candidates.vehicles]
+            idle_lane_changes.wake_times[rejected] = time + self.lane_change_recheck_interval
+            idle = np.flatnonzero(idle_lane_changes.wake_times > time)
+            idle = idle[np.argsort(idle_lane_changes.keys[idle])]
+            self.idle_lane_changes = IdleLaneChanges(*(field[idle] for field in idle_lane_changes))
+
+    """
+        Skips the lane change evaluation of a time step in which no vehicle can change lanes, before any state is
+        gathered: vehicles without a lane change model never can, the others not while they are on cooldown. The
+        skipped lane changes of the vehicles on cooldown are counted like in an evaluation.
+
+        The vehicles are not looked at, instead next_lane_change_time and lane_change_option_count are kept up to date
+        as vehicles enter, leave and change lanes (see track_vehicle), and recomputed in every evaluation.
+
+        Returns:
+            Whether the evaluation is skipped
+    """
+    def skip_lane_changes(self, time):
+        if not self.vehicles:
+            return True
+
+        if time < self.next_lane_change_time:
+            self.cooldown_skip_count += self.lane_change_option_count
+            return True
+
+        return False
+
+    def update_lane_change_schedule(self, state):
+        """Recompute next_lane_change_time and lane_change_option_count from the state of all vehicles"""
+        can_change = state.lane_change_model_ids >= 0
+        self.lane_change_option_count = self.count_lane_change_options(state.lanes[can_change])
+
+        # Half a time step early, so rounding never delays an evaluation
+        ready_times = state.last_lane_change_times + self.get_min_last_change_deltas(state)
+        self.next_lane_change_time = np.min(ready_times, initial=math.inf) - self.time_step / 2
+
+    """
+        Keeps the bookkeeping of the lane changes up to date when a vehicle enters or leaves the road: the row of the
+        vehicle in vehicle_table, next_lane_change_time and lane_change_option_count.
+
+        Args:
+            vehicle: the vehicle, in the lane in which it enters or leaves
+            count: 1 when the vehicle enters the road, -1 when it leaves
+    """
+    def track_vehicle(self, vehicle, count=1):
+        if self.vehicle_table is not None:
+            if count > 0:
+                self.add_table_row(vehicle)
+            else:
+                self.free_rows.append(self.vehicle_rows.pop(vehicle))
+
+        self.track_lane_change_options(vehicle, count)
+
+    def track_lane_change_options(self, vehicle, count=1):
+        """Add the possible lane changes of a vehicle in its lane to lane_change_option_count (count 1), or remove them
+        (count -1), if it can change lanes"""
+        if vehicle.lane_change_model is None or isinstance(vehicle, Obstacle):
+            return
+
+        lane = vehicle.lane
+        self.lane_change_option_count += count * (int(self.are_adjacent_lanes(lane, lane - 1))
+                                                  + int(self.are_adjacent_lanes(lane, lane + 1)))
+        if count > 0:
+            ready_time = vehicle.last_lane_change_time + vehicle.lane_change_model.MIN_LAST_CHANGE_DELTA
+            self.next_lane_change_time = min(self.next_lane_change_time, ready_time - self.time_step / 2)
+
+    def get_min_last_change_deltas(self, state):
+        """Cooldown of each vehicle after a lane change, inf for the vehicles that cannot change lanes"""
+        min_last_change_deltas = [model.MIN_LAST_CHANGE_DELTA for model in state.lane_change_models]
+        return np.array(min_last_change_deltas + [math.inf])[state.lane_change_model_ids]
+
+    def count_lane_change_options(self, lanes):
+        """Number of possible lane changes to an adjacent lane of vehicles in the given lanes"""
+        return (int(np.count_nonzero(self.are_adjacent_lanes(lanes, lanes - 1)))
+                + int(np.count_nonzero(self.are_adjacent_lanes(lanes, lanes + 1))))
+
+    """
+        Args:
+            state: VehicleArrays with the state of the vehicles on the road
+            time: current time elapsed in the simulation
+
+        Returns:
+            LaneChangeCandidates with every possible lane change to an adjacent lane, in the order of the vehicle list,
+            the lane to the left of a vehicle is considered before the lane to its right
+            vehicles that are on cooldown, i.e. changed lanes less than MIN_LAST_CHANGE_DELTA ago, are left out
+    """
+    def find_lane_change_candidates(self, state, time):
+        num = state.positions.size
+        next_vehicles, prev_vehicles = self.vehicle_links()
+        can_change = state.lane_change_model_ids >= 0
+
+        # Note: lanes are indexed from left to right
+        vehicles = np.repeat(np.arange(num), 2)
+        new_lanes = state.lanes[vehicles] + np.tile([-1, 1], num)
+
+        # Check if the new lane is valid
+        valid = can_change[vehicles] & self.are_adjacent_lanes(state.lanes[vehicles], new_lanes)
+
+        # The last lane change time tells when a vehicle on cooldown can change lanes again, so it is not evaluated
+        on_cooldown = time - state.last_lane_change_times < self.get_min_last_change_deltas(state)
+
+        self.cooldown_skip_count += int(np.count_nonzero(valid & on_cooldown[vehicles]))
+        valid &= ~on_cooldown[vehicles]
+        vehicles = vehicles[valid]
+        new_lanes = new_lanes[valid]
+
+        new_next_vehicles, new_prev_vehicles = self.find_lane_neighbours(state, vehicles, new_lanes)
+
+        return LaneChangeCandidates(vehicles, new_lanes, next_vehicles[vehicles], new_next_vehicles,
+                                    prev_vehicles[vehicles], new_prev_vehicles)
+
+    def are_adjacent_lanes(self, lanes, new_lanes):
+        """Whether each of the new lanes (next to the current lanes) is a lane of the road"""
+        return (new_lanes >= 0) & (new_lanes < self.num_lanes)
+
+    """
+        Args:
+            state: VehicleArrays with the state of the vehicles on the road
+            vehicles: index array of the vehicles that consider changing lanes
+            new_lanes: array with the lane each vehicle considers changing to
+
+        Returns:
+            Tuple of index arrays with the next and previous vehicle each vehicle would have in its new lane, -1 if
+            there is none
+    """
+    def find_lane_neighbours(self, state, vehicles, new_lanes):
+        # The vehicle list is sorted, so the vehicles in a lane are sorted as well and their neighbours can be found
+        # with a binary search
+        new_next_vehicles = np.full(vehicles.size, -1)
+        new_prev_vehicles = np.full(vehicles.size, -1)
+        for lane in range(self.num_lanes):
+            to_lane = new_lanes == lane
+            if not to_lane.any():
                 continue
 
-            # Note: lanes are indexed from left to right
-            new_lanes = [vehicle.lane - 1, vehicle.lane + 1]
-            for new_lane in new_lanes:
-                # Check if the new lane is valid
-                if not 0 <= new_lane < self.num_lanes:
+            in_lane = np.flatnonzero(state.lanes == lane)
+            i = np.searchsorted(-state.positions[in_lane], -state.positions[vehicles[to_lane]])
+            in_lane = np.concatenate(([-1], in_lane, [-1]))
+            new_next_vehicles[to_lane] = in_lane[i]
+            new_prev_vehicles[to_lane] = in_lane[i + 1]
+
+        return new_next_vehicles, new_prev_vehicles
+
+    """
+        Matches the candidates against the lane changes that were rejected in earlier time steps. A candidate stays idle
+        until its wake time, as long as the vehicle has the same current and potential new neighbours and its
+        acceleration did not change by more than IDLE_ACCELERATION_TOLERANCE.
+
+        Returns:
+            IdleLaneChanges with an entry for each candidate, the wake time is -inf for candidates that are not idle
+    """
+    def find_idle_lane_changes(self, state, candidates):
+        ids = np.append(self.vehicle_ids(), -1)
+
+        keys = ids[candidates.vehicles] * self.num_lanes + candidates.new_lanes
+        neighbours = np.stack([ids[candidates.old_next_vehicles], ids[candidates.new_next_vehicles],
+                               ids[candidates.old_prev_vehicles], ids[candidates.new_prev_vehicles]], axis=1)
+        accelerations = state.accelerations[candidates.vehicles]
+        wake_times = np.full(keys.size, -math.inf)
+
+        previous = self.idle_lane_changes
+        if previous is not None and previous.keys.size > 0:
+            i = np.minimum(np.searchsorted(previous.keys, keys), previous.keys.size - 1)
+            idle = ((previous.keys[i] == keys) & (previous.neighbours[i] == neighbours).all(axis=1)
+                    & (np.abs(previous.accelerations[i] - accelerations) <= self.IDLE_ACCELERATION_TOLERANCE))
+
+            accelerations[idle] = previous.accelerations[i[idle]]
+            wake_times[idle] = previous.wake_times[i[idle]]
+
+        return IdleLaneChanges(keys, neighbours, accelerations, wake_times)
+
+    """
+        Evaluates all candidate lane changes at once with the batched will_change_lanes of the lane change models.
+
+        Returns:
+            Boolean array with for each candidate whether the vehicle will change lanes
+    """
+    def decide_lane_changes(self, state, candidates, time):
+        model_ids = state.lane_change_model_ids[candidates.vehicles]
+        decisions = np.zeros(candidates.vehicles.size, dtype=bool)
+        if decisions.size == 0:
+            return decisions
+
+        for model_id, lane_change_model in enumerate(state.lane_change_models):
+            # Every candidate has a lane change model, so with a single model all of them use it
+            if len(state.lane_change_models) == 1:
+                mask = slice(None)
+            else:
+                mask = model_ids == model_id
+                if not mask.any():
                     continue
 
-                new_next_vehicle = self.get_next_vehicle(new_lane, i)
-                new_prev_vehicle = self.get_prev_vehicle(new_lane, i)
+            decisions[mask] = lane_change_model.will_change_lanes(
+                state, candidates.vehicles[mask], candidates.new_lanes[mask], candidates.old_next_vehicles[mask],
+                candidates.new_next_vehicles[mask], candidates.old_prev_vehicles[mask],
+                candidates.new_prev_vehicles[mask], time)
+
+        return decisions
+
+    """
+        Applies the accepted lane changes in order. A later candidate whose inputs are changed by a lane change is
+        evaluated again when it is reached, so conflicting lane changes (e.g. into the same gap) are resolved exactly
+        as if the vehicles were handled one by one.
+
+        Args:
+            stale: optional boolean array with the candidates whose inputs were already changed before the first
+                   candidate is reached (by lane changes applied elsewhere), these are evaluated again as well
+
+        Returns:
+            Boolean array with for each candidate whether it was evaluated again
+    """
+    def apply_lane_changes(self, candidates, decisions, time, stale=None):
+        vehicles = self.vehicles
+        indices = None
 
-                if vehicle.will_change_lane(new_lane, new_next_vehicle, new_prev_vehicle, time):
-                    if vehicle.prev_vehicle is not None:
-                        vehicle.prev_vehicle.next_vehicle = vehicle.next_vehicle
+        stale = np.zeros(decisions.size, dtype=bool) if stale is None else stale.copy()
+        pending = decisions | stale
+        changed_vehicles = set()
 
-                    if vehicle.next_vehicle is not None:
-                        vehicle.next_vehicle.prev_vehicle = vehicle.prev_vehicle
+        start = 0
+        while True:
+            remaining = np.flatnonzero(pending[start:])
+            if remaining.size == 0:
+                break
 
-                    vehicle.change_lane(new_next_vehicle, new_prev_vehicle, new_lane, time)
+            i = start + int(remaining[0])
+            start = i + 1
+
+            vehicle = vehicles[candidates.vehicles[i]]
+            if vehicle in changed_vehicles:
+                continue
 
-                    if new_prev_vehicle is not None:
-                        new_prev_vehicle.next_vehicle = vehicle
+            new_lane = int(candidates.new_lanes[i])
+            if stale[i]:
+                new_next_vehicle, new_prev_vehicle = self.lane_index.get_neighbours(new_lane, vehicle.position)
+                self.lane_change_reevaluation_count += 1
+                if not vehicle.will_change_lane(new_lane, new_next_vehicle, new_prev_vehicle, time):
+                    continue
+            else:
+                new_next_vehicle = self.get_vehicle(candidates.new_next_vehicles[i])
+                new_prev_vehicle = self.get_vehicle(candidates.new_prev_vehicles[i])
+
+            if indices is None:
+                indices = dict(zip(vehicles, range(len(vehicles))))
+
+            # The inputs of a later candidate change if its vehicle gets a new previous vehicle, if an obstacle becomes
+            # or stops being its next vehicle, if it considers this vehicle as new neighbour or if it targets the gap
+            # this vehicle moves into
+            changed_inputs = [vehicle.next_vehicle, new_next_vehicle]
+            if isinstance(vehicle.next_vehicle, Obstacle):
+                changed_inputs.append(vehicle.prev_vehicle)
+            if isinstance(new_next_vehicle, Obstacle):
+                changed_inputs.append(new_prev_vehicle)
+
+            changed_indices = [indices[changed] for changed in changed_inputs if changed in indices]
+
+            later = slice(start, None)
+            invalidated = self.find_invalidated_lane_changes(
+                candidates, later, changed_indices, candidates.vehicles[i], new_lane,
+                indices.get(new_next_vehicle, -1), indices.get(new_prev_vehicle, -1))
+            stale[later] |= invalidated
+            pending[later] |= invalidated
+
+            changed_vehicles.add(vehicle)
+            self.lane_change_count += 1
+            if self.event_log is not None:
+                self.event_log.record_lane_change(time, vehicle, new_lane)
+            self.apply_lane_change(vehicle, new_lane, new_next_vehicle, new_prev_vehicle, time)
+
+        return stale
+
+    def replay_lane_changes(self, time):
+        """Apply the lane changes of the event log for this update, in their original order"""
+        lane_changes = self.event_log.replay_lane_changes(time)
+        if not lane_changes:
+            return
 
-                    if new_next_vehicle is not None:
-                        new_next_vehicle.prev_vehicle = vehicle
+        vehicles = {vehicle.vehicle_id: vehicle for vehicle in self.vehicles}
+        for vehicle_id, new_lane in lane_changes:
+            vehicle = vehicles[vehicle_id]
+            new_next_vehicle, new_prev_vehicle = self.lane_index.get_neighbours(new_lane, vehicle.position)
 
-                    break
+            self.lane_change_count += 1
+            self.apply_lane_change(vehicle, new_lane, new_next_vehicle, new_prev_vehicle, time)
+
+    """
+        Args:
+            candidates: LaneChangeCandidates
+            later: slice with the candidates after the lane change
+            changed_indices: list with the indices of the vehicles that get a new previous vehicle or a new (or no
+                             more) next obstacle
+            index: index of the vehicle that changes lanes
+            new_lane, new_next_index, new_prev_index: the lane it changes to and the index of its new neighbours
+
+        Returns:
+            Boolean array with for each of the later candidates whether the lane change changed its inputs
+    """
+    def find_invalidated_lane_changes(self, candidates, later, changed_indices, index, new_lane, new_next_index,
+                                      new_prev_index):
+        return (np.isin(candidates.vehicles[later], changed_indices)
+                | (candidates.new_next_vehicles[later] == index)
+                | (candidates.new_prev_vehicles[later] == index)
+                | ((candidates.new_lanes[later] == new_lane)
+                   & (candidates.new_next_vehicles[later] == new_next_index)
+                   & (candidates.new_prev_vehicles[later] == new_prev_index)))
+
+    def get_vehicle(self, index):
+        return None if index < 0 else self.vehicles[index]
+
+    def apply_lane_change(self, vehicle, new_lane, new_next_vehicle, new_prev_vehicle, time):
+        if vehicle.prev_vehicle is not None:
+            vehicle.prev_vehicle.next_vehicle = vehicle.next_vehicle
+
+        if vehicle.next_vehicle is not None:
+            vehicle.next_vehicle.prev_vehicle = vehicle.prev_vehicle
+
+        self.track_lane_change_options(vehicle, -1)
+        self.lane_index.remove(vehicle)
+        vehicle.change_lane(new_next_vehicle, new_prev_vehicle, new_lane, time)
+        self.lane_index.insert(vehicle)
+        self.track_lane_change_options(vehicle)
+
+        if self.vehicle_table is not None:
+            row = self.vehicle_rows[vehicle]
+            self.vehicle_table.lanes[row] = new_lane
+            self.vehicle_table.last_lane_change_times[row] = time
+
+        if new_prev_vehicle is not None:
+            new_prev_vehicle.next_vehicle = vehicle
+
+        if new_next_vehicle is not None:
+            new_next_vehicle.prev_vehicle = vehicle
+
+    def vehicle_arrays(self):
+        """Struct of arrays with the state of the vehicles on the road, in the order of the vehicle list: the
+        TABLE_COLUMNS are selected from vehicle_table, only the other columns are gathered from the vehicles"""
+        vehicles = self.vehicles
+        if self.vehicle_table is None:
+            self.vehicle_table = VehicleArrays(vehicles)
+            self.vehicle_rows = dict(zip(vehicles, range(len(vehicles))))
+            self.free_rows = []
+
+        table = self.vehicle_table
+        rows = np.fromiter(map(self.vehicle_rows.__getitem__, vehicles), int, len(vehicles))
+
+        state = VehicleArrays(traffic_models=table.traffic_models, lane_change_models=table.lane_change_models)
+        for attribute in self.TABLE_COLUMNS:
+            setattr(state, attribute, getattr(table, attribute)[rows])
+        for attribute, vehicle_attribute in (('positions', 'position'), ('velocities', 'velocity'),
+                                             ('accelerations', 'acceleration'), ('gaps', 'gap')):
+            setattr(state, attribute, np.fromiter(map(attrgetter(vehicle_attribute), vehicles), float, len(vehicles)))
+
+        return state
+
+    def add_table_row(self, vehicle):
+        """Add a vehicle that enters the road to vehicle_table, in a row of a vehicle that left it if there is one"""
+        table = self.vehicle_table
+        arrays = VehicleArrays([vehicle], table.traffic_models, table.lane_change_models)
+
+        if self.free_rows:
+            row = self.free_rows.pop()
+            for attribute in self.TABLE_COLUMNS:
+                getattr(table, attribute)[row] = getattr(arrays, attribute)[0]
+        else:
+            row = len(self.vehicle_rows)
+            for attribute in VehicleArrays.COLUMNS:
+                setattr(table, attribute, np.concatenate((getattr(table, attribute), getattr(arrays, attribute))))
+
+        self.vehicle_rows[vehicle] = row
+
+    def vehicle_ids(self):
+        """Array with the id of each vehicle in the vehicle list"""
+        vehicles = self.vehicles
+        return np.fromiter(map(attrgetter('vehicle_id'), vehicles), np.int64, len(vehicles))
+
+    def vehicle_links(self):
+        """Index arrays with the next and previous vehicle of each vehicle in the vehicle list, -1 if there is none"""
+        vehicles = self.vehicles
+        indices = dict(zip(vehicles, range(len(vehicles))))
+
+        def index_array(linked_vehicles):
+            # Vehicles that are not on the road (including None) get index -1
+            return np.fromiter(map(indices.get, linked_vehicles, repeat(-1)), int, len(vehicles))
+
+        return (index_array(map(attrgetter('next_vehicle'), vehicles)),
+                index_array(map(attrgetter('prev_vehicle'), vehicles)))
 
     def update_positions_velocities(self):
-        vehicles_to_delete = []
-        for i, vehicle in enumerate(self.vehicles):
+        if self.detectors:
+            self.update_detectors()
+        if self.space_time_grids:
+            self.update_space_time_grids()
+
+        vehicles = self.vehicles
+        exited_count = 0
+        unsorted_lanes = set()
+        front_position = math.inf
+        for i, vehicle in enumerate(vehicles):
             vehicle.update_position(self.time_step)
 
+            # Vehicles rarely pass each other within a time step, so the vehicle list is kept sorted by moving the
+            # vehicles that did forward, past the (already updated) vehicles they overtook
+            if vehicle.position > front_position:
+                j = i
+                while j > 0 and vehicles[j - 1].position < vehicle.position:
+                    if vehicles[j - 1].lane == vehicle.lane:
+                        unsorted_lanes.add(vehicle.lane)
+
+                    vehicles[j] = vehicles[j - 1]
+                    j -= 1
+                vehicles[j] = vehicle
+
+            front_position = vehicles[i].position
+
             if vehicle.position > self.length:
-                vehicles_to_delete.append(vehicle)
+                exited_count += 1
                 continue
 
             vehicle.update_velocity(self.time_step)
 
-        self.removed_vehicle_count += len(vehicles_to_delete)
+        for lane in unsorted_lanes:
+            self.lane_index.sort_lane(lane)
+
+        # Remove vehicles from road that reached the end of the road, these are at the front of the sorted list
+        if exited_count > 0:
+            self.remove_front_vehicles(exited_count)
+
+    def update_detectors(self):
+        """Pass the vehicles that cross each detector in this time step to it, before the positions are updated"""
+        lanes = self.lane_index.lanes
+        for detector in self.detectors:
+            speeds = []
+            lengths = []
+            for lane in range(self.num_lanes) if detector.lane is None else (detector.lane,):
+                vehicles = lanes[lane]
+
+                # The vehicles right behind the detector cross it if they reach it in this step
+                for i in range(bisect_position(vehicles, detector.position, after_equal=True), len(vehicles)):
+                    vehicle = vehicles[i]
+                    if vehicle.position + self.time_step * vehicle.velocity < detector.position:
+                        break
 
-        # Remove vehicles from road that reached the end of the road
-        for vehicle in vehicles_to_delete:
-            vehicle.prev_vehicle.next_vehicle = None
-            self.vehicles.remove(vehicle)
+                    speeds.append(vehicle.velocity)
+                    lengths.append(vehicle.length)
+
+            detector.update(speeds, lengths)
+
+    def update_space_time_grids(self):
+        """Add the time step to the space-time grids, before the positions are updated"""
+        vehicles = [vehicle for vehicle in self.vehicles if not isinstance(vehicle, Obstacle)]
+        positions = np.fromiter(map(attrgetter('position'), vehicles), float, len(vehicles))
+        velocities = np.fromiter(map(attrgetter('velocity'), vehicles), float, len(vehicles))
+        lanes = np.fromiter(map(attrgetter('lane'), vehicles), int, len(vehicles))
+
+        for space_time_grid in self.space_time_grids:
+            space_time_grid.update(positions, velocities, lanes)
+
+    def remove_front_vehicles(self, count):
+        """Remove the first count vehicles of the (sorted) vehicle list from the road in bulk"""
+        removed_vehicles = self.vehicles[:count]
+        del self.vehicles[:count]
+        self.removed_vehicle_count += count
+
+        lane_counts = [0] * self.num_lanes
+        for vehicle in removed_vehicles:
+            if vehicle.prev_vehicle is not None:
+                vehicle.prev_vehicle.next_vehicle = None
+
+            lane_counts[vehicle.lane] += 1
+            self.track_vehicle(vehicle, -1)
+
+        for lane, lane_count in enumerate(lane_counts):
+            if lane_count > 0:
+                self.lane_index.remove_first(lane, lane_count)
+
+        if self.vehicle_factory is not None:
+            self.vehicle_factory.release_vehicles(removed_vehicles)
 
     def sort_vehicles(self):
         self.vehicles.sort(key=lambda x: x.position, reverse=True)
+        self.lane_index.sort()
+
+    def insert_vehicle(self, vehicle):
+        """Insert a vehicle in the vehicle list (behind the vehicles at the same position) and the lane index, without
+        re-sorting"""
+        self.inserted_vehicle_count += 1
+        self.vehicles.insert(bisect_position(self.vehicles, vehicle.position, after_equal=True), vehicle)
+        self.lane_index.insert(vehicle)
+        self.track_vehicle(vehicle)
 
+    """
+        Args:
+            lane: lane in which to look for the vehicle
+            index: index of a vehicle in the vehicle list, or the length of the list to get the last vehicle in the lane
+
+        Returns:
+            The closest vehicle in the given lane in front of the vehicle at the given index, None if there is none
+    """
     def get_next_vehicle(self, lane, index):
-        if lane >= self.num_lanes:
+        if not 0 <= lane < self.num_lanes:
             return None
 
         if not self.vehicles or not 0 < index <= len(self.vehicles):
             return None
 
-        if len(self.vehicles) == 1 and self.vehicles[0].lane == lane:
-            return self.vehicles[0]
-
-        for i in range(index - 1, -1, -1):
-            vehicle = self.vehicles[i]
+        if index == len(self.vehicles):
+            return self.lane_index.last(lane)
 
-            if vehicle.lane == lane:
-                return vehicle
+        return self.lane_index.get_next_vehicle(lane, self.vehicles[index].position)
 
-        return None
+    """
+        Args:
+            lane: lane in which to look for the vehicle
+            index: index of a vehicle in the vehicle list
 
+        Returns:
+            The closest vehicle in the given lane behind the vehicle at the given index, None if there is none
+    """
     def get_prev_vehicle(self, lane, index):
-        if lane >= self.num_lanes:
+        if not 0 <= lane < self.num_lanes:
             return None
 
         if not self.vehicles or not 0 <= index < len(self.vehicles):
             return None
 
-        for i in range(index + 1, len(self.vehicles)):
-            vehicle = self.vehicles[i]
-
-            if vehicle.lane == lane:
-                return vehicle
+        vehicle = self.vehicles[index]
+        prev_vehicle = self.lane_index.get_prev_vehicle(lane, vehicle.position)
+        if prev_vehicle is vehicle:
+            return vehicle.prev_vehicle
 
-        return None
-
-    def generate_new_vehicles(self, time):
-        if self.vehicle_factory is None:
-            return
+        return prev_vehicle
 
+    """
+        Returns:
+            Tuple of arrays with, for each lane, the gap between the start of the road and the last vehicle in the lane
+            and the velocity of that vehicle, inf for both if the lane is empty
+    """
+    def get_entry_gaps(self):
+        gaps = np.full(self.num_lanes, math.inf)
+        velocities = np.full(self.num_lanes, math.inf)
         for lane in range(self.num_lanes):
-            if random.random() > self.insertion_chance:
+            last_vehicle = self.lane_index.last(lane)
+            if last_vehicle is not None:
+                gaps[lane] = last_vehicle.position - last_vehicle.length
+                velocities[lane] = last_vehicle.velocity
+
+        return gaps, velocities
+
+    def draw_random(self, num):
+        """Next num uniform random numbers from the block of drawn numbers, drawing a new block when it runs out"""
+        if self.random_position + num > len(self.random_block):
+            self.random_block = (self.random_block[self.random_position:] +
+                                 self.random.random(max(self.RANDOM_BLOCK_SIZE, num)).tolist())
+            self.random_position = 0
+
+        start = self.random_position
+        self.random_position += num
+
+        return self.random_block[start:start + num]
+
+    def create_new_vehicles(self, time):
+        """Vehicles that try to enter the road at its start in this update, at most one per lane: the vehicles of the
+        event log when it is replayed, random ones otherwise"""
+        if self.event_log is not None and self.event_log.replaying:
+            return self.event_log.replay_insertions(time, self.vehicle_factory)
+
+        new_vehicles = []
+        for lane, draw in enumerate(self.draw_random(self.num_lanes)):
+            if draw > self.insertion_chance:
                 continue
 
             new_vehicle = self.vehicle_factory.create_random_vehicle()
             new_vehicle.lane = lane
             new_vehicle.last_lane_change_time = time
+            new_vehicles.append(new_vehicle)
+
+        return new_vehicles
+
+    def generate_new_vehicles(self, time):
+        if self.vehicle_factory is None:
+            return
 
-            next_vehicle = self.get_next_vehicle(lane, len(self.vehicles))
+        for new_vehicle in self.create_new_vehicles(time):
+            next_vehicle = self.lane_index.last(new_vehicle.lane)
 
             if next_vehicle is None:
                 distance = self.length
@@ -157,8 +801,13 @@ class Road:
                 if next_vehicle is not None:
                     new_vehicle.next_vehicle = next_vehicle
                     next_vehicle.prev_vehicle = new_vehicle
+                    new_vehicle.update_gap()
 
-                self.vehicles.append(new_vehicle)
+                self.insert_vehicle(new_vehicle)
+                if self.event_log is not None:
+                    self.event_log.record_insertion(time, new_vehicle)
+            else:
+                self.vehicle_factory.release_vehicles([new_vehicle])
 
     """
         Args:
@@ -178,6 +827,27 @@ class Road:
 
         return vehicles_passed_point / (current_time / 3600)
 
+    """
+        Places a virtual loop detector on the road, which is updated incrementally in every time step from then on.
+
+        Args:
+            position: position of the detector [m]
+            lane: lane of the detector, None for a detector across all lanes
+            window: time [s] over which the readings of the detector are aggregated
+
+        Returns:
+            The LoopDetector
+    """
+    def add_detector(self, position, lane=None, window=LoopDetector.DEFAULT_WINDOW):
+        if lane is not None and not 0 <= lane < self.num_lanes:
+            raise ValueError(f'Lane {lane} is not on the road, which has {self.num_lanes} lanes')
+
+        covered_lanes = self.num_lanes if lane is None else 1
+        detector = LoopDetector(position, lane, self.time_step, window, covered_lanes)
+        self.detectors.append(detector)
+
+        return detector
+
     def add_obstacle(self, lane, at_position):
         if not 0 <= lane < self.num_lanes:
             return
@@ -186,39 +856,63 @@ class Road:
         obstacle.lane = lane
         obstacle.position = at_position
 
-        if self.vehicles:
-            for i, vehicle in enumerate(self.vehicles):
-                if vehicle.position < at_position and vehicle.lane == lane:
-                    next_vehicle = vehicle.next_vehicle
-                    if next_vehicle is not None:
-                        next_vehicle.prev_vehicle = obstacle
+        self.add_vehicle(obstacle)
+        if self.event_log is not None:
+            self.event_log.record_obstacle(lane, at_position, obstacle)
 
-                    vehicle.next_vehicle = obstacle
-                    obstacle.prev_vehicle = vehicle
-                    vehicle.update_gap()
-                    break
+    def add_vehicle(self, vehicle):
+        """Insert a vehicle at its position and lane, linking it to its neighbours in the lane"""
+        next_vehicle, prev_vehicle = self.lane_index.get_neighbours(vehicle.lane, vehicle.position)
+        if prev_vehicle is not None:
+            prev_vehicle.next_vehicle = vehicle
+            vehicle.prev_vehicle = prev_vehicle
+            prev_vehicle.update_gap()
 
-        self.vehicles.append(obstacle)
-        self.sort_vehicles()
+        if next_vehicle is not None:
+            next_vehicle.prev_vehicle = vehicle
+            vehicle.next_vehicle = next_vehicle
+            vehicle.update_gap()
+
+        self.insert_vehicle(vehicle)
 
     def remove_obstacle(self, lane, at_position):
         if not 0 <= lane < self.num_lanes:
             return
 
-        if self.vehicles:
-            obstacle = None
-            for i, vehicle in enumerate(self.vehicles):
-                if isinstance(vehicle, Obstacle) and vehicle.position == at_position and vehicle.lane == lane:
-                    if vehicle.prev_vehicle is not None:
-                        vehicle.prev_vehicle.next_vehicle = vehicle.next_vehicle
+        # The obstacles at the position are found with a binary search in the lane
+        vehicles = self.lane_index.lanes[lane]
+        for i in range(bisect_position(vehicles, at_position), len(vehicles)):
+            vehicle = vehicles[i]
+            if vehicle.position != at_position:
+                break
+
+            if isinstance(vehicle, Obstacle):
+                self.remove_vehicle(vehicle)
+                # Only a removal that happened is logged, so a replay does not apply it to an obstacle added later
+                if self.event_log is not None:
+                    self.event_log.record_obstacle(lane, at_position)
+                break
+
+    def remove_vehicle(self, vehicle):
+        """Remove a vehicle from the road (if it is still on it), linking its neighbours in the lane to each other"""
+        vehicles = self.vehicles
+        i = bisect_position(vehicles, vehicle.position)
+        while i < len(vehicles) and vehicles[i] is not vehicle and vehicles[i].position == vehicle.position:
+            i += 1
+
+        if i == len(vehicles) or vehicles[i] is not vehicle:
+            return
 
-                    if vehicle.next_vehicle is not None:
-                        vehicle.next_vehicle.prev_vehicle = vehicle.prev_vehicle
+        del vehicles[i]
+        self.lane_index.remove(vehicle)
+        self.track_vehicle(vehicle, -1)
 
-                    break
+        if vehicle.next_vehicle is not None:
+            vehicle.next_vehicle.prev_vehicle = vehicle.prev_vehicle
 
-            if obstacle is not None:
-                self.vehicles.remove(obstacle)
+        if vehicle.prev_vehicle is not None:
+            vehicle.prev_vehicle.next_vehicle = vehicle.next_vehicle
+            vehicle.prev_vehicle.update_gap()
 
     def vehicle_density(self):
         vehicles_count = len([vehicle for vehicle in self.vehicles if not isinstance(vehicle, Obstacle)])
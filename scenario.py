@@ -0,0 +1,125 @@
+from traffic_models import *
+from lane_change_models import *
+from road import *
+from array_road import ArrayRoad
+from incidents import IncidentSchedule
+import copy
+import json
+
+import numpy as np
+
+
+TRAFFIC_MODELS = {
+    'IDM': lambda time_step: IDM(),
+    'Gipps': lambda time_step: Gipps(time_step),
+}
+
+ROADS = {
+    'Road': Road,
+    'ArrayRoad': ArrayRoad,
+}
+
+"""
+Declarative description of a simulation, scenario files (JSON) only have to contain the values that differ from it:
+    name: name of the scenario, used as output directory
+    duration: simulated time [s]
+    seed: seed of the random number generators of the road and the vehicle factory, None to leave them unseeded
+    traffic_model: name of the longitudinal traffic model, see TRAFFIC_MODELS
+    lane_change_model: parameters of the MOBIL lane change model
+    factory: weights of the VehicleFactory for Cars, Trucks, AggressiveCars and PassiveCars
+    road: type of the road (see ROADS) and its parameters, inflow tells whether the factory generates new vehicles
+    vehicles: rows of vehicles on the road at the start, see VehicleFactory.create_random_vehicle_row
+    obstacles: lanes and positions of the obstacles on the road
+    incidents: timed obstacles, lane closures and moving bottlenecks, see IncidentSchedule.add_incident
+"""
+DEFAULT_SCENARIO = {
+    'name': 'braking',
+    'duration': 600,
+    'seed': None,
+    'traffic_model': 'IDM',
+    'lane_change_model': {
+        'politeness_factor': MOBIL.DEFAULT_POLITENESS_FACTOR,
+        'right_bias': 0.6,
+    },
+    'factory': {
+        'weights': [1.0, 0, 0, 0],
+    },
+    'road': {
+        'type': 'Road',
+        'length': 200000,
+        'num_lanes': 1,
+        'insertion_gap': Road.DEFAULT_INSERTION_GAP,
+        'insertion_chance': Road.DEFAULT_INSERTION_CHANCE,
+        'time_step': Road.DEFAULT_TIME_STEP,
+        'inflow': False,
+    },
+    'vehicles': [
+        {'num': 5, 'spacing': 200, 'lane': 0},
+    ],
+    'obstacles': [
+        {'lane': 0, 'position': 5000},
+    ],
+    'incidents': [],
+}
+
+
+"""
+    Args:
+        path: path of a JSON scenario file, the default scenario if None
+
+    Returns:
+        The scenario, with the missing values filled in from DEFAULT_SCENARIO
+"""
+def load_scenario(path=None):
+    scenario = copy.deepcopy(DEFAULT_SCENARIO)
+    if path is None:
+        return scenario
+
+    with open(path) as scenario_file:
+        overrides = json.load(scenario_file)
+
+    unknown = set(overrides) - set(scenario)
+    if unknown:
+        raise ValueError(f'Unknown scenario keys: {", ".join(sorted(unknown))}')
+
+    for key, value in overrides.items():
+        if isinstance(scenario[key], dict):
+            scenario[key].update(value)
+        else:
+            scenario[key] = value
+
+    return scenario
+
+
+def spawn_seeds(seed):
+    """Independent seeds for the random number generators of a road and its vehicle factory, derived from one seed"""
+    road_seed, factory_seed = np.random.SeedSequence(seed).spawn(2)
+    return road_seed, factory_seed
+
+
+def create_road(scenario):
+    """Set up the road of a scenario, with its vehicles and obstacles"""
+    road_seed, factory_seed = spawn_seeds(scenario['seed'])
+
+    road_parameters = dict(scenario['road'])
+    road_type = ROADS[road_parameters.pop('type')]
+    inflow = road_parameters.pop('inflow')
+
+    traffic_model = TRAFFIC_MODELS[scenario['traffic_model']](road_parameters['time_step'])
+    lane_change_model = MOBIL(**scenario['lane_change_model'])
+    vehicle_factory = VehicleFactory(scenario['factory']['weights'], traffic_model, lane_change_model,
+                                     seed=factory_seed)
+
+    vehicles = []
+    for row in scenario['vehicles']:
+        vehicles += vehicle_factory.create_random_vehicle_row(**row)
+
+    road = road_type(vehicles=vehicles, vehicle_factory=vehicle_factory if inflow else None, seed=road_seed,
+                     **road_parameters)
+    for obstacle in scenario['obstacles']:
+        road.add_obstacle(obstacle['lane'], obstacle['position'])
+
+    if scenario['incidents']:
+        IncidentSchedule(road, scenario['incidents'])
+
+    return road
@@ -0,0 +1,693 @@
+from array_road import ArrayRoad
+from vehicle_arrays import VehicleArrays
+from vehicle import *
+from collections import namedtuple
+from bisect import bisect_right
+import copy
+import multiprocessing
+
+import numpy as np
+
+
+"""
+VehicleRecord is a vehicle as it is sent between the processes of a SegmentedRoad, with its class, state and the index
+of its models in the model list of the road (-1 for no model).
+"""
+VehicleRecord = namedtuple('VehicleRecord', ['vehicle_class', 'vehicle_id', 'position', 'velocity', 'acceleration',
+                                             'gap', 'lane', 'last_lane_change_time', 'traffic_model',
+                                             'lane_change_model'])
+
+"""
+LaneChangeEvent is a lane change that changed the last vehicle of a segment in one or more lanes, which the segment
+behind it replays before applying its own lane changes:
+    vehicle_id: the vehicle that changed lanes
+    new_lane: the lane it changed to
+    old_next_id, new_next_id, old_prev_id, new_prev_id: its old and new neighbours, -1 if there is none
+    old_next_obstacle, new_next_obstacle: whether the old and new next vehicle are obstacles
+    last_vehicles: tuple of (lane, VehicleRecord or None) with the new last vehicle of each lane that changed
+"""
+LaneChangeEvent = namedtuple('LaneChangeEvent', ['vehicle_id', 'new_lane', 'old_next_id', 'new_next_id', 'old_prev_id',
+                                                 'new_prev_id', 'old_next_obstacle', 'new_next_obstacle',
+                                                 'last_vehicles'])
+
+# Counters of the segments, the SegmentedRoad reports their sum
+COUNTERS = ('removed_vehicle_count', 'inserted_vehicle_count', 'acceleration_update_count',
+            'lane_change_evaluation_count', 'cooldown_skip_count', 'lane_change_reevaluation_count',
+            'lane_change_count')
+
+
+class RoadSegment(ArrayRoad):
+    """
+    The part of a SegmentedRoad from start (inclusive) to end, simulated in a worker process. Besides its own
+    vehicles, the arrays of a segment contain copies (ghosts) of the vehicles of the other segments it interacts with:
+    in every lane the last vehicle ahead of the segment (the leader of its first vehicle in the lane) and the first
+    vehicle behind it (the potential new follower of a vehicle that changes to the lane). The ghosts are refreshed in
+    every step and are not updated by the segment itself. A lane without a vehicle ahead of the segment gets a
+    placeholder row instead (an Obstacle in lane -1), so a lane change of the segment ahead can fill in the front ghost
+    of the lane without moving the rows of the lane changes that are being applied.
+
+    Args:
+        start, end: positions between which the vehicles belong to the segment [m]
+        models: list of the traffic and lane change models that VehicleRecords refer to
+        records: VehicleRecords of the vehicles on the segment
+        vehicle_factory: factory that generates new vehicles, only the first segment has one
+        random: state of the random number generator of the road (for the first segment)
+        next_vehicle_id: id of the next vehicle that is created in this process
+        see Road for the other arguments
+    """
+    def __init__(self, start, end, models, records, length, num_lanes, vehicle_factory, insertion_gap,
+                 insertion_chance, time_step, random=None, next_vehicle_id=None):
+        # Index -1 (no model) selects the None at the end
+        self.models = models + [None]
+        self.model_indices = {id(model): i for i, model in enumerate(models)}
+        self.model_indices[id(None)] = -1
+
+        self.start = start
+        self.end = end
+
+        # The ghosts of the current step by vehicle_id, and the mask of their rows in the arrays
+        self.ghost_vehicles = {}
+        self.ghost_rows = np.zeros(len(records), dtype=bool)
+
+        # Candidates and decisions of the lane changes of the current step, and the events for the segment behind
+        self.lane_changes = None
+        self.lane_change_events = []
+
+        super().__init__(length, num_lanes, list(map(self.create_vehicle, records)), vehicle_factory, insertion_gap,
+                         insertion_chance, time_step, seed=0)
+
+        if random is not None:
+            self.random, self.random_block, self.random_position = random
+        if next_vehicle_id is not None:
+            Vehicle.ids = count(next_vehicle_id)
+
+    def create_vehicle(self, record):
+        vehicle = record.vehicle_class.__new__(record.vehicle_class)
+        self.load_record(vehicle, record)
+        vehicle.next_vehicle = None
+        vehicle.prev_vehicle = None
+
+        return vehicle
+
+    def load_record(self, vehicle, record):
+        vehicle.vehicle_id = record.vehicle_id
+        vehicle.position = record.position
+        vehicle.velocity = record.velocity
+        vehicle.acceleration = record.acceleration
+        vehicle.gap = record.gap
+        vehicle.lane = record.lane
+        vehicle.last_lane_change_time = record.last_lane_change_time
+        vehicle.traffic_model = self.models[record.traffic_model]
+        vehicle.lane_change_model = self.models[record.lane_change_model]
+
+    def get_records(self, indices):
+        """VehicleRecords of the vehicles at the given indices, with the state from the arrays"""
+        columns = [getattr(self, attribute)[indices].tolist() for attribute in
+                   ('positions', 'velocities', 'accelerations', 'gaps', 'lanes', 'last_lane_change_times')]
+        vehicles = [self._vehicles[i] for i in indices]
+
+        return [VehicleRecord(vehicle.__class__, vehicle.vehicle_id, *state,
+                              self.model_indices[id(vehicle.traffic_model)],
+                              self.model_indices[id(vehicle.lane_change_model)])
+                for vehicle, *state in zip(vehicles, *columns)]
+
+    def get_ghost(self, record):
+        ghost = self.ghost_vehicles.get(record.vehicle_id)
+        if ghost is None:
+            ghost = self.create_vehicle(record)
+            self.ghost_vehicles[record.vehicle_id] = ghost
+        else:
+            self.load_record(ghost, record)
+
+        return ghost
+
+    def insert_sorted(self, vehicles, ghosts=False):
+        """Insert vehicles (or ghosts) in the arrays and the vehicle list at their position, behind the vehicles at the
+        same position, like sort_vehicles would order them. Only the links of their neighbours are updated."""
+        if not vehicles:
+            return
+
+        vehicles = sorted(vehicles, key=lambda x: x.position, reverse=True)
+        arrays = VehicleArrays(vehicles, self.traffic_models, self.lane_change_models)
+
+        # Every vehicle goes before an index of the old arrays, behind the vehicles inserted before it
+        indices = np.searchsorted(-self.positions, -arrays.positions, side='right')
+        rows = indices + np.arange(len(vehicles))
+        for row, vehicle in zip(rows.tolist(), vehicles):
+            self._vehicles.insert(row, vehicle)
+
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, np.insert(getattr(self, attribute), indices, getattr(arrays, attribute)))
+        self.ghost_rows = np.insert(self.ghost_rows, indices, ghosts)
+
+        # The old indices move down by the number of vehicles inserted before them
+        for attribute in ('leaders', 'followers'):
+            links = getattr(self, attribute)
+            links = np.where(links >= 0, links + np.searchsorted(indices, links, side='right'), -1)
+            setattr(self, attribute, np.insert(links, indices, -1))
+
+        changed_gaps = set()
+        for lane in np.unique(arrays.lanes[arrays.lanes >= 0]).tolist():
+            in_lane = np.flatnonzero(self.lanes == lane)
+            for i in np.searchsorted(in_lane, rows[arrays.lanes == lane]).tolist():
+                index = int(in_lane[i])
+                changed_gaps.add(index)
+                if i > 0:
+                    self.leaders[index] = in_lane[i - 1]
+                    self.followers[in_lane[i - 1]] = index
+                if i + 1 < in_lane.size:
+                    self.followers[index] = in_lane[i + 1]
+                    self.leaders[in_lane[i + 1]] = index
+                    changed_gaps.add(int(in_lane[i + 1]))
+
+        self.update_gaps_of(changed_gaps)
+        self.invalidate_views()
+
+    def remove_ghosts(self):
+        """Remove the rows of the ghosts, linking the vehicles around them to each other"""
+        self.ghost_vehicles = {}
+        ghosts = np.flatnonzero(self.ghost_rows)
+        if ghosts.size == 0:
+            return
+
+        followers = set()
+        for ghost in ghosts.tolist():
+            leader = int(self.leaders[ghost])
+            follower = int(self.followers[ghost])
+            if leader >= 0:
+                self.followers[leader] = follower
+            if follower >= 0:
+                self.leaders[follower] = leader
+                followers.add(follower)
+
+        for ghost in reversed(ghosts.tolist()):
+            del self._vehicles[ghost]
+
+        # The mask is rebuilt at full size, as new vehicles can have been added behind the ghosts
+        removed = np.zeros(self.positions.size, dtype=bool)
+        removed[ghosts] = True
+        shifts = np.cumsum(removed)
+        for attribute in VehicleArrays.COLUMNS:
+            setattr(self, attribute, getattr(self, attribute)[~removed])
+        for attribute in ('leaders', 'followers'):
+            links = getattr(self, attribute)[~removed]
+            setattr(self, attribute, np.where(links >= 0, links - shifts[links], -1))
+
+        self.ghost_rows = np.zeros(self.positions.size, dtype=bool)
+        self.update_gaps_of(follower - int(shifts[follower]) for follower in followers if not removed[follower])
+        self.invalidate_views()
+
+    """
+        Starts a time step: adds the vehicles that crossed into the segment and the ghosts, updates the accelerations
+        and decides the lane changes of the own vehicles.
+
+        Args:
+            time: current time elapsed in the simulation
+            incoming: VehicleRecords of the vehicles that crossed into the segment in the last step
+            front_ghosts, back_ghosts: VehicleRecords of the ghosts ahead of and behind the segment
+    """
+    def begin_step(self, time, incoming, front_ghosts, back_ghosts):
+        self.ghost_rows = np.zeros(self.positions.size, dtype=bool)
+        self.insert_sorted(list(map(self.create_vehicle, incoming)))
+
+        ghosts = list(map(self.get_ghost, front_ghosts + back_ghosts))
+        if self.num_lanes > 1 and self.end < math.inf:
+            # Lanes without a front ghost can get one from a lane change of the segment ahead
+            missing = self.num_lanes - len(front_ghosts)
+            ghosts += [self.create_vehicle(VehicleRecord(Obstacle, -1, self.end, 0, 0, math.inf, -1, 0, -1, -1))
+                       for _ in range(missing)]
+        self.insert_sorted(ghosts, ghosts=True)
+
+        self.update_accelerations()
+        self.acceleration_update_count -= len(ghosts)
+
+        self.lane_changes = None
+        if self.num_lanes > 1 and self.positions.size > 0:
+            self.decide_segment_lane_changes(time)
+
+    def decide_segment_lane_changes(self, time):
+        state = self.vehicle_arrays()
+        # Ghosts are never candidates, their own segment decides their lane changes
+        state.lane_change_model_ids = np.where(self.ghost_rows, -1, state.lane_change_model_ids)
+
+        candidates = self.find_lane_change_candidates(state, time)
+        self.lane_change_evaluation_count += candidates.vehicles.size
+        decisions = self.decide_lane_changes(state, candidates, time)
+
+        self.lane_changes = (candidates, decisions)
+
+    """
+        Applies the lane changes of the segment, after replaying the lane changes of the segments ahead of it that
+        changed its front ghosts. In the order of the vehicle list of the whole road, those lane changes come before
+        the ones of this segment.
+
+        Args:
+            events: LaneChangeEvents of the segment ahead
+            time: current time elapsed in the simulation
+
+        Returns:
+            List of LaneChangeEvents for the segment behind
+    """
+    def apply_segment_lane_changes(self, events, time):
+        self.lane_change_events = []
+        if self.lane_changes is None:
+            return []
+
+        candidates, decisions = self.lane_changes
+        stale = np.zeros(decisions.size, dtype=bool)
+        if events:
+            indices = {vehicle_id: i for i, vehicle_id in enumerate(self.vehicle_ids().tolist()) if vehicle_id >= 0}
+            for event in events:
+                stale |= self.replay_lane_change(event, candidates, indices)
+
+        self.apply_lane_changes(candidates, decisions, time, stale)
+
+        return self.lane_change_events
+
+    def replay_lane_change(self, event, candidates, indices):
+        """Update the front ghosts for a lane change of the segment ahead, and return which candidates it invalidated,
+        with the same rules as apply_lane_changes"""
+        changed_inputs = [event.old_next_id, event.new_next_id]
+        if event.old_next_obstacle:
+            changed_inputs.append(event.old_prev_id)
+        if event.new_next_obstacle:
+            changed_inputs.append(event.new_prev_id)
+
+        changed_indices = [indices[changed] for changed in changed_inputs if changed in indices]
+
+        def get_index(vehicle_id):
+            # -2 for a vehicle that is not on the segment, which no candidate refers to
+            return -1 if vehicle_id < 0 else indices.get(vehicle_id, -2)
+
+        invalidated = self.find_invalidated_lane_changes(
+            candidates, slice(None), changed_indices, get_index(event.vehicle_id), event.new_lane,
+            get_index(event.new_next_id), get_index(event.new_prev_id))
+
+        lanes = [lane for lane, _ in event.last_vehicles]
+        last_vehicles = self.get_vehicles(self.get_last_vehicles(lanes))
+        for lane, record in event.last_vehicles:
+            self.set_front_ghost(lane, record)
+        self.report_last_vehicle_changes(event, lanes, last_vehicles)
+
+        return invalidated
+
+    def set_front_ghost(self, lane, record):
+        """Replace the front ghost of a lane, in its own row or in a placeholder row, and link it to the vehicle behind
+        it like a lane change would"""
+        front_rows = np.flatnonzero(self.ghost_rows & (self.positions >= self.end))
+        in_lane = front_rows[self.lanes[front_rows] == lane]
+        if in_lane.size == 0 and record is None:
+            return
+        row = int(in_lane[0]) if in_lane.size > 0 else int(front_rows[self.lanes[front_rows] < 0][0])
+
+        # A front ghost that is not replaced leaves a placeholder row
+        self.lanes[row] = -1
+        self.leaders[row] = -1
+        self.followers[row] = -1
+
+        # The front ghosts come before all other vehicles in the arrays
+        in_lane = np.flatnonzero(self.lanes == lane)
+        prev_index = int(in_lane[0]) if in_lane.size > 0 else -1
+        if record is not None:
+            ghost = self.get_ghost(record)
+            arrays = VehicleArrays([ghost], self.traffic_models, self.lane_change_models)
+            for attribute in VehicleArrays.COLUMNS:
+                getattr(self, attribute)[row] = getattr(arrays, attribute)[0]
+            self._vehicles[row] = ghost
+            self.followers[row] = prev_index
+        if prev_index >= 0:
+            self.leaders[prev_index] = -1 if record is None else row
+
+    def get_vehicles(self, indices):
+        """Vehicle objects at the given indices (None for -1), which tell whether a row was replaced"""
+        return [None if i < 0 else self._vehicles[i] for i in indices]
+
+    def get_last_vehicles(self, lanes):
+        """Index of the last vehicle of the segment (or of the road ahead of it) in each of the lanes, -1 if there is
+        none"""
+        # Only the back ghosts are behind the start
+        ahead = int(np.searchsorted(-self.positions, -self.start, side='right'))
+        return [self.find_in_lane(lane, ahead - 1, -1) for lane in lanes]
+
+    def report_last_vehicle_changes(self, event, lanes, last_vehicles):
+        if self.start == -math.inf:
+            return
+
+        indices = self.get_last_vehicles(lanes)
+        changes = tuple((lane, None if index < 0 else self.get_records([index])[0])
+                        for lane, last_vehicle, index, vehicle in zip(lanes, last_vehicles, indices,
+                                                                      self.get_vehicles(indices))
+                        if vehicle is not last_vehicle)
+        if changes:
+            self.lane_change_events.append(event._replace(last_vehicles=changes))
+
+    def change_vehicle_lane(self, index, new_lane, time):
+        # The first segment has no segment behind it to report to
+        if self.start == -math.inf:
+            return super().change_vehicle_lane(index, new_lane, time)
+
+        lanes = [int(self.lanes[index]), new_lane]
+        last_vehicles = self.get_vehicles(self.get_last_vehicles(lanes))
+        next_index = int(self.leaders[index])
+        prev_index = int(self.followers[index])
+
+        changed = super().change_vehicle_lane(index, new_lane, time)
+
+        new_next_index = int(self.leaders[index])
+        new_prev_index = int(self.followers[index])
+        ids = [-1 if i < 0 else self._vehicles[i].vehicle_id for i in (next_index, new_next_index, prev_index,
+                                                                       new_prev_index)]
+        event = LaneChangeEvent(self._vehicles[index].vehicle_id, new_lane, *ids,
+                                next_index >= 0 and bool(self.obstacles[next_index]),
+                                new_next_index >= 0 and bool(self.obstacles[new_next_index]), ())
+        self.report_last_vehicle_changes(event, lanes, last_vehicles)
+
+        return changed
+
+    """
+        Finishes the time step: updates the positions and velocities, removes the vehicles that reached the end of the
+        road (last segment) or generates new ones (first segment) and hands over the vehicles that crossed the end of
+        the segment.
+
+        Returns:
+            Tuple of the VehicleRecords of the vehicles that left the segment, the first and last vehicle of the
+            segment in each lane (see get_lane_ends) and the counters of the segment
+    """
+    def finish_step(self, time):
+        self.lane_changes = None
+
+        front_ghosts = []
+        if self.vehicle_factory is not None:
+            front_ghosts = self.get_records(np.flatnonzero(self.ghost_rows & (self.positions >= self.end)
+                                                           & (self.lanes >= 0)))
+
+        self.remove_ghosts()
+        self.update_positions_velocities()
+
+        if self.vehicle_factory is not None:
+            self.ghost_rows = np.zeros(self.positions.size, dtype=bool)
+            # The inserted vehicles keep their distance to the last vehicle in their lane, which can be a ghost
+            front_ghosts = [ghost if issubclass(ghost.vehicle_class, Obstacle)
+                            else ghost._replace(position=ghost.position + self.time_step * ghost.velocity)
+                            for ghost in front_ghosts]
+            self.insert_sorted(list(map(self.get_ghost, front_ghosts)), ghosts=True)
+
+            self.generate_new_vehicles(time)
+            self.remove_ghosts()
+
+        # The vehicles that crossed the end are at the front of the sorted arrays
+        outgoing_count = int(np.count_nonzero(self.positions >= self.end))
+        records = self.get_records(np.arange(outgoing_count))
+        if records:
+            self._remove_front(outgoing_count)
+
+        return records, self.get_lane_ends(), {counter: getattr(self, counter) for counter in COUNTERS}
+
+    def get_lane_ends(self):
+        """Lists with the VehicleRecord of the first and of the last vehicle of the segment in each lane (or None)"""
+        first_vehicles = [None] * self.num_lanes
+        last_vehicles = [None] * self.num_lanes
+        for lane in range(self.num_lanes):
+            in_lane = np.flatnonzero(self.lanes == lane)
+            if in_lane.size > 0:
+                first_vehicles[lane], last_vehicles[lane] = self.get_records(in_lane[[0, -1]])
+
+        return first_vehicles, last_vehicles
+
+    def get_vehicle_records(self):
+        return self.get_records(np.arange(self.positions.size))
+
+    def add_segment_obstacle(self, record):
+        self.insert_vehicle(self.create_vehicle(record))
+        return self.get_lane_ends()
+
+    def remove_segment_obstacle(self, lane, at_position):
+        self.remove_obstacle(lane, at_position)
+        return self.get_lane_ends()
+
+    def allocate_vehicle_id(self):
+        return next(Vehicle.ids)
+
+
+def run_segment_worker(connection):
+    """Serves the requests of a SegmentedRoad for a single RoadSegment, until the road is closed"""
+    segment = None
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            break
+
+        try:
+            if command == 'init':
+                segment = RoadSegment(*args)
+                result = None
+            else:
+                result = getattr(segment, command)(*args)
+        except Exception as error:
+            result = error
+
+        connection.send(result)
+
+    connection.close()
+
+
+class SegmentedRoad:
+    """
+    Road that is split into consecutive segments of equal length, each simulated by its own worker process, so a long
+    road is updated on several cores. A SegmentedRoad is created from an existing road (with its vehicles, vehicle
+    factory and random number generator) and has the same update method; the results are the same as those of the
+    single-process ArrayRoad, including the vehicle ids.
+
+    In every step, the segments exchange the vehicles closest to their borders, which they keep as ghosts: the
+    leaders ahead of the segment and the potential followers behind it. Accelerations, lane change decisions and
+    positions are computed by all segments in parallel. The lane changes are applied in the order of the vehicle
+    list of the whole road, so from the front segment to the back one; a segment forwards the lane changes that
+    affect the segment behind it as LaneChangeEvents, which that segment replays before it applies its own. Only the
+    application of the accepted lane changes is sequential, which is a small part of the work. After the positions are
+    updated, the vehicles that crossed the end of their segment are handed over to the next one.
+
+    The first segment generates the new vehicles and the last one removes the vehicles that reach the end of the road.
+    The counters of the road (like removed_vehicle_count) are the sums of the counters of the segments. Detectors,
+    space-time grids, instrumentation and the lane_change_recheck_interval are not supported.
+
+    Args:
+        road: road to split, it should not be used anymore afterwards
+        num_segments: number of segments (and worker processes)
+    """
+    def __init__(self, road, num_segments):
+        if road.lane_change_recheck_interval > 0:
+            raise ValueError('A SegmentedRoad does not support a lane_change_recheck_interval')
+
+        self.length = road.length
+        self.num_lanes = road.num_lanes
+        self.time_step = road.time_step
+        self.num_segments = num_segments
+
+        self.borders = [road.length * i / num_segments for i in range(1, num_segments)]
+        starts = [-math.inf] + self.borders
+        ends = self.borders + [math.inf]
+
+        vehicles = road.vehicles
+        vehicle_factory = road.vehicle_factory
+        models = list({id(model): model for vehicle in vehicles
+                       for model in (vehicle.traffic_model, vehicle.lane_change_model) if model is not None}.values())
+        if vehicle_factory is not None:
+            # The pooled vehicles are not sent to the worker
+            vehicle_factory = copy.copy(vehicle_factory)
+            vehicle_factory.pool = {}
+            models += [model for model in (vehicle_factory.default_traffic_model,
+                                           vehicle_factory.default_lane_change_model)
+                       if model is not None and all(model is not known for known in models)]
+
+        self.models = models + [None]
+        model_indices = {id(model): i for i, model in enumerate(models)}
+        model_indices[id(None)] = -1
+
+        records = [[] for _ in range(num_segments)]
+        for vehicle in vehicles:
+            records[bisect_right(self.borders, vehicle.position)].append(VehicleRecord(
+                vehicle.__class__, vehicle.vehicle_id, vehicle.position, vehicle.velocity, vehicle.acceleration,
+                vehicle.gap, vehicle.lane, vehicle.last_lane_change_time, model_indices[id(vehicle.traffic_model)],
+                model_indices[id(vehicle.lane_change_model)]))
+
+        # Peek at the id the next new vehicle gets, the first segment continues with it
+        next_vehicle_id = next(Vehicle.ids)
+        Vehicle.ids = count(next_vehicle_id)
+
+        self.connections = []
+        self.processes = []
+        for i in range(num_segments):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_segment_worker, args=(worker_connection,), daemon=True)
+            process.start()
+            worker_connection.close()
+
+            self.connections.append(connection)
+            self.processes.append(process)
+
+            first = i == 0
+            connection.send(('init', (starts[i], ends[i], models, records[i], road.length, road.num_lanes,
+                                      vehicle_factory if first else None, road.insertion_gap, road.insertion_chance,
+                                      road.time_step, (road.random, road.random_block, road.random_position)
+                                      if first else None, next_vehicle_id if first else None)))
+
+        for i in range(num_segments):
+            self.receive(i)
+
+        # Vehicles that crossed into each segment in the last step, and the first and last vehicle of each segment in
+        # each lane
+        self.incoming = [[] for _ in range(num_segments)]
+        self.first_vehicles = []
+        self.last_vehicles = []
+        for segment_records in records:
+            first_vehicles = [None] * self.num_lanes
+            last_vehicles = [None] * self.num_lanes
+            for record in segment_records:
+                if first_vehicles[record.lane] is None:
+                    first_vehicles[record.lane] = record
+                last_vehicles[record.lane] = record
+
+            self.first_vehicles.append(first_vehicles)
+            self.last_vehicles.append(last_vehicles)
+
+        for counter in COUNTERS:
+            setattr(self, counter, getattr(road, counter))
+        self.counters = [dict.fromkeys(COUNTERS, 0) for _ in range(num_segments)]
+
+    def receive(self, segment):
+        result = self.connections[segment].recv()
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def request(self, segment, command, *args):
+        self.connections[segment].send((command, args))
+        return self.receive(segment)
+
+    def get_front_ghosts(self, segment):
+        """Last vehicle in each lane of the closest segment ahead that has a vehicle in the lane"""
+        ghosts = []
+        for lane in range(self.num_lanes):
+            for last_vehicles in self.last_vehicles[segment + 1:]:
+                if last_vehicles[lane] is not None:
+                    ghosts.append(last_vehicles[lane])
+                    break
+
+        return ghosts
+
+    def get_back_ghosts(self, segment):
+        """First vehicle in each lane of the closest segment behind that has a vehicle in the lane"""
+        ghosts = []
+        for lane in range(self.num_lanes):
+            for first_vehicles in reversed(self.first_vehicles[:segment]):
+                if first_vehicles[lane] is not None:
+                    ghosts.append(first_vehicles[lane])
+                    break
+
+        return ghosts
+
+    def update(self, time):
+        for i, connection in enumerate(self.connections):
+            back_ghosts = self.get_back_ghosts(i) if self.num_lanes > 1 else []
+            connection.send(('begin_step', (time, self.incoming[i], self.get_front_ghosts(i), back_ghosts)))
+
+        # The lane changes are applied from the front segment to the back one, each segment can finish its step as
+        # soon as it applied them
+        events = []
+        for i in reversed(range(self.num_segments)):
+            self.receive(i)
+            if self.num_lanes > 1:
+                events = self.request(i, 'apply_segment_lane_changes', events, time)
+            self.connections[i].send(('finish_step', (time,)))
+
+        results = [self.receive(i) for i in range(self.num_segments)]
+
+        # Vehicles that crossed into a segment are placed behind the ones already in it, those of the closest segment
+        # behind first
+        self.incoming = [[] for _ in range(self.num_segments)]
+        for i in reversed(range(self.num_segments)):
+            for record in results[i][0]:
+                self.incoming[bisect_right(self.borders, record.position)].append(record)
+
+        for i, (_, (first_vehicles, last_vehicles), counters) in enumerate(results):
+            for record in self.incoming[i]:
+                first_vehicle = first_vehicles[record.lane]
+                if first_vehicle is None or record.position > first_vehicle.position:
+                    first_vehicles[record.lane] = record
+
+                last_vehicle = last_vehicles[record.lane]
+                if last_vehicle is None or record.position <= last_vehicle.position:
+                    last_vehicles[record.lane] = record
+
+            self.first_vehicles[i] = first_vehicles
+            self.last_vehicles[i] = last_vehicles
+            self.add_counters(i, counters)
+
+    def add_counters(self, segment, counters):
+        for counter, value in counters.items():
+            setattr(self, counter, getattr(self, counter) + value - self.counters[segment][counter])
+        self.counters[segment] = counters
+
+    @property
+    def vehicles(self):
+        """List with a copy of the vehicles on the road, sorted by decreasing position and linked per lane"""
+        vehicles = []
+        for i in reversed(range(self.num_segments)):
+            for record in self.request(i, 'get_vehicle_records') + self.incoming[i]:
+                vehicle = record.vehicle_class.__new__(record.vehicle_class)
+                vehicle.vehicle_id, vehicle.position, vehicle.velocity, vehicle.acceleration, vehicle.gap, \
+                    vehicle.lane, vehicle.last_lane_change_time = record[1:8]
+                vehicle.traffic_model = self.models[record.traffic_model]
+                vehicle.lane_change_model = self.models[record.lane_change_model]
+                vehicles.append(vehicle)
+
+        vehicles.sort(key=lambda x: x.position, reverse=True)
+
+        last_vehicles = [None] * self.num_lanes
+        for vehicle in vehicles:
+            vehicle.next_vehicle = last_vehicles[vehicle.lane]
+            vehicle.prev_vehicle = None
+            if vehicle.next_vehicle is not None:
+                vehicle.next_vehicle.prev_vehicle = vehicle
+            vehicle.update_gap()
+            last_vehicles[vehicle.lane] = vehicle
+
+        return vehicles
+
+    def add_obstacle(self, lane, at_position):
+        if not 0 <= lane < self.num_lanes:
+            return
+
+        # Vehicle ids are handed out by the first segment, which creates the new vehicles
+        record = VehicleRecord(Obstacle, self.request(0, 'allocate_vehicle_id'), at_position, 0, 0, math.inf, lane, 0,
+                               -1, -1)
+        segment = bisect_right(self.borders, at_position)
+        self.first_vehicles[segment], self.last_vehicles[segment] = self.request(segment, 'add_segment_obstacle',
+                                                                                 record)
+        self.inserted_vehicle_count += 1
+        self.counters[segment]['inserted_vehicle_count'] += 1
+
+    def remove_obstacle(self, lane, at_position):
+        if not 0 <= lane < self.num_lanes:
+            return
+
+        segment = bisect_right(self.borders, at_position)
+        self.first_vehicles[segment], self.last_vehicles[segment] = self.request(segment, 'remove_segment_obstacle',
+                                                                                 lane, at_position)
+
+    def close(self):
+        """Stop the worker processes"""
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(('close', None))
+            process.join()
+            connection.close()
+
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,113 +1,116 @@
-from traffic_models import *
-from lane_change_models import *
-from road import *
+from scenario import load_scenario, create_road
+from trajectory_recorder import TrajectoryRecorder, load_trajectories
+import argparse
 import os
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-TIME_STEP = 0.5
-MAX_TIME = 600
 
-NUM_LANES = 1
+def plot(output_directory, time_range, velocities, accelerations, positions, gap, lanes, labels, traffic_model,
+         num_lanes, show=False):
+    # Plotting is optional, so matplotlib is only imported when it is needed
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-SCENARIO_NAME = 'braking'
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
 
-
-def plot(time_range, velocities, accelerations, positions, gap, lanes, labels, traffic_model, num_lanes):
-    if not os.path.exists(SCENARIO_NAME):
-        os.makedirs(SCENARIO_NAME)
+    def finish_figure(file_name):
+        plt.legend(labels, loc="lower right")
+        plt.savefig(f'{output_directory}/{file_name}_{traffic_model}.png')
+        if show:
+            plt.show()
+        plt.close()
 
     plt.plot(time_range, velocities)
     plt.title("Velocities over time")
     plt.xlabel("Time in seconds")
     plt.ylabel("Velocity in km/h")
-    plt.legend(labels, loc="lower right")
-    plt.savefig(f'{SCENARIO_NAME}/velocities_{traffic_model}.png')
-    plt.show()
+    finish_figure('velocities')
 
     plt.plot(time_range, accelerations)
     plt.title("Accelerations over time")
     plt.xlabel("Time in seconds")
     plt.ylabel(r"Acceleration in $\mathregular{m/s^2}$")
-    plt.legend(labels, loc="lower right")
-    plt.savefig(f'{SCENARIO_NAME}/accelerations_{traffic_model}.png')
-    plt.show()
+    finish_figure('accelerations')
 
     plt.plot(time_range, positions)
     plt.title("Positions over time")
     plt.xlabel("Time in seconds")
     plt.ylabel("Position in meters")
-    plt.legend(labels, loc="lower right")
-    plt.savefig(f'{SCENARIO_NAME}/positions_{traffic_model}.png')
-    plt.show()
+    finish_figure('positions')
 
     plt.plot(time_range, gap)
     plt.title("Gap to front vehicles over time")
     plt.xlabel("Time in seconds")
     plt.ylabel("Gap in meters")
-    plt.legend(labels, loc="lower right")
-    plt.savefig(f'{SCENARIO_NAME}/gaps_{traffic_model}.png')
-    plt.show()
+    finish_figure('gaps')
 
     plt.plot(time_range, lanes)
     plt.title("Lanes over time")
     plt.xlabel("Time in seconds")
     plt.ylabel("Lane (indexed from left to right)")
     plt.yticks([i for i in range(num_lanes)])
-    plt.legend(labels, loc="lower right")
-    plt.savefig(f'{SCENARIO_NAME}/lanes_{traffic_model}.png')
-    plt.show()
+    finish_figure('lanes')
+
+
+"""
+    Runs a scenario and records the trajectories of its vehicles.
+
+    Args:
+        scenario: scenario as returned by load_scenario
+        output_directory: directory to write the trajectories to
+
+    Returns:
+        Tuple of the simulated road and the path of the recorded trajectories
+"""
+def run(scenario, output_directory):
+    road = create_road(scenario)
+
+    trajectories_directory = os.path.join(output_directory, 'trajectories')
+    with TrajectoryRecorder(trajectories_directory) as recorder:
+        for time in np.arange(0, scenario['duration'], road.time_step):
+            recorder.record(time, road.vehicles)
+            road.update(time)
+
+    return road, trajectories_directory
+
+
+def plot_trajectories(scenario, trajectories_directory, output_directory, show=False):
+    trajectories = load_trajectories(trajectories_directory)
+    vehicle_ids = trajectories.vehicle_ids()
+    time_range, _, velocities = trajectories.pivot('velocities', vehicle_ids)
+    _, _, accelerations = trajectories.pivot('accelerations', vehicle_ids)
+    _, _, positions = trajectories.pivot('positions', vehicle_ids)
+    _, _, gap = trajectories.pivot('gaps', vehicle_ids)
+    _, _, lanes = trajectories.pivot('lanes', vehicle_ids)
+
+    labels = [f'{class_name} {i + 1}' for i, class_name in enumerate(trajectories.vehicle_class_names(vehicle_ids))]
+    plot(output_directory, time_range, velocities * 3.6, accelerations, positions, gap, lanes, labels,
+         scenario['traffic_model'], num_lanes=scenario['road']['num_lanes'], show=show)
 
 
 def main():
-    traffic_model = IDM()
-    mobil_model = MOBIL(right_bias=0.6)
-    vehicle_factory = VehicleFactory(weights=[1.0, 0, 0, 0],
-                                     default_traffic_model=traffic_model,
-                                     default_lane_change_model=mobil_model)
-
-    vehicle_list = vehicle_factory.create_random_vehicle_row(num=5, spacing=200, lane=0)
-    road = Road(length=200000, num_lanes=NUM_LANES, vehicles=vehicle_list, time_step=TIME_STEP)
-
-    road.add_obstacle(0, 5000)
-
-    velocities = []
-    accelerations = []
-    positions = []
-    gap = []
-    lanes = []
-
-    time_range = np.arange(0, MAX_TIME, TIME_STEP)
-    for time in time_range:
-        velocities_temp = []
-        accelerations_temp = []
-        positions_temp = []
-        gap_temp = []
-        lanes_temp = []
-
-        for vehicle in road.vehicles:
-            if isinstance(vehicle, Obstacle):
-                continue
-
-            velocities_temp.append(vehicle.velocity * 3.6)
-            accelerations_temp.append(vehicle.acceleration)
-            positions_temp.append(vehicle.position)
-            gap_temp.append(vehicle.gap)
-            lanes_temp.append(vehicle.lane)
-
-        velocities.append(velocities_temp)
-        accelerations.append(accelerations_temp)
-        positions.append(positions_temp)
-        gap.append(gap_temp)
-        lanes.append(lanes_temp)
-
-        road.update(time)
-
-    labels = [f'{v.__class__.__name__} {i + 1}'
-              for i, v in enumerate([veh for veh in vehicle_list if not isinstance(veh, Obstacle)])]
-    traffic_model_name = traffic_model.__class__.__name__
-    plot(time_range, velocities, accelerations, positions, gap, lanes, labels, traffic_model_name, num_lanes=NUM_LANES)
-
-
-main()
+    parser = argparse.ArgumentParser(description='Simulate a traffic scenario.')
+    parser.add_argument('scenario', nargs='?', default=None,
+                        help='JSON scenario file, see scenario.DEFAULT_SCENARIO (the braking scenario if omitted)')
+    parser.add_argument('--output', default=None, help='output directory, the name of the scenario by default')
+    parser.add_argument('--plot', action='store_true', help='save plots of the trajectories')
+    parser.add_argument('--show', action='store_true', help='save and show plots of the trajectories')
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+    output_directory = scenario['name'] if args.output is None else args.output
+
+    road, trajectories_directory = run(scenario, output_directory)
+    print(f'Simulated {scenario["duration"]} s, {road.removed_vehicle_count} vehicles left the road, '
+          f'trajectories are in {trajectories_directory}')
+
+    if args.plot or args.show:
+        plot_trajectories(scenario, trajectories_directory, output_directory, show=args.show)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import json
+import math
+import os
+
+import numpy as np
+
+
+class SpaceTimeGrid:
+    """
+    Online aggregation of the traffic on a road into a space-time grid, with a cell per lane, road segment of
+    cell_length meters and time slice of slice_duration seconds. Creating a SpaceTimeGrid attaches it to the road,
+    after which every time step adds the distance travelled and the time spent by each vehicle to the cell the vehicle
+    is in at the start of the step. Vehicles that cross a cell boundary within a step are counted in the cell they
+    started in, which is accurate when cells are much longer than the distance travelled in a step.
+
+    Only the time slice in progress is kept in memory: finished slices are appended to the output files in directory
+    right away, so memory use does not depend on the length of the run. The flow, density and mean speed of each cell
+    follow Edie's generalized definitions:
+        flow = total distance travelled / (length of the cell * slice_duration)  [vehicles/hour]
+        density = total time spent / (length of the cell * slice_duration)  [vehicles/m]
+    All cells are cell_length long, except the last one, which ends at the end of the road.
+        speed = total distance travelled / total time spent  [m/s], NaN for cells without vehicles
+
+    Args:
+        road: road to aggregate
+        directory: directory to write the finished slices to, it is created if it does not exist
+        cell_length: length of the road segment of a cell [m]
+        slice_duration: duration of a time slice [s], rounded to a whole number of time steps of the road
+        start_time: simulation time of the first step that is aggregated [s]
+    """
+    DEFAULT_CELL_LENGTH = 100
+    DEFAULT_SLICE_DURATION = 60
+
+    # Edie's totals of each cell, written to an output file per total
+    TOTALS = ('distances', 'times')
+
+    def __init__(self, road, directory, cell_length=DEFAULT_CELL_LENGTH, slice_duration=DEFAULT_SLICE_DURATION,
+                 start_time=0):
+        self.road = road
+        self.directory = directory
+        self.cell_length = cell_length
+        self.time_step = road.time_step
+        self.slice_steps = max(1, round(slice_duration / road.time_step))
+        self.slice_duration = self.slice_steps * road.time_step
+        self.start_time = start_time
+
+        self.length = road.length
+        self.num_lanes = road.num_lanes
+        self.num_cells = max(1, math.ceil(road.length / cell_length))
+
+        self.distances = np.zeros(self.num_lanes * self.num_cells)
+        self.times = np.zeros(self.num_lanes * self.num_cells)
+        self.steps = 0
+        self.slice_count = 0
+        # Edie's totals of the last finished slice, with a row per lane and a column per cell
+        self.last_slice = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.output_files = {name: open(os.path.join(directory, f'{name}.bin'), 'wb') for name in self.TOTALS}
+
+        road.space_time_grids.append(self)
+
+    """
+        Adds a time step to the slice in progress.
+
+        Args:
+            positions, velocities, lanes: arrays with the state of the vehicles (without obstacles) at the start of
+                                          the step
+    """
+    def update(self, positions, velocities, lanes):
+        cells = np.minimum((positions // self.cell_length).astype(int), self.num_cells - 1)
+        on_road = (cells >= 0) & (lanes >= 0) & (lanes < self.num_lanes)
+        cell_ids = lanes[on_road] * self.num_cells + cells[on_road]
+
+        size = self.distances.size
+        self.distances += np.bincount(cell_ids, weights=velocities[on_road] * self.time_step, minlength=size)
+        self.times += np.bincount(cell_ids, minlength=size) * self.time_step
+
+        self.steps += 1
+        if self.steps % self.slice_steps == 0:
+            self.finish_slice()
+
+    def finish_slice(self):
+        """Append the slice in progress to the output files, and start a new one"""
+        self.last_slice = {'distances': self.distances.reshape(self.num_lanes, self.num_cells),
+                           'times': self.times.reshape(self.num_lanes, self.num_cells)}
+        for name, output_file in self.output_files.items():
+            getattr(self, name).tofile(output_file)
+            output_file.flush()
+
+        self.slice_count += 1
+        self.distances = np.zeros_like(self.distances)
+        self.times = np.zeros_like(self.times)
+
+    def close(self):
+        """Detach the grid from the road, and convert the output files to .npy files (an unfinished slice is dropped)"""
+        if self in self.road.space_time_grids:
+            self.road.space_time_grids.remove(self)
+
+        shape = (self.slice_count, self.num_lanes, self.num_cells)
+        for name, output_file in self.output_files.items():
+            output_file.close()
+
+            raw_path = os.path.join(self.directory, f'{name}.bin')
+            totals = np.lib.format.open_memmap(os.path.join(self.directory, f'{name}.npy'), mode='w+',
+                                               dtype=np.float64, shape=shape)
+
+            # Copy a slice at a time, so the whole grid never has to fit in memory
+            if self.slice_count > 0:
+                raw_totals = np.memmap(raw_path, dtype=np.float64, mode='r', shape=shape)
+                for i in range(self.slice_count):
+                    totals[i] = raw_totals[i]
+                del raw_totals
+
+            totals.flush()
+            del totals
+            os.remove(raw_path)
+
+        with open(os.path.join(self.directory, 'metadata.json'), 'w') as metadata_file:
+            json.dump({'slices': self.slice_count, 'num_lanes': self.num_lanes, 'num_cells': self.num_cells,
+                       'cell_length': self.cell_length, 'length': self.length,
+                       'slice_duration': self.slice_duration, 'start_time': self.start_time}, metadata_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SpaceTimeGridData:
+    """
+    Space-time grid written by SpaceTimeGrid, loaded with load_space_time_grid. distances and times are read-only
+    memory-mapped arrays with Edie's totals, indexed by time slice, lane and cell.
+
+    Args:
+        directory: directory the grid was written to
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'metadata.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+
+        self.cell_length = metadata['cell_length']
+        # Grids written before the road length was saved are taken to end at the end of their last cell
+        self.length = metadata.get('length', metadata['num_cells'] * metadata['cell_length'])
+        self.slice_duration = metadata['slice_duration']
+        self.start_time = metadata['start_time']
+
+        for name in SpaceTimeGrid.TOTALS:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+
+    def slice_times(self):
+        """Start time of each slice [s]"""
+        return self.start_time + np.arange(self.distances.shape[0]) * self.slice_duration
+
+    def cell_positions(self):
+        """Start position of each cell [m]"""
+        return np.arange(self.distances.shape[2]) * self.cell_length
+
+    def cell_lengths(self):
+        """Length of each cell [m], the last cell ends at the end of the road"""
+        return np.minimum(self.cell_length, self.length - self.cell_positions())
+
+    def flow(self, lane=None):
+        """Flow per slice and cell [vehicles/hour], of a single lane or summed over all lanes if lane is None"""
+        return self.get_totals('distances', lane) / (self.cell_lengths() * self.slice_duration) * 3600
+
+    def density(self, lane=None):
+        """Density per slice and cell [vehicles/m], of a single lane or summed over all lanes if lane is None"""
+        return self.get_totals('times', lane) / (self.cell_lengths() * self.slice_duration)
+
+    def speed(self, lane=None):
+        """Space-mean speed per slice and cell [m/s], NaN where there were no vehicles"""
+        distances = self.get_totals('distances', lane)
+        times = self.get_totals('times', lane)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(times > 0, distances / times, np.nan)
+
+    def get_totals(self, name, lane):
+        totals = getattr(self, name)
+        return totals.sum(axis=1) if lane is None else np.asarray(totals[:, lane])
+
+
+def load_space_time_grid(directory):
+    return SpaceTimeGridData(directory)
@@ -0,0 +1,236 @@
+from traffic_models import *
+from lane_change_models import *
+from road import *
+from scenario import TRAFFIC_MODELS, ROADS, spawn_seeds
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time as timer
+
+import numpy as np
+
+
+"""
+Parameters of a single run, every one of them can be swept by listing multiple values in the grid:
+    traffic_model: name of the longitudinal traffic model, see TRAFFIC_MODELS
+    politeness_factor, right_bias: parameters of the MOBIL lane change model
+    weights: VehicleFactory weights for Cars, Trucks, AggressiveCars and PassiveCars
+    road: name of the road implementation, see ROADS
+    length, num_lanes, insertion_gap, insertion_chance, time_step: parameters of the road
+    duration: simulated time [s]
+    warmup: time [s] before the density and speed are sampled
+    sample_interval: time [s] between two samples of the density and speed
+    measure_position: position at which the traffic flow is measured [m], the middle of the road if None
+    seed: seed of the random number generators of the road and the vehicle factory
+"""
+DEFAULT_PARAMETERS = {
+    'traffic_model': 'IDM',
+    'politeness_factor': MOBIL.DEFAULT_POLITENESS_FACTOR,
+    'right_bias': MOBIL.DEFAULT_RIGHT_BIAS,
+    'weights': [1, 1, 1, 1],
+    'road': 'Road',
+    'length': 5000,
+    'num_lanes': Road.DEFAULT_NUM_LANES,
+    'insertion_gap': Road.DEFAULT_INSERTION_GAP,
+    'insertion_chance': Road.DEFAULT_INSERTION_CHANCE,
+    'time_step': Road.DEFAULT_TIME_STEP,
+    'duration': 600,
+    'warmup': 120,
+    'sample_interval': 10,
+    'measure_position': None,
+    'seed': 0,
+}
+
+METRICS = ['flow', 'density', 'mean_speed', 'vehicle_count', 'removed_vehicle_count', 'wall_time']
+
+
+"""
+    Args:
+        grid: dict mapping parameter names to a list of values, parameters that are not in it keep their default value
+
+    Returns:
+        List with the parameters of every combination of values in the grid
+"""
+def expand_grid(grid):
+    unknown = set(grid) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown parameters: {", ".join(sorted(unknown))}')
+
+    names = list(grid)
+    runs = []
+    for values in product(*(grid[name] for name in names)):
+        parameters = dict(DEFAULT_PARAMETERS)
+        parameters.update(zip(names, values))
+        runs.append(parameters)
+
+    return runs
+
+
+def get_run_id(parameters):
+    """Identifier of a run that only depends on its parameters, used to recognize finished runs when resuming"""
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
+
+
+"""
+    Simulates a single scenario, this function is executed in the worker processes.
+
+    Args:
+        parameters: dict with the parameters of the run, see DEFAULT_PARAMETERS
+
+    Returns:
+        Dict with the summary metrics of the run:
+            flow: traffic flow at the measure position at the end of the run [vehicles/hour]
+            density: mean number of vehicles per meter of road
+            mean_speed: mean velocity of the vehicles on the road [m/s]
+            vehicle_count, removed_vehicle_count: vehicles on the road at the end and vehicles that left the road
+            wall_time: time the simulation took [s]
+"""
+def run_scenario(parameters):
+    start = timer.perf_counter()
+    road_seed, factory_seed = spawn_seeds(parameters['seed'])
+
+    time_step = parameters['time_step']
+    traffic_model = TRAFFIC_MODELS[parameters['traffic_model']](time_step)
+    lane_change_model = MOBIL(politeness_factor=parameters['politeness_factor'], right_bias=parameters['right_bias'])
+    vehicle_factory = VehicleFactory(parameters['weights'], traffic_model, lane_change_model, seed=factory_seed,
+                                     pool_size=VehicleFactory.REUSE_POOL_SIZE)
+
+    road = ROADS[parameters['road']](length=parameters['length'], num_lanes=parameters['num_lanes'],
+                                     vehicle_factory=vehicle_factory, insertion_gap=parameters['insertion_gap'],
+                                     insertion_chance=parameters['insertion_chance'], time_step=time_step,
+                                     seed=road_seed)
+
+    measure_position = parameters['measure_position']
+    if measure_position is None:
+        measure_position = parameters['length'] / 2
+
+    densities = []
+    speeds = []
+    next_sample_time = parameters['warmup']
+
+    time = 0
+    for time in np.arange(0, parameters['duration'], time_step):
+        road.update(time)
+
+        if time >= next_sample_time:
+            next_sample_time += parameters['sample_interval']
+            velocities = [vehicle.velocity for vehicle in road.vehicles if not isinstance(vehicle, Obstacle)]
+
+            densities.append(road.vehicle_density())
+            if velocities:
+                speeds.append(sum(velocities) / len(velocities))
+
+    end_time = time + time_step
+    return {
+        'flow': road.get_traffic_flow(measure_position, end_time),
+        'density': sum(densities) / len(densities) if densities else 0,
+        'mean_speed': sum(speeds) / len(speeds) if speeds else 0,
+        'vehicle_count': sum(not isinstance(vehicle, Obstacle) for vehicle in road.vehicles),
+        'removed_vehicle_count': road.removed_vehicle_count,
+        'wall_time': timer.perf_counter() - start,
+    }
+
+
+def run_with_id(run_id, parameters):
+    return run_id, parameters, run_scenario(parameters)
+
+
+"""
+    Reads the finished runs from a results table, dropping an incomplete last row left behind by an interruption.
+
+    Returns:
+        Set with the run ids in the table
+"""
+def read_finished_runs(results_path, columns):
+    if not os.path.exists(results_path):
+        return set()
+
+    with open(results_path, 'rb+') as results_file:
+        content = results_file.read()
+        complete_length = content.rfind(b'\n') + 1
+        if complete_length < len(content):
+            results_file.truncate(complete_length)
+
+    with open(results_path, newline='') as results_file:
+        reader = csv.DictReader(results_file)
+        if reader.fieldnames is None:
+            return set()
+
+        if reader.fieldnames != columns:
+            raise ValueError(f'The columns of {results_path} do not match the parameters of the sweep')
+
+        return {row['run_id'] for row in reader}
+
+
+"""
+    Runs every combination of parameters in the grid in a process pool, and appends the results to a CSV table as soon
+    as each run finishes. Runs that are already in the table are skipped, so an interrupted sweep can be resumed by
+    calling the function again with the same arguments.
+
+    Args:
+        grid: dict mapping parameter names to a list of values, see DEFAULT_PARAMETERS
+        results_path: path of the CSV results table, with one row per run
+        max_workers: number of worker processes, the number of CPUs if None
+
+    Returns:
+        Number of runs that were executed
+"""
+def run_sweep(grid, results_path, max_workers=None):
+    runs = {get_run_id(parameters): parameters for parameters in expand_grid(grid)}
+    columns = ['run_id'] + list(DEFAULT_PARAMETERS) + METRICS
+
+    finished_runs = read_finished_runs(results_path, columns)
+    pending_runs = {run_id: parameters for run_id, parameters in runs.items() if run_id not in finished_runs}
+    if not pending_runs:
+        return 0
+
+    write_header = not os.path.exists(results_path) or os.path.getsize(results_path) == 0
+    with open(results_path, 'a', newline='') as results_file:
+        writer = csv.DictWriter(results_file, columns)
+        if write_header:
+            writer.writeheader()
+            results_file.flush()
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_with_id, run_id, parameters)
+                       for run_id, parameters in pending_runs.items()]
+
+            for future in as_completed(futures):
+                run_id, parameters, metrics = future.result()
+
+                row = {name: json.dumps(value) if isinstance(value, (list, type(None))) else value
+                       for name, value in parameters.items()}
+                row.update(metrics)
+                row['run_id'] = run_id
+
+                writer.writerow(row)
+                results_file.flush()
+
+    return len(pending_runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a parameter sweep of traffic simulations in parallel.')
+    parser.add_argument('grid', help='JSON file mapping parameter names to lists of values')
+    parser.add_argument('results', help='CSV file the results are appended to, finished runs are skipped')
+    parser.add_argument('--seeds', type=int, default=None,
+                        help='run every combination with seeds 0 to SEEDS - 1, unless the grid lists the seeds')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    with open(args.grid) as grid_file:
+        grid = json.load(grid_file)
+
+    if args.seeds is not None and 'seed' not in grid:
+        grid['seed'] = list(range(args.seeds))
+
+    run_count = run_sweep(grid, args.results, args.workers)
+    print(f'Finished {run_count} runs, results are in {args.results}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,27 @@
 import math
+import numpy as np
 from vehicle import Vehicle, Obstacle
 
 
+# Distance [m] added to the interaction horizons, so rounding errors cannot move a vehicle across a horizon
+INTERACTION_HORIZON_MARGIN = 1
+
+
+def power(base, exponent):
+    """base ** exponent for an integer exponent >= 1, by repeated squaring. Unlike **, which NumPy computes differently
+    from Python for some floats, this gives the same result for floats and for arrays of them, so the scalar and
+    batched models take the same decisions"""
+    result = None
+    while exponent > 0:
+        if exponent % 2 == 1:
+            result = base if result is None else result * base
+        exponent //= 2
+        if exponent > 0:
+            base = base * base
+
+    return result
+
+
 class IDM:
     # Minimum gap between two vehicles [m], 1000+ meters models free road
     MINIMUM_GAP = 2
@@ -21,18 +41,64 @@ class IDM:
                                 / (2 * math.sqrt(vehicle.max_acceleration * vehicle.comfortable_deceleration)))
 
             desired_gap = self.MINIMUM_GAP + max(0, desired_distance)
-            acceleration_interaction = (desired_gap / max(vehicle.gap, self.MINIMUM_GAP)) ** 2
+            acceleration_interaction = power(desired_gap / max(vehicle.gap, self.MINIMUM_GAP), 2)
             if vehicle.gap >= desired_gap:
                 acceleration_interaction = 0
         else:
             # No car in front, so there is no "interaction" variable needed
             acceleration_interaction = 0
 
-        acceleration_free_road = 1 - (vehicle.velocity / vehicle.desired_velocity) ** self.ACCELERATION_EXPONENT
+        acceleration_free_road = 1 - power(vehicle.velocity / vehicle.desired_velocity, self.ACCELERATION_EXPONENT)
         new_acceleration = vehicle.max_acceleration * (acceleration_free_road - acceleration_interaction)
 
         return new_acceleration
 
+    """
+        The interaction term vanishes once the gap reaches the desired gap, which is largest for a leader that stands
+        still. So as long as a vehicle does not drive faster than its desired velocity, a leader further away than the
+        desired gap at the desired velocity (plus INTERACTION_HORIZON_MARGIN against rounding) has no influence.
+
+        Args:
+            vehicle_class: class of the vehicle, with its VehicleParameters as class attributes
+
+        Returns:
+            The gap [m] from which on calculate_acceleration equals calculate_free_road_acceleration
+    """
+    def interaction_horizon(self, vehicle_class):
+        velocity = vehicle_class.desired_velocity
+        return (self.MINIMUM_GAP + velocity * vehicle_class.desired_time_headway
+                + velocity ** 2 / (2 * math.sqrt(vehicle_class.max_acceleration
+                                                 * vehicle_class.comfortable_deceleration))
+                + INTERACTION_HORIZON_MARGIN)
+
+    def calculate_free_road_acceleration(self, vehicle: Vehicle):
+        """Acceleration of a vehicle whose leader is beyond the interaction horizon"""
+        acceleration_free_road = 1 - power(vehicle.velocity / vehicle.desired_velocity, self.ACCELERATION_EXPONENT)
+        return vehicle.max_acceleration * (acceleration_free_road - 0)
+
+    """
+        Batched version of calculate_acceleration, all arguments are arrays with one entry per vehicle.
+        Vehicles without a leader have an infinite gap (or a False entry in has_next), their next_velocity is ignored.
+
+        Returns:
+            Array with the new accelerations
+    """
+    def calculate_accelerations(self, velocity, gap, next_velocity, desired_velocity, desired_time_headway,
+                                max_acceleration, comfortable_deceleration, has_next=None):
+        if has_next is not None:
+            gap = np.where(has_next, gap, math.inf)
+
+        delta_velocity = velocity - next_velocity
+        desired_distance = ((velocity * desired_time_headway)
+                            + (velocity * delta_velocity) / (2 * np.sqrt(max_acceleration * comfortable_deceleration)))
+
+        desired_gap = self.MINIMUM_GAP + np.maximum(0, desired_distance)
+        acceleration_interaction = np.where(gap >= desired_gap, 0,
+                                            power(desired_gap / np.maximum(gap, self.MINIMUM_GAP), 2))
+
+        acceleration_free_road = 1 - power(velocity / desired_velocity, self.ACCELERATION_EXPONENT)
+        return max_acceleration * (acceleration_free_road - acceleration_interaction)
+
 
 class Gipps:
     # Minimum gap between two vehicles [m]
@@ -49,8 +115,8 @@ class Gipps:
             return 1 - (vehicle.velocity / vehicle.desired_velocity)
 
         velocity_safe = ((-vehicle.comfortable_deceleration * self.delta_t)
-                         + (math.sqrt(vehicle.comfortable_deceleration ** 2 * self.delta_t ** 2
-                                      + next_vehicle.velocity ** 2 + 2 * vehicle.comfortable_deceleration
+                         + (math.sqrt(power(vehicle.comfortable_deceleration, 2) * power(self.delta_t, 2)
+                                      + power(next_vehicle.velocity, 2) + 2 * vehicle.comfortable_deceleration
                                       * max(vehicle.gap - self.MINIMUM_GAP, 0))))
 
         new_velocity = min(velocity_safe, min(vehicle.velocity + vehicle.max_acceleration * self.delta_t,
@@ -58,3 +124,49 @@ class Gipps:
         new_acceleration = (new_velocity - vehicle.velocity) / self.delta_t
 
         return new_acceleration
+
+    """
+        The safe velocity grows with the gap, and exceeds the velocity reached by accelerating at the maximum rate
+        for any leader velocity once the gap is large enough. Beyond this gap (plus INTERACTION_HORIZON_MARGIN against
+        rounding), evaluated at the desired velocity, the leader has no influence on a vehicle that does not drive
+        faster than its desired velocity.
+
+        Args:
+            vehicle_class: class of the vehicle, with its VehicleParameters as class attributes
+
+        Returns:
+            The gap [m] from which on calculate_acceleration equals calculate_free_road_acceleration
+    """
+    def interaction_horizon(self, vehicle_class):
+        deceleration = vehicle_class.comfortable_deceleration
+        reachable_velocity = (vehicle_class.desired_velocity + vehicle_class.max_acceleration * self.delta_t
+                              + deceleration * self.delta_t)
+        return self.MINIMUM_GAP + reachable_velocity ** 2 / (2 * deceleration) + INTERACTION_HORIZON_MARGIN
+
+    def calculate_free_road_acceleration(self, vehicle: Vehicle):
+        """Acceleration of a vehicle whose leader is beyond the interaction horizon"""
+        new_velocity = min(vehicle.velocity + vehicle.max_acceleration * self.delta_t, vehicle.desired_velocity)
+        return (new_velocity - vehicle.velocity) / self.delta_t
+
+    """
+        Batched version of calculate_acceleration, all arguments are arrays with one entry per vehicle.
+        Vehicles without a leader have an infinite gap (or a False entry in has_next), their next_velocity is ignored.
+
+        Returns:
+            Array with the new accelerations
+    """
+    def calculate_accelerations(self, velocity, gap, next_velocity, desired_velocity, desired_time_headway,
+                                max_acceleration, comfortable_deceleration, has_next=None):
+        free_road = np.isinf(gap) if has_next is None else ~has_next
+        finite_gap = np.where(free_road, 0, gap)
+
+        velocity_safe = ((-comfortable_deceleration * self.delta_t)
+                         + np.sqrt(power(comfortable_deceleration, 2) * power(self.delta_t, 2)
+                                   + power(next_velocity, 2) + 2 * comfortable_deceleration
+                                   * np.maximum(finite_gap - self.MINIMUM_GAP, 0)))
+
+        new_velocity = np.minimum(velocity_safe, np.minimum(velocity + max_acceleration * self.delta_t,
+                                                            desired_velocity))
+        new_acceleration = (new_velocity - velocity) / self.delta_t
+
+        return np.where(free_road, 1 - (velocity / desired_velocity), new_acceleration)
@@ -0,0 +1,206 @@
+from vehicle import *
+from operator import attrgetter
+import glob
+import json
+import os
+
+import numpy as np
+
+
+class TrajectoryRecorder:
+    """
+    Records the trajectories of the vehicles on a road to disk. Every call to record adds one row per vehicle to a
+    fixed size in-memory buffer, each column of the buffer is written to its own .npy chunk file once the buffer is
+    full. Closing the recorder merges the chunks into a single .npy file per column, which load_trajectories maps back
+    into memory.
+
+    The recorded COLUMNS are:
+        times: simulation time of the row [s]
+        ids: vehicle_id of the vehicle
+        class_ids: index of the vehicle's class name in class_names
+        lanes, positions, velocities, accelerations, gaps: state of the vehicle
+
+    Args:
+        directory: directory to write the trajectories to, it is created if it does not exist
+        buffer_size: number of rows kept in memory before they are written to a chunk
+        include_obstacles: whether to record obstacles as well
+    """
+    DEFAULT_BUFFER_SIZE = 2 ** 16
+
+    COLUMNS = (('times', np.float64), ('ids', np.int64), ('class_ids', np.int16), ('lanes', np.int32),
+               ('positions', np.float64), ('velocities', np.float64), ('accelerations', np.float64),
+               ('gaps', np.float64))
+
+    VEHICLE_ATTRIBUTES = (('ids', 'vehicle_id'), ('lanes', 'lane'), ('positions', 'position'),
+                          ('velocities', 'velocity'), ('accelerations', 'acceleration'), ('gaps', 'gap'))
+
+    def __init__(self, directory, buffer_size=DEFAULT_BUFFER_SIZE, include_obstacles=False):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.include_obstacles = include_obstacles
+
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, 'chunk_*.npy')):
+            os.remove(path)
+
+        self.buffer = {name: np.empty(buffer_size, dtype) for name, dtype in self.COLUMNS}
+        self.buffered_rows = 0
+        self.chunk_count = 0
+        self.row_count = 0
+
+        self.class_names = []
+        self.class_ids = {}
+
+    def get_class_id(self, vehicle_class):
+        if vehicle_class not in self.class_ids:
+            self.class_ids[vehicle_class] = len(self.class_names)
+            self.class_names.append(vehicle_class.__name__)
+
+        return self.class_ids[vehicle_class]
+
+    """
+        Args:
+            time: current time elapsed in the simulation
+            vehicles: vehicles to record, e.g. the vehicle list of a road
+    """
+    def record(self, time, vehicles):
+        if not self.include_obstacles:
+            vehicles = [vehicle for vehicle in vehicles if not isinstance(vehicle, Obstacle)]
+
+        start = 0
+        while start < len(vehicles):
+            num = min(len(vehicles) - start, self.buffer_size - self.buffered_rows)
+            self.record_rows(time, vehicles[start:start + num])
+            start += num
+
+            if self.buffered_rows == self.buffer_size:
+                self.flush()
+
+    def record_rows(self, time, vehicles):
+        rows = slice(self.buffered_rows, self.buffered_rows + len(vehicles))
+
+        self.buffer['times'][rows] = time
+        self.buffer['class_ids'][rows] = [self.get_class_id(vehicle.__class__) for vehicle in vehicles]
+        for name, attribute in self.VEHICLE_ATTRIBUTES:
+            self.buffer[name][rows] = np.fromiter(map(attrgetter(attribute), vehicles), self.buffer[name].dtype,
+                                                  len(vehicles))
+
+        self.buffered_rows += len(vehicles)
+
+    def flush(self):
+        """Write the buffered rows to a new chunk"""
+        if self.buffered_rows == 0:
+            return
+
+        for name, _ in self.COLUMNS:
+            np.save(self.get_chunk_path(self.chunk_count, name), self.buffer[name][:self.buffered_rows])
+
+        self.row_count += self.buffered_rows
+        self.chunk_count += 1
+        self.buffered_rows = 0
+
+    def get_chunk_path(self, chunk, name):
+        return os.path.join(self.directory, f'chunk_{chunk:06d}_{name}.npy')
+
+    def close(self):
+        """Write the remaining rows and merge the chunks into one .npy file per column"""
+        self.flush()
+
+        for name, dtype in self.COLUMNS:
+            merged = np.lib.format.open_memmap(os.path.join(self.directory, f'{name}.npy'), mode='w+', dtype=dtype,
+                                               shape=(self.row_count,))
+
+            # Copy the chunks one at a time, so the whole column never has to fit in memory
+            start = 0
+            for chunk in range(self.chunk_count):
+                chunk_path = self.get_chunk_path(chunk, name)
+                values = np.load(chunk_path, mmap_mode='r')
+                merged[start:start + values.size] = values
+                start += values.size
+
+                del values
+                os.remove(chunk_path)
+
+            merged.flush()
+            del merged
+
+        with open(os.path.join(self.directory, 'metadata.json'), 'w') as metadata_file:
+            json.dump({'rows': self.row_count, 'class_names': self.class_names}, metadata_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Trajectories:
+    """
+    Recorded trajectories, loaded with load_trajectories. Each of the TrajectoryRecorder.COLUMNS is a read-only
+    memory-mapped array with one entry per recorded row, the rows are ordered by time.
+
+    Args:
+        directory: directory the trajectories were recorded to
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'metadata.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+
+        self.class_names = metadata['class_names']
+        for name, _ in TrajectoryRecorder.COLUMNS:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return self.times.size
+
+    def vehicle_ids(self):
+        """Ids of the recorded vehicles, in order of their first appearance"""
+        ids, first_rows = np.unique(self.ids, return_index=True)
+        return ids[np.argsort(first_rows)]
+
+    def vehicle_class_names(self, vehicle_ids):
+        """Class names of the given vehicles, e.g. to label them in a plot"""
+        ids, first_rows = np.unique(self.ids, return_index=True)
+        class_ids = self.class_ids[first_rows[np.searchsorted(ids, vehicle_ids)]]
+        return [self.class_names[class_id] for class_id in class_ids]
+
+    """
+        Args:
+            vehicle_id: id of the vehicle
+
+        Returns:
+            Dict mapping each column name to the values of the rows of the given vehicle
+    """
+    def vehicle(self, vehicle_id):
+        rows = np.flatnonzero(self.ids == vehicle_id)
+        return {name: getattr(self, name)[rows] for name, _ in TrajectoryRecorder.COLUMNS}
+
+    """
+        Args:
+            name: name of the column, e.g. 'velocities'
+            vehicle_ids: ids of the vehicles to include, all vehicles if None
+
+        Returns:
+            Tuple of the recorded times, the vehicle ids and a matrix with a row per time and a column per vehicle,
+            NaN where a vehicle was not on the road
+    """
+    def pivot(self, name, vehicle_ids=None):
+        if vehicle_ids is None:
+            vehicle_ids = self.vehicle_ids()
+
+        times, time_rows = np.unique(self.times, return_inverse=True)
+        order = np.argsort(vehicle_ids)
+        sorted_ids = np.asarray(vehicle_ids)[order]
+
+        columns = np.searchsorted(sorted_ids, self.ids)
+        columns = np.minimum(columns, sorted_ids.size - 1)
+        selected = sorted_ids[columns] == self.ids
+
+        matrix = np.full((times.size, sorted_ids.size), np.nan)
+        matrix[time_rows[selected], np.argsort(order)[columns[selected]]] = getattr(self, name)[selected]
+
+        return times, np.asarray(vehicle_ids), matrix
+
+
+def load_trajectories(directory):
+    return Trajectories(directory)
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from enum import Enum
+from itertools import count
 import math
 
 
@@ -15,6 +16,29 @@ VehicleParameters = namedtuple('VehicleParameters', ['length', 'desired_velocity
                                                      'max_acceleration', 'comfortable_deceleration'])
 
 
+"""
+Table with the VehicleParameters of every registered vehicle type, indexed by the type_id of the vehicle class.
+"""
+VEHICLE_PARAMETERS = []
+
+
+"""
+    Registers the parameters of a vehicle class, every vehicle of the class shares them: the parameters are class
+    attributes instead of per-vehicle attributes. Subclasses of Vehicle have to be registered before they are used.
+
+    Args:
+        vehicle_class: subclass of Vehicle
+        vehicle_parameters: VehicleParameters of the vehicles of the class
+"""
+def register_vehicle_type(vehicle_class, vehicle_parameters: VehicleParameters):
+    vehicle_class.type_id = len(VEHICLE_PARAMETERS)
+    VEHICLE_PARAMETERS.append(vehicle_parameters)
+
+    vehicle_class.parameters = vehicle_parameters
+    vehicle_class.length, vehicle_class.desired_velocity, vehicle_class.desired_time_headway, \
+        vehicle_class.max_acceleration, vehicle_class.comfortable_deceleration = vehicle_parameters
+
+
 class VehicleType(Enum):
     Car = 1
     Truck = 2
@@ -28,21 +52,30 @@ class Vehicle:
         position: the position of the front of the vehicle
         velocity: velocity of the vehicle
         traffic_model: traffic model used to update the acceleration
-        vehicle_parameters: the length, desired_velocity, desired_time_headway, max_acceleration, and
-                            comfortable_deceleration parameters of the vehicle in the given order
         lane_change_model: lane change model used to determine whether the car will change lanes
         next_vehicle: next vehicle on the road, the vehicle in front of this vehicle
         lane: lane the vehicle is currently on
+
+    Every vehicle gets a unique vehicle_id when it is created, which identifies it in recorded trajectories.
+
+    Vehicles only store their state (in slots, without a per-vehicle __dict__), their parameters (length,
+    desired_velocity, desired_time_headway, max_acceleration and comfortable_deceleration) are shared by all vehicles of
+    the same class, see register_vehicle_type. Calling __init__ again resets a vehicle, so it can be reused as a new one.
     """
-    def __init__(self, position, velocity, vehicle_parameters: VehicleParameters, traffic_model,
-                 lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
+    __slots__ = ('vehicle_id', 'position', 'velocity', 'acceleration', 'gap', 'traffic_model', 'lane_change_model',
+                 'next_vehicle', 'prev_vehicle', 'lane', 'last_lane_change_time')
+
+    ids = count()
+
+    def __init__(self, position, velocity, traffic_model, lane_change_model=None, next_vehicle=None,
+                 prev_vehicle=None, lane=0):
+        self.vehicle_id = next(Vehicle.ids)
+
         self.position = position
         self.velocity = velocity
 
         self.traffic_model = traffic_model
         self.lane_change_model = lane_change_model
-        self.length, self.desired_velocity, self.desired_time_headway, self.max_acceleration, \
-            self.comfortable_deceleration = vehicle_parameters
 
         self.next_vehicle = next_vehicle
         self.prev_vehicle = prev_vehicle
@@ -102,6 +135,8 @@ class Vehicle:
 
 
 class Car(Vehicle):
+    __slots__ = ()
+
     CAR_PARAMETERS = VehicleParameters(
         length=5,
         desired_velocity=100 / 3.6,
@@ -112,11 +147,15 @@ class Car(Vehicle):
 
     def __init__(self, position=0, velocity=CAR_PARAMETERS.desired_velocity, traffic_model=None,
                  lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
-        super().__init__(position, velocity, self.CAR_PARAMETERS, traffic_model,
-                         lane_change_model, next_vehicle, prev_vehicle, lane)
+        super().__init__(position, velocity, traffic_model, lane_change_model, next_vehicle, prev_vehicle, lane)
+
+
+register_vehicle_type(Car, Car.CAR_PARAMETERS)
 
 
 class Truck(Vehicle):
+    __slots__ = ()
+
     TRUCK_PARAMETERS = VehicleParameters(
         length=19,
         desired_velocity=80 / 3.6,
@@ -127,11 +166,15 @@ class Truck(Vehicle):
 
     def __init__(self, position=0, velocity=TRUCK_PARAMETERS.desired_velocity, traffic_model=None,
                  lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
-        super().__init__(position, velocity, self.TRUCK_PARAMETERS, traffic_model,
-                         lane_change_model, next_vehicle, prev_vehicle, lane)
+        super().__init__(position, velocity, traffic_model, lane_change_model, next_vehicle, prev_vehicle, lane)
+
+
+register_vehicle_type(Truck, Truck.TRUCK_PARAMETERS)
 
 
 class AggressiveCar(Vehicle):
+    __slots__ = ()
+
     # Higher desired velocity, max_acceleration, comfortable deceleration and lower desired time headway
     AGGRESSIVE_CAR_PARAMETERS = VehicleParameters(
         length=5,
@@ -143,11 +186,15 @@ class AggressiveCar(Vehicle):
 
     def __init__(self, position=0, velocity=AGGRESSIVE_CAR_PARAMETERS.desired_velocity, traffic_model=None,
                  lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
-        super().__init__(position, velocity, self.AGGRESSIVE_CAR_PARAMETERS, traffic_model,
-                         lane_change_model, next_vehicle, prev_vehicle, lane)
+        super().__init__(position, velocity, traffic_model, lane_change_model, next_vehicle, prev_vehicle, lane)
+
+
+register_vehicle_type(AggressiveCar, AggressiveCar.AGGRESSIVE_CAR_PARAMETERS)
 
 
 class PassiveCar(Vehicle):
+    __slots__ = ()
+
     # Higher desired time gap and lower comfortable deceleration
     PASSIVE_CAR_PARAMETERS = VehicleParameters(
         length=5,
@@ -159,11 +206,15 @@ class PassiveCar(Vehicle):
 
     def __init__(self, position=0, velocity=PASSIVE_CAR_PARAMETERS.desired_velocity, traffic_model=None,
                  lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
-        super().__init__(position, velocity, self.PASSIVE_CAR_PARAMETERS, traffic_model,
-                         lane_change_model, next_vehicle, prev_vehicle, lane)
+        super().__init__(position, velocity, traffic_model, lane_change_model, next_vehicle, prev_vehicle, lane)
+
+
+register_vehicle_type(PassiveCar, PassiveCar.PASSIVE_CAR_PARAMETERS)
 
 
 class Obstacle(Vehicle):
+    __slots__ = ()
+
     OBSTACLE_PARAMETERS = VehicleParameters(
         length=0,
         desired_velocity=0,
@@ -186,5 +237,30 @@ class Obstacle(Vehicle):
 
     def __init__(self, position=0, velocity=OBSTACLE_PARAMETERS.desired_velocity, traffic_model=None,
                  lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
-        super().__init__(position, velocity, self.OBSTACLE_PARAMETERS, traffic_model,
-                         lane_change_model, next_vehicle, prev_vehicle, lane)
+        super().__init__(position, velocity, traffic_model, lane_change_model, next_vehicle, prev_vehicle, lane)
+
+
+register_vehicle_type(Obstacle, Obstacle.OBSTACLE_PARAMETERS)
+
+
+class MovingBottleneck(Vehicle):
+    """
+    Slow vehicle that drives at a constant velocity in its lane, like a road works convoy. It has no traffic model and
+    no lane change model, so it never accelerates or changes lanes; other vehicles follow or overtake it as usual.
+    """
+    __slots__ = ()
+
+    MOVING_BOTTLENECK_PARAMETERS = VehicleParameters(
+        length=12,
+        desired_velocity=30 / 3.6,
+        desired_time_headway=1.7,
+        max_acceleration=0.3,
+        comfortable_deceleration=2.0
+    )
+
+    def __init__(self, position=0, velocity=MOVING_BOTTLENECK_PARAMETERS.desired_velocity, traffic_model=None,
+                 lane_change_model=None, next_vehicle=None, prev_vehicle=None, lane=0):
+        super().__init__(position, velocity, traffic_model, lane_change_model, next_vehicle, prev_vehicle, lane)
+
+
+register_vehicle_type(MovingBottleneck, MovingBottleneck.MOVING_BOTTLENECK_PARAMETERS)
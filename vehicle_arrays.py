@@ -0,0 +1,104 @@
+from vehicle import *
+from itertools import repeat
+from operator import attrgetter
+import numpy as np
+
+
+class VehicleArrays:
+    """
+    Struct of arrays with the state of a list of vehicles, used for batched computations on many vehicles at once.
+    Each of the COLUMNS is a NumPy array with one entry per vehicle, in the order of the given vehicle list:
+        positions, velocities, accelerations, gaps, lanes, last_lane_change_times: state of the vehicles
+        lengths, desired_velocities, desired_time_headways, max_accelerations, comfortable_decelerations:
+            the VehicleParameters of each vehicle, looked up by its type_id in VEHICLE_PARAMETERS
+        obstacles: mask of the Obstacle entries
+        model_ids: index of the vehicle's traffic model in traffic_models, -1 for obstacles and vehicles without one
+        lane_change_model_ids: index of the vehicle's lane change model in lane_change_models, -1 for obstacles and
+                               vehicles without one
+
+    Args:
+        vehicles: list of vehicles
+        traffic_models: list of traffic models that model_ids refer to, models that are not in it yet are appended
+        lane_change_models: list of lane change models that lane_change_model_ids refer to, likewise
+    """
+    COLUMNS = ('positions', 'velocities', 'accelerations', 'gaps', 'lanes', 'last_lane_change_times', 'lengths',
+               'desired_velocities', 'desired_time_headways', 'max_accelerations', 'comfortable_decelerations',
+               'obstacles', 'model_ids', 'lane_change_model_ids')
+
+    def __init__(self, vehicles=(), traffic_models=None, lane_change_models=None):
+        self.traffic_models = [] if traffic_models is None else traffic_models
+        self.lane_change_models = [] if lane_change_models is None else lane_change_models
+
+        num = len(vehicles)
+
+        def column(attribute, dtype=float):
+            return np.fromiter(map(attrgetter(attribute), vehicles), dtype, num)
+
+        self.positions = column('position')
+        self.velocities = column('velocity')
+        self.accelerations = column('acceleration')
+        self.gaps = column('gap')
+        self.lanes = column('lane', int)
+        self.last_lane_change_times = column('last_lane_change_time')
+
+        # The parameters are looked up by the type of the vehicles in the shared table, instead of per vehicle
+        parameters = np.array(VEHICLE_PARAMETERS, dtype=float).reshape(-1, len(VehicleParameters._fields))
+        self.lengths, self.desired_velocities, self.desired_time_headways, self.max_accelerations, \
+            self.comfortable_decelerations = np.ascontiguousarray(parameters[column('type_id', int)].T)
+
+        self.obstacles = np.fromiter(map(isinstance, vehicles, repeat(Obstacle)), bool, num)
+        self.model_ids = self.get_model_ids(vehicles, 'traffic_model', self.traffic_models)
+        self.lane_change_model_ids = self.get_model_ids(vehicles, 'lane_change_model', self.lane_change_models)
+
+    """
+        Args:
+            vehicles: list of vehicles
+            attribute: name of the model attribute of the vehicles
+            models: list of models the ids refer to, the models that are not in it yet are appended
+
+        Returns:
+            Array with the index of the model of each vehicle in models, -1 for obstacles and vehicles without one
+    """
+    def get_model_ids(self, vehicles, attribute, models):
+        model_ids = {id(model): model_id for model_id, model in enumerate(models)}
+        model_ids[id(None)] = -1
+
+        # The mappings are built by builtins instead of loops over the vehicles, as this runs in every step for Road
+        vehicle_models = list(map(attrgetter(attribute), vehicles))
+        for model in dict(zip(map(id, vehicle_models), vehicle_models)).values():
+            if id(model) not in model_ids:
+                model_ids[id(model)] = len(models)
+                models.append(model)
+
+        ids = np.fromiter(map(model_ids.get, map(id, vehicle_models)), int, len(vehicle_models))
+        ids[self.obstacles] = -1
+
+        return ids
+
+    """
+        Args:
+            vehicles: index array of the vehicles for which to calculate the acceleration
+            next_vehicles: index array of the vehicles in front of them, -1 if there is none
+            model_ids: index array of the traffic model to use for each vehicle
+
+        Returns:
+            Array with the accelerations, with the same gap semantics as calculate_acceleration:
+            the gap is the current gap of the vehicle, the next vehicle only provides the velocity
+    """
+    def calculate_accelerations(self, vehicles, next_vehicles, model_ids):
+        accelerations = np.zeros(vehicles.size)
+        has_next = next_vehicles >= 0
+        next_velocities = np.where(has_next, self.velocities[next_vehicles], 0)
+
+        for model_id, traffic_model in enumerate(self.traffic_models):
+            mask = (model_ids == model_id) & ~self.obstacles[vehicles]
+            if not mask.any():
+                continue
+
+            selected = vehicles[mask]
+            accelerations[mask] = traffic_model.calculate_accelerations(
+                self.velocities[selected], self.gaps[selected], next_velocities[mask],
+                self.desired_velocities[selected], self.desired_time_headways[selected],
+                self.max_accelerations[selected], self.comfortable_decelerations[selected], has_next[mask])
+
+        return accelerations
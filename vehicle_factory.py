@@ -1,19 +1,61 @@
 from vehicle import *
 import random
 
+import numpy as np
+
+
+VEHICLE_TYPES = list(VehicleType)
+VEHICLE_CLASSES = {
+    VehicleType.Car: Car,
+    VehicleType.Truck: Truck,
+    VehicleType.AggressiveCar: AggressiveCar,
+    VehicleType.PassiveCar: PassiveCar,
+}
+
 
 class VehicleFactory:
+    # Number of vehicle types drawn from the random number generator at once
+    RANDOM_BLOCK_SIZE = 4096
+    # Vehicles are only reused when a pool size is given, see release_vehicles
+    DEFAULT_POOL_SIZE = 0
+    # Pool size for runs in which nothing keeps a reference to a vehicle that left the road
+    REUSE_POOL_SIZE = 1024
+
     """
+        The types of the random vehicles are drawn from the factory's own random number generator, in blocks of
+        RANDOM_BLOCK_SIZE types, so a factory created with the same seed and weights creates the same vehicles.
+        Changes to the weights take effect from the next block on.
+
+        Vehicles that are no longer used (e.g. vehicles that left the road) can be returned to the factory with
+        release_vehicles, create_vehicle then reuses them instead of allocating new vehicles. Reuse is opt-in: a road
+        releases every vehicle that leaves it, and a released vehicle is reset (with a new vehicle_id) when it is
+        reused, so a pool size should only be given when nothing keeps references to the vehicles of the road (e.g.
+        plots, detectors or user code holding on to objects from road.vehicles).
+
         Args:
             weights: list of weights with the bias for Cars, Trucks, AggressiveCars and PassiveCars in given order
             default_traffic_model: traffic model passed to the created vehicle in case no traffic model is supplied
             default_lane_change_model: lane change model passed to the created vehicle in case no traffic model is supplied
+            seed: seed of the random number generator (anything numpy.random.default_rng accepts), if None the seed
+                  is drawn from the global random module, so seeding that module still makes the factory deterministic
+            pool_size: maximum number of released vehicles kept for reuse per vehicle class, 0 (the default) to
+                       disable reuse, see REUSE_POOL_SIZE
     """
-    def __init__(self, weights, default_traffic_model, default_lane_change_model):
+    def __init__(self, weights, default_traffic_model, default_lane_change_model, seed=None,
+                 pool_size=DEFAULT_POOL_SIZE):
         self.weights = weights
         self.default_traffic_model = default_traffic_model
         self.default_lane_change_model = default_lane_change_model
 
+        self.random = np.random.default_rng(random.getrandbits(64) if seed is None else seed)
+        # Vehicle types that were drawn (as indices into VEHICLE_TYPES), the ones before the position are used
+        self.vehicle_type_block = []
+        self.vehicle_type_position = 0
+
+        self.pool_size = pool_size
+        # Released vehicles per vehicle class
+        self.pool = {}
+
     def create_vehicle(self, vehicle_type: VehicleType, traffic_model=None, lane_change_model=None):
         if traffic_model is None:
             traffic_model = self.default_traffic_model
@@ -21,26 +63,45 @@ class VehicleFactory:
         if lane_change_model is None:
             lane_change_model = self.default_lane_change_model
 
-        if vehicle_type is VehicleType.Car:
-            return Car(traffic_model=traffic_model, lane_change_model=lane_change_model)
-        elif vehicle_type is VehicleType.Truck:
-            return Truck(traffic_model=traffic_model, lane_change_model=lane_change_model)
-        elif vehicle_type is VehicleType.AggressiveCar:
-            return AggressiveCar(traffic_model=traffic_model, lane_change_model=lane_change_model)
-        elif vehicle_type is VehicleType.PassiveCar:
-            return PassiveCar(traffic_model=traffic_model, lane_change_model=lane_change_model)
-        else:
-            return Car(traffic_model=traffic_model, lane_change_model=lane_change_model)
+        vehicle_class = VEHICLE_CLASSES.get(vehicle_type, Car)
+        pool = self.pool.get(vehicle_class)
+        if pool:
+            vehicle = pool.pop()
+            vehicle.__init__(traffic_model=traffic_model, lane_change_model=lane_change_model)
+            return vehicle
+
+        return vehicle_class(traffic_model=traffic_model, lane_change_model=lane_change_model)
+
+    def release_vehicles(self, vehicles):
+        """Return vehicles that are no longer used to the pool, for reuse by create_vehicle"""
+        if self.pool_size == 0:
+            return
+
+        for vehicle in vehicles:
+            pool = self.pool.setdefault(type(vehicle), [])
+            if len(pool) < self.pool_size:
+                pool.append(vehicle)
 
     def create_random_vehicle(self, traffic_model=None, lane_change_model=None):
         return self.create_random_vehicles(num=1, traffic_model=traffic_model, lane_change_model=lane_change_model)[0]
 
-    def create_random_vehicles(self, num=1, traffic_model=None, lane_change_model=None):
-        vehicle_types = list(VehicleType)
-        random_vehicle_types = random.choices(vehicle_types, weights=self.weights, k=num)
+    def draw_vehicle_types(self, num):
+        """Next num random vehicle types from the block of drawn types, drawing a new block when it runs out"""
+        if self.vehicle_type_position + num > len(self.vehicle_type_block):
+            probabilities = np.asarray(self.weights, dtype=float)
+            probabilities /= probabilities.sum()
+            self.vehicle_type_block = self.vehicle_type_block[self.vehicle_type_position:] + self.random.choice(
+                len(probabilities), size=max(self.RANDOM_BLOCK_SIZE, num), p=probabilities).tolist()
+            self.vehicle_type_position = 0
+
+        start = self.vehicle_type_position
+        self.vehicle_type_position += num
 
+        return list(map(VEHICLE_TYPES.__getitem__, self.vehicle_type_block[start:start + num]))
+
+    def create_random_vehicles(self, num=1, traffic_model=None, lane_change_model=None):
         return [self.create_vehicle(vehicle_type, traffic_model, lane_change_model)
-                for vehicle_type in random_vehicle_types]
+                for vehicle_type in self.draw_vehicle_types(num)]
 
     def create_random_vehicle_row(self, num, spacing, lane=0, traffic_model=None, lane_change_model=None):
         vehicles = self.create_random_vehicles(num, traffic_model, lane_change_model)